@@ -0,0 +1,407 @@
+# -*- encoding:utf-8 -*-
+
+import os
+import sys
+import argparse
+import json
+import shlex
+import shutil
+import subprocess
+import time
+
+import numpy as np
+from PIL import Image
+
+##################################################
+#                初期処理関連
+##################################################
+NORMAL_EXIT = 0
+ERROR_EXIT = 1
+
+MAIN_SCRIPT_FILE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+OUTPUT_BENCHMARK_DIR = "output/benchmark"
+DEFAULT_WORK_DIR = OUTPUT_BENCHMARK_DIR + "/work"
+BASELINE_FILE_NAME = OUTPUT_BENCHMARK_DIR + "/baseline.json"
+REPORT_FILE_NAME = OUTPUT_BENCHMARK_DIR + "/report.json"
+CORPUS_SPEC_FILE_NAME = "corpus_spec.json"
+RUN_LOG_FILE_NAME = "run.log"
+# main.pyは作業ディレクトリからの相対パスで入出力するため、作業ディレクトリごとに用意する
+WORK_OUTPUT_DIRS = ["input", "output/Image", "output/Figure", "output/csv", "output/json"]
+PROFILE_FILE_NAME = "output/profile/profile.jsonl"
+
+CORPUS_FORMAT_VERSION = 1
+# 解像度は --scale で一律に拡大・縮小する(ジャケット画像に近い縦長・横長を混ぜる)
+CORPUS_RESOLUTIONS = {
+  "small": (240, 320),
+  "medium": (800, 600),
+  "large": (1200, 1600),
+}
+# (画像モード, 拡張子)の組み合わせ
+CORPUS_VARIANTS = [
+  ("RGB", "jpg"),
+  ("RGB", "png"),
+  ("L", "jpg"),
+  ("P", "png"),
+  ("RGBA", "png"),
+]
+CORPUS_MAKERS = ["Nintendo", "Sega", "Sony", "Capcom", "Konami", "Namco", "Square", "Hudson"]
+CORPUS_JPEG_QUALITY = 90
+CORPUS_PALETTE_COLORS = 64
+
+LATENCY_PERCENTILES = [50, 95, 99]
+# ベースラインと比較して悪化とみなす指標(値が大きいほど遅い・重い)
+REGRESSION_METRICS = ["wall_seconds", "latency_p50", "latency_p95", "peak_rss_bytes", "seconds_per_invocation"]
+# -p 付きの別の実行で測る1枚あたりの所要時間(計測用の実行とは分けて比較する)
+PROFILED_REGRESSION_METRICS = ["latency_p50", "latency_p95"]
+# 統計値のみ(-n)で小さな画像1枚を処理する起動込みの所要時間の目標
+STATS_ONLY_STARTUP_TARGET_SECONDS = 0.5
+STARTUP_INVOCATIONS = 5
+
+##################################################
+#                  引数制御用
+##################################################
+def DefineSystemArgumentsProcess():
+  parser = argparse.ArgumentParser(description="Benchmark main.py on a deterministic synthetic cover-image corpus.")
+  parser._action_groups.pop()
+  optional = parser.add_argument_group('optional arguments')
+  optional.add_argument("-w", "--work-dir", type=str, default=DEFAULT_WORK_DIR, help="The working directory for the corpus and outputs. The default value is " + DEFAULT_WORK_DIR + ".")
+  optional.add_argument("-n", "--count", type=int, default=1, help="Number of images per resolution and mode/format. The default value is 1.")
+  optional.add_argument("-x", "--scale", type=float, default=1.0, help="Scale factor applied to every corpus resolution. The default value is 1.0.")
+  optional.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpus. The default value is 0.")
+  optional.add_argument("-r", "--repeat", type=int, default=1, help="Run each case N times and report the median wall time. The default value is 1.")
+  optional.add_argument("-p", "--profile-runs", type=int, default=1, help="Number of extra runs per case with main.py -p for the per-image latencies and stage breakdown. These runs are reported separately and never mixed into the measured runs. The default value is 1 (0 to skip).")
+  optional.add_argument("-j", "--jobs", type=int, default=0, help="Also benchmark the parallel batch path with N jobs. The default value is 0 (skip).")
+  optional.add_argument("--single-files", type=int, default=3, help="Number of corpus files run through the single-file path (-f). The default value is 3.")
+  optional.add_argument("-a", "--main-args", type=str, default="", help="Extra arguments passed to every main.py run, e.g. \"-s 250000\".")
+  optional.add_argument("-k", "--cases", type=str, default="startup,single,batch,batch_jobs", help="Comma separated cases to run. The default value is startup,single,batch,batch_jobs.")
+  optional.add_argument("-b", "--save-baseline", action='store_const', default=False, const=True, help="Store this run's results as the baseline in " + BASELINE_FILE_NAME + ".")
+  optional.add_argument("-t", "--threshold", type=float, default=10.0, help="Regression threshold in percent against the baseline. The default value is 10.")
+  optional.add_argument("--regenerate", action='store_const', default=False, const=True, help="Regenerate the corpus even if the stored one matches.")
+  return parser.parse_args()
+
+##################################################
+#              合成コーパス生成用
+##################################################
+def MakeCorpusSpec(count: int, scale: float, seed: int):
+  return {
+    "format_version": CORPUS_FORMAT_VERSION,
+    "count": count,
+    "scale": scale,
+    "seed": seed,
+    "resolutions": {name: [max(16, int(width * scale)), max(16, int(height * scale))] for name, (width, height) in CORPUS_RESOLUTIONS.items()},
+    "variants": CORPUS_VARIANTS,
+  }
+
+def MakeCorpusFileName(rng: np.random.Generator, image_index: int, resolution_name: str, image_mode: str, extension: str):
+  # ファイル名の規約: 売上_メーカー_発売日_タイトル(空白は'_'区切り)
+  sales_count = int(rng.integers(1000, 5000000))
+  maker_name = CORPUS_MAKERS[int(rng.integers(len(CORPUS_MAKERS)))]
+  seles_date = "{:04d}{:02d}{:02d}".format(int(rng.integers(1985, 2024)), int(rng.integers(1, 13)), int(rng.integers(1, 29)))
+  software_name = "Bench_Cover_{:04d}_{}_{}".format(image_index, resolution_name, image_mode)
+  return "{}_{}_{}_{}.{}".format(sales_count, maker_name, seles_date, software_name, extension)
+
+def MakeSyntheticCover(rng: np.random.Generator, width: int, height: int):
+  # 色相のグラデーションに矩形の色面とノイズを重ね、実際のジャケット画像に近い圧縮率と色分布にする
+  y_axis, x_axis = np.mgrid[0:height, 0:width].astype(np.float32)
+  hue_direction = rng.uniform(-1.0, 1.0, size=2) * (256.0 / max(width, height))
+  hsv_data = np.empty((height, width, 3), dtype=np.float32)
+  hsv_data[:, :, 0] = rng.uniform(0, 256) + x_axis * hue_direction[0] + y_axis * hue_direction[1]
+  hsv_data[:, :, 1] = rng.uniform(40, 255) * (0.5 + 0.5 * x_axis / width)
+  hsv_data[:, :, 2] = rng.uniform(60, 255) * (1.0 - 0.5 * y_axis / height)
+  for _ in range(int(rng.integers(3, 9))):
+    left, top = int(rng.integers(0, width)), int(rng.integers(0, height))
+    right, bottom = left + int(rng.integers(width // 10 + 1, width // 2 + 2)), top + int(rng.integers(height // 10 + 1, height // 2 + 2))
+    hsv_data[top:bottom, left:right] = rng.uniform(0, 256, size=3)
+  hsv_data += rng.normal(0.0, 6.0, size=hsv_data.shape).astype(np.float32)
+  hsv_data[:, :, 0] %= 256
+  hsv_image = Image.fromarray(np.clip(hsv_data, 0, 255).astype(np.uint8), "HSV")
+  return hsv_image.convert("RGB")
+
+def ConvertCoverMode(rgb_image: Image, image_mode: str):
+  if image_mode == "L":
+    return rgb_image.convert("L")
+  if image_mode == "P":
+    return rgb_image.convert("P", palette=Image.ADAPTIVE, colors=CORPUS_PALETTE_COLORS)
+  if image_mode == "RGBA":
+    # 左から右へ透明度を変える
+    alpha_data = np.tile(np.linspace(64, 255, rgb_image.width, dtype=np.uint8), (rgb_image.height, 1))
+    rgba_image = rgb_image.copy()
+    rgba_image.putalpha(Image.fromarray(alpha_data, "L"))
+    return rgba_image
+  return rgb_image
+
+def GenerateCorpus(input_dir: str, corpus_spec: dict):
+  rng = np.random.default_rng(corpus_spec["seed"])
+  generated_file_names = []
+  image_index = 0
+  for resolution_name, (width, height) in corpus_spec["resolutions"].items():
+    for image_mode, extension in corpus_spec["variants"]:
+      for _ in range(corpus_spec["count"]):
+        corpus_file_name = os.path.join(input_dir, MakeCorpusFileName(rng, image_index, resolution_name, image_mode, extension))
+        cover_image = ConvertCoverMode(MakeSyntheticCover(rng, width, height), image_mode)
+        if extension == "jpg":
+          cover_image.save(corpus_file_name, quality=CORPUS_JPEG_QUALITY)
+        else:
+          cover_image.save(corpus_file_name)
+        generated_file_names.append(corpus_file_name)
+        image_index += 1
+  return generated_file_names
+
+def PrepareCorpus(work_dir: str, corpus_spec: dict, is_regenerate: bool):
+  input_dir = os.path.join(work_dir, "input")
+  spec_file_name = os.path.join(work_dir, CORPUS_SPEC_FILE_NAME)
+  if is_regenerate == False and os.path.isfile(spec_file_name):
+    with open(spec_file_name, mode='r', encoding='utf-8') as spec_file:
+      # JSONを経由すると(モード, 拡張子)の組がリストになるため同じ形に揃えて比較する
+      if json.load(spec_file) == json.loads(json.dumps(corpus_spec)):
+        return sorted(os.path.join(input_dir, file_name) for file_name in os.listdir(input_dir))
+
+  shutil.rmtree(input_dir, ignore_errors=True)
+  os.makedirs(input_dir)
+  generated_file_names = GenerateCorpus(input_dir, corpus_spec)
+  with open(spec_file_name, mode='w', encoding='utf-8') as spec_file:
+    json.dump(corpus_spec, spec_file, ensure_ascii=False, indent=2)
+  return sorted(generated_file_names)
+
+##################################################
+#                  計測実行用
+##################################################
+def ResetWorkOutputs(work_dir: str):
+  # 追記モードのCSVやキャッシュが前回の実行結果を引き継がないよう出力を毎回作り直す
+  shutil.rmtree(os.path.join(work_dir, "output"), ignore_errors=True)
+  for output_dir in WORK_OUTPUT_DIRS:
+    os.makedirs(os.path.join(work_dir, output_dir), exist_ok=True)
+
+def RunMainScript(work_dir: str, main_arguments: list, is_profiled: bool = False):
+  # 標準出力は進捗表示を含むためログファイルへ逃がし、wait4で子プロセス(ワーカー含む)の最大RSSも回収する
+  command = [sys.executable, MAIN_SCRIPT_FILE_NAME] + (["-p"] if is_profiled == True else []) + main_arguments
+  with open(os.path.join(work_dir, RUN_LOG_FILE_NAME), mode='w', encoding='utf-8') as log_file:
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, cwd=work_dir, stdout=log_file, stderr=subprocess.STDOUT)
+    if hasattr(os, "wait4"):
+      _, exit_status, resource_usage = os.wait4(process.pid, 0)
+      process.returncode = os.waitstatus_to_exitcode(exit_status)
+      max_rss = resource_usage.ru_maxrss if sys.platform == "darwin" else resource_usage.ru_maxrss * 1024
+    else:
+      process.wait()
+      max_rss = None
+    wall_seconds = time.perf_counter() - start_time
+  if process.returncode != NORMAL_EXIT:
+    raise RuntimeError("main.py exited with " + str(process.returncode) + ": " + " ".join(command) + " (see " + os.path.join(work_dir, RUN_LOG_FILE_NAME) + ")")
+  return wall_seconds, max_rss
+
+def LoadImageProfiles(work_dir: str):
+  with open(os.path.join(work_dir, PROFILE_FILE_NAME), mode='r', encoding='utf-8') as profile_file:
+    return [json.loads(line) for line in profile_file if line.strip() != ""]
+
+def AddLatencyPercentiles(summary: dict, latencies: list):
+  for percentile, value in zip(LATENCY_PERCENTILES, np.percentile(latencies, LATENCY_PERCENTILES) if len(latencies) > 0 else [None] * len(LATENCY_PERCENTILES)):
+    summary["latency_p" + str(percentile)] = None if value is None else float(value)
+
+def SummarizeRuns(run_records: list, image_count: int):
+  # 計測用の実行は -p を付けずに行い、壁時計時間は中央値の回を代表とする
+  wall_seconds_list = [run_record["wall_seconds"] for run_record in run_records]
+  wall_seconds = float(np.median(wall_seconds_list))
+  summary = {
+    "runs": len(run_records),
+    "images": image_count,
+    "wall_seconds": wall_seconds,
+    "images_per_second": image_count / wall_seconds if wall_seconds > 0 else None,
+    "peak_rss_bytes": max((run_record["max_rss"] for run_record in run_records if run_record["max_rss"] is not None), default=None),
+  }
+  # 1回の実行で1枚を処理する場合は実行ごとの時間がそのままレイテンシになる(一括処理では画像ごとの時間は -p なしでは分からない)
+  AddLatencyPercentiles(summary, [latency for run_record in run_records for latency in run_record.get("invocation_seconds", [])])
+  return summary
+
+def SummarizeProfiledRuns(image_profiles: list, profiled_run_count: int):
+  # 画像ごとのレイテンシと処理段階別の内訳は -p 付きの別の実行から集計し、計測用の実行の数値には混ぜない
+  image_latencies = [image_profile["total_seconds"] + image_profile["stages"].get("result_write", 0.0) for image_profile in image_profiles]
+  summary = {"runs": profiled_run_count, "stages": {}}
+  AddLatencyPercentiles(summary, image_latencies)
+  stage_names = sorted({stage_name for image_profile in image_profiles for stage_name in image_profile["stages"]})
+  for stage_name in stage_names:
+    stage_seconds = [image_profile["stages"].get(stage_name, 0.0) for image_profile in image_profiles]
+    summary["stages"][stage_name] = {"p50": float(np.percentile(stage_seconds, 50)), "total": float(np.sum(stage_seconds)) / profiled_run_count}
+  return summary
+
+def RunSingleFileCase(work_dir: str, corpus_file_names: list, single_file_count: int, repeat: int, profile_runs: int, main_arguments: list):
+  # 解像度・モードが偏らないよう等間隔に選ぶ
+  step = max(1, len(corpus_file_names) // max(1, single_file_count))
+  target_file_names = corpus_file_names[::step][:single_file_count]
+  run_records = []
+  for _ in range(repeat):
+    ResetWorkOutputs(work_dir)
+    invocation_seconds = []
+    max_rss_list = []
+    for target_file_name in target_file_names:
+      file_wall_seconds, max_rss = RunMainScript(work_dir, ["-f", os.path.relpath(target_file_name, work_dir)] + main_arguments)
+      invocation_seconds.append(file_wall_seconds)
+      max_rss_list.append(max_rss)
+    run_records.append({
+      "wall_seconds": sum(invocation_seconds),
+      "max_rss": max(max_rss_list) if None not in max_rss_list else None,
+      "invocation_seconds": invocation_seconds,
+    })
+  summary = SummarizeRuns(run_records, len(target_file_names))
+  # 単一ファイル実行は起動時間込みの1回あたりの時間が利用者の待ち時間になる
+  summary["seconds_per_invocation"] = summary["wall_seconds"] / len(target_file_names)
+
+  image_profiles = []
+  for _ in range(profile_runs):
+    ResetWorkOutputs(work_dir)
+    for target_file_name in target_file_names:
+      RunMainScript(work_dir, ["-f", os.path.relpath(target_file_name, work_dir)] + main_arguments, is_profiled=True)
+      # プロファイルは実行ごとに上書きされるため1ファイルずつ回収する
+      image_profiles.extend(LoadImageProfiles(work_dir))
+  if profile_runs > 0:
+    summary["profiled"] = SummarizeProfiledRuns(image_profiles, profile_runs)
+  return summary
+
+def RunStartupCase(work_dir: str, corpus_file_names: list, repeat: int, main_arguments: list):
+  # 最小の画像を統計値のみで処理し、インタプリタ起動とモジュール読み込みの時間を測る
+  target_file_name = min(corpus_file_names, key=os.path.getsize)
+  wall_seconds_list = []
+  max_rss_list = []
+  for _ in range(repeat * STARTUP_INVOCATIONS):
+    ResetWorkOutputs(work_dir)
+    wall_seconds, max_rss = RunMainScript(work_dir, ["-n", "-f", os.path.relpath(target_file_name, work_dir)] + main_arguments)
+    wall_seconds_list.append(wall_seconds)
+    max_rss_list.append(max_rss)
+  wall_seconds = float(np.median(wall_seconds_list))
+  summary = {
+    "runs": len(wall_seconds_list),
+    "images": 1,
+    "wall_seconds": wall_seconds,
+    "images_per_second": 1 / wall_seconds,
+    "peak_rss_bytes": max(max_rss_list) if None not in max_rss_list else None,
+    "seconds_per_invocation": wall_seconds,
+    "target_seconds": STATS_ONLY_STARTUP_TARGET_SECONDS,
+  }
+  AddLatencyPercentiles(summary, wall_seconds_list)
+  return summary
+
+def RunBatchCase(work_dir: str, image_count: int, repeat: int, profile_runs: int, main_arguments: list):
+  run_records = []
+  for _ in range(repeat):
+    ResetWorkOutputs(work_dir)
+    wall_seconds, max_rss = RunMainScript(work_dir, main_arguments)
+    run_records.append({"wall_seconds": wall_seconds, "max_rss": max_rss})
+  summary = SummarizeRuns(run_records, image_count)
+
+  image_profiles = []
+  for _ in range(profile_runs):
+    ResetWorkOutputs(work_dir)
+    RunMainScript(work_dir, main_arguments, is_profiled=True)
+    image_profiles.extend(LoadImageProfiles(work_dir))
+  if profile_runs > 0:
+    summary["profiled"] = SummarizeProfiledRuns(image_profiles, profile_runs)
+  return summary
+
+##################################################
+#                 結果比較用
+##################################################
+def CompareWithBaseline(report: dict, baseline: dict, threshold: float):
+  regressions = []
+  if baseline.get("corpus") != report["corpus"] or baseline.get("main_args") != report["main_args"]:
+    print("[!]: The baseline was measured on a different corpus or arguments. The comparison may be meaningless.")
+  for case_name, case_summary in report["cases"].items():
+    baseline_summary = baseline.get("cases", {}).get(case_name)
+    if baseline_summary is None:
+      continue
+    compared_metrics = [(metric_name, case_summary.get(metric_name), baseline_summary.get(metric_name)) for metric_name in REGRESSION_METRICS]
+    compared_metrics += [("profiled_" + metric_name, case_summary.get("profiled", {}).get(metric_name), baseline_summary.get("profiled", {}).get(metric_name))
+                         for metric_name in PROFILED_REGRESSION_METRICS]
+    for metric_name, current_value, baseline_value in compared_metrics:
+      if current_value is None or baseline_value is None or baseline_value == 0:
+        continue
+      change_percent = (current_value - baseline_value) / baseline_value * 100
+      case_summary.setdefault("baseline_change_percent", {})[metric_name] = change_percent
+      if change_percent > threshold:
+        regressions.append((case_name, metric_name, baseline_value, current_value, change_percent))
+  return regressions
+
+def FormatBytes(byte_count):
+  return "-" if byte_count is None else '{:.1f} MB'.format(byte_count / (1024 * 1024))
+
+def FormatMilliseconds(seconds):
+  return "-" if seconds is None else '{:.1f}'.format(seconds * 1000)
+
+def PrintReport(report: dict):
+  print('{:<12}{:>8}{:>10}{:>10}{:>12}{:>12}{:>12}{:>12}'.format("case", "images", "wall s", "img/s", "p50 ms", "p95 ms", "p99 ms", "peak RSS"))
+  for case_name, case_summary in report["cases"].items():
+    print('{:<12}{:>8}{:>10.2f}{:>10.2f}{:>12}{:>12}{:>12}{:>12}'.format(
+      case_name, case_summary["images"], case_summary["wall_seconds"], case_summary["images_per_second"] or 0.0,
+      FormatMilliseconds(case_summary["latency_p50"]), FormatMilliseconds(case_summary["latency_p95"]), FormatMilliseconds(case_summary["latency_p99"]),
+      FormatBytes(case_summary["peak_rss_bytes"])))
+    if "profiled" in case_summary:
+      profiled_summary = case_summary["profiled"]
+      print('  {:<20}per image p50 {} ms, p95 {} ms, p99 {} ms  ({} run(s) with -p, not included above)'.format(
+        "profiled", FormatMilliseconds(profiled_summary["latency_p50"]), FormatMilliseconds(profiled_summary["latency_p95"]),
+        FormatMilliseconds(profiled_summary["latency_p99"]), profiled_summary["runs"]))
+      for stage_name, stage_summary in profiled_summary["stages"].items():
+        print('    {:<18}p50 {:>9.2f} ms  total {:>8.2f} s'.format(stage_name, stage_summary["p50"] * 1000, stage_summary["total"]))
+    if "target_seconds" in case_summary:
+      print('  {:<20}{:>9.3f} s  (target {:.3f} s)'.format("per invocation", case_summary["seconds_per_invocation"], case_summary["target_seconds"]))
+    for metric_name, change_percent in case_summary.get("baseline_change_percent", {}).items():
+      print('  vs baseline {:<18}{:>+8.1f} %'.format(metric_name, change_percent))
+
+##################################################
+#                    Main
+##################################################
+if __name__ == '__main__':
+  try:
+    args = DefineSystemArgumentsProcess()
+    main_arguments = shlex.split(args.main_args)
+    case_names = [case_name.strip() for case_name in args.cases.split(",") if case_name.strip() != ""]
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    corpus_spec = MakeCorpusSpec(max(args.count, 1), args.scale, args.seed)
+    print("Preparing corpus:", args.work_dir)
+    corpus_file_names = PrepareCorpus(args.work_dir, corpus_spec, args.regenerate)
+    print("Corpus images:", len(corpus_file_names))
+
+    report = {"corpus": json.loads(json.dumps(corpus_spec)), "main_args": args.main_args, "python": sys.version.split()[0], "cases": {}}
+    for case_name in case_names:
+      print("Running case:", case_name)
+      if case_name == "startup":
+        report["cases"][case_name] = RunStartupCase(args.work_dir, corpus_file_names, max(args.repeat, 1), main_arguments)
+      elif case_name == "single":
+        report["cases"][case_name] = RunSingleFileCase(args.work_dir, corpus_file_names, args.single_files, max(args.repeat, 1), max(args.profile_runs, 0), main_arguments)
+      elif case_name == "batch":
+        report["cases"][case_name] = RunBatchCase(args.work_dir, len(corpus_file_names), max(args.repeat, 1), max(args.profile_runs, 0), main_arguments)
+      elif case_name == "batch_jobs":
+        if args.jobs > 1:
+          report["cases"][case_name] = RunBatchCase(args.work_dir, len(corpus_file_names), max(args.repeat, 1), max(args.profile_runs, 0), ["-j", str(args.jobs)] + main_arguments)
+      else:
+        print("[!]: Unknown case was skipped:", case_name)
+
+    regressions = []
+    if os.path.isfile(BASELINE_FILE_NAME) and args.save_baseline == False:
+      with open(BASELINE_FILE_NAME, mode='r', encoding='utf-8') as baseline_file:
+        regressions = CompareWithBaseline(report, json.load(baseline_file), args.threshold)
+
+    PrintReport(report)
+    os.makedirs(OUTPUT_BENCHMARK_DIR, exist_ok=True)
+    with open(REPORT_FILE_NAME, mode='w', encoding='utf-8') as report_file:
+      json.dump(report, report_file, ensure_ascii=False, indent=2)
+    if args.save_baseline == True:
+      with open(BASELINE_FILE_NAME, mode='w', encoding='utf-8') as baseline_file:
+        json.dump(report, baseline_file, ensure_ascii=False, indent=2)
+      print("Saved baseline:", BASELINE_FILE_NAME)
+
+    for case_name, metric_name, baseline_value, current_value, change_percent in regressions:
+      print("[-]: Regression in {} {}: {:.4g} -> {:.4g} ({:+.1f} %)".format(case_name, metric_name, baseline_value, current_value, change_percent))
+    missed_targets = [case_name for case_name, case_summary in report["cases"].items()
+                      if "target_seconds" in case_summary and case_summary["seconds_per_invocation"] > case_summary["target_seconds"]]
+    for case_name in missed_targets:
+      print("[-]: {} took {:.3f} s per invocation (target {:.3f} s)".format(case_name, report["cases"][case_name]["seconds_per_invocation"], report["cases"][case_name]["target_seconds"]))
+    if len(regressions) > 0 or len(missed_targets) > 0:
+      sys.exit(ERROR_EXIT)
+  except Exception as e:
+    print("\nUnexpected error: " + str(e))
+    sys.exit(ERROR_EXIT)
+  except KeyboardInterrupt:
+    print("\nKeyboard Interrupt: The benchmark aborted.")
+    sys.exit(NORMAL_EXIT)
+
+  sys.exit(NORMAL_EXIT)
@@ -6,20 +6,38 @@ import re
 import argparse
 import json
 import itertools
-import multiprocessing
-import asyncio
+import threading
 import time
 import glob
 import csv
 import tracemalloc
 import gc
+import collections
+import concurrent.futures
+import hashlib
+import math
+import sqlite3
+import struct
+import zlib
+import contextlib
+import io
+import queue
+import importlib.util
 
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')                 # お試し
-import matplotlib.pyplot as plt
-import japanize_matplotlib
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
+try:
+  import resource
+except ImportError:
+  # Windowsには存在しないため最大RSSの記録を省略する
+  resource = None
+# matplotlibと日本語フォントの登録は起動時間の大半を占めるため、グラフを描く時点で読み込む(ImportPlottingModules)
+matplotlib = None
+plt = None
+# 解析サービスだけが使うHTTPサーバー関連のモジュールも同様にサービスの開始時に読み込む(ImportServiceModules)
+http = None
+socketserver = None
+urllib = None
 
 ##################################################
 #                初期処理関連                 
@@ -27,12 +45,55 @@ from PIL import Image
 NORMAL_EXIT = 0
 ERROR_EXIT = 1
 
+INPUT_DIR = "input"
 OUTPUT_IMAGE_DIR = "output/Image"
 OUTPUT_FIGURE_DIR = "output/Figure"
 OUTPUT_CSV_DIR = "output/csv"
 OUTPUT_JSON_DIR = "output/json"
 CSV_FILE_NAME = OUTPUT_CSV_DIR + "/Image_statistics.csv"
 JSON_FILE_NAME = OUTPUT_JSON_DIR + "/statistics_report.json"
+OUTPUT_CACHE_DIR = "output/cache"
+MANIFEST_FILE_NAME = OUTPUT_CACHE_DIR + "/analysis_manifest.json"
+MANIFEST_FORMAT_VERSION = 1
+OUTPUT_STORE_DIR = "output/store"
+HISTOGRAM_STORE_FILE_NAME = OUTPUT_STORE_DIR + "/histograms.bin"
+HISTOGRAM_INDEX_FILE_NAME = OUTPUT_STORE_DIR + "/histogram_index.jsonl"
+HISTOGRAM_STORE_DTYPE = np.dtype('<u4')
+OUTPUT_DATABASE_DIR = "output/db"
+DATABASE_FILE_NAME = OUTPUT_DATABASE_DIR + "/hsv_statistics.sqlite3"
+QUERY_CSV_FILE_NAME = "query_result.csv"
+QUERY_JSON_FILE_NAME = "query_result.json"
+OUTPUT_AGGREGATE_DIR = "output/aggregate"
+AGGREGATE_MEMBER_FILE_NAME = OUTPUT_AGGREGATE_DIR + "/member_histograms.bin"
+AGGREGATE_MEMBER_INDEX_FILE_NAME = OUTPUT_AGGREGATE_DIR + "/member_index.jsonl"
+AGGREGATE_GROUP_FILE_NAME = OUTPUT_AGGREGATE_DIR + "/group_histograms.json"
+AGGREGATE_CSV_FILE_NAME = OUTPUT_AGGREGATE_DIR + "/group_statistics.csv"
+AGGREGATE_JSON_FILE_NAME = OUTPUT_AGGREGATE_DIR + "/group_statistics.json"
+AGGREGATE_FORMAT_VERSION = 1
+AGGREGATE_GROUP_TYPE_NAMES = {"maker": "メーカー", "release_year": "発売年", "sales_bucket": "売上帯"}
+AGGREGATE_PERCENTILES = [10, 25, 75, 90]
+SALES_BUCKET_BOUNDARIES = [1000, 10000, 100000, 1000000]
+OUTPUT_DEDUP_DIR = "output/dedup"
+NEAR_DUPLICATE_INDEX_FILE_NAME = OUTPUT_DEDUP_DIR + "/near_duplicate_index.jsonl"
+NEAR_DUPLICATE_HISTOGRAM_FILE_NAME = OUTPUT_DEDUP_DIR + "/near_duplicate_histograms.bin"
+NEAR_DUPLICATE_FORMAT_VERSION = 1
+NEAR_DUPLICATE_THUMBNAIL_SIZE = (9, 8)          # dHash: 横に隣り合う画素の明るさの大小を 8 x 8 = 64ビットに並べる
+NEAR_DUPLICATE_MAX_COLOR_DIFFERENCE = 8         # 明るさの並びが同じ色違いの画像を区別するため、平均色(RGB)の差もこの値以内に限る
+NEAR_DUPLICATE_CSV_HEADER = ['近似重複元', 'ハミング距離']
+NEAR_DUPLICATE_RESULT_KEYS = ("hue_mean", "hue_median", "saturation_mean", "saturation_median", "brightness_mean", "brightness_median",
+                              "sample_size", "total_pixel_count",
+                              "hue_mean_error", "hue_median_error", "saturation_mean_error", "saturation_median_error", "brightness_mean_error", "brightness_median_error",
+                              "dominant_colors")     # 近似重複の画像に引き継ぐ統計値
+OUTPUT_PROFILE_DIR = "output/profile"
+PROFILE_FILE_NAME = OUTPUT_PROFILE_DIR + "/profile.jsonl"
+PROFILE_SUMMARY_FILE_NAME = OUTPUT_PROFILE_DIR + "/profile_summary.json"
+PROFILE_STAGE_NAMES = ["decode", "hsv_convert", "channel_extract", "statistics", "channel_png_save", "histogram_render", "figure_savefig", "result_write"]
+PROFILE_PERCENTILES = [50, 95, 99]
+CSV_HEADER = ['# 売上', 'メーカー', '発売日', 'タイトル', '色相の平均値', '色相の中央値',  '彩度の平均値', '彩度の中央値', '明度の平均値', '明度の中央値']
+SAMPLING_CSV_HEADER = ['標本数', '総画素数', '色相の平均値の標準誤差', '色相の中央値の標準誤差', '彩度の平均値の標準誤差', '彩度の中央値の標準誤差', '明度の平均値の標準誤差', '明度の中央値の標準誤差']
+DOMINANT_COLOR_CSV_HEADER_FORMATS = ['主要色{}の色相', '主要色{}の彩度', '主要色{}の明度', '主要色{}の占有率']
+OUTPUT_SUFFIX_NAMES = ['Image_Hue.png', 'Image_Saturation.png', 'Image_Brightness.png']
+COMPOSITE_FIGURE_SUFFIX_NAME = 'Image_HSV.png'
 COLORS = {
   "blue": "b",
   "green": "g",
@@ -43,10 +104,77 @@ COLORS = {
   "black": "k",
   "white": "w"
 }
+FIGURE_BACKENDS = ["matplotlib", "raster"]
+# 直接描画する図表の配置(matplotlibの既定の6.4 x 4.8インチ・100dpiと、subplotの既定の余白に合わせる)
+RASTER_FIGURE_SIZE = (640, 480)
+RASTER_AXES_BOX = (80, 58, 576, 427)   # 左, 上, 右, 下
+RASTER_COLORS = {
+  "b": (0, 0, 255),
+  "g": (0, 128, 0),
+  "r": (255, 0, 0),
+  "c": (0, 191, 191),
+  "m": (191, 0, 191),
+  "y": (191, 191, 0),
+  "k": (0, 0, 0),
+  "w": (255, 255, 255)
+}
+# 図表は1画素1バイトの濃淡で描き、保存時にパレット画像として書き出す(0番は棒の色、それ以外は同じ明るさの灰色)
+RASTER_BAR_LEVEL = 0
+RASTER_TEXT_LEVEL = 1                  # 文字の滑らかな縁が棒の色と重ならないよう、黒は1番で描く
+RASTER_BACKGROUND_LEVEL = 255
+RASTER_FONT_FILE_NAME = "fonts/ipaexg.ttf"
+RASTER_TITLE_FONT_SIZE = 17            # 12pt
+RASTER_LABEL_FONT_SIZE = 14            # 10pt
+RASTER_TICK_FONT_SIZE = 14
+RASTER_ANALYTICS_FONT_SIZE = 11        # 8pt
+RASTER_TICK_LENGTH = 5
+RASTER_X_TICK_STEP = 50
+RASTER_MAX_Y_TICKS = 8
+RASTER_PNG_COMPRESS_LEVEL = 1          # 図表は単色の塗りが大半のため、圧縮を弱めても大きさはほとんど変わらない
 DEFAULT_EQUAL_WIDTH_BINS = 255
 DEFAULT_NUMBER_OUTPUT_FORMAT='{:.1f}'
+DEFAULT_ERROR_OUTPUT_FORMAT='{:.3f}'
 WHITE_PADDING = "                                                "
-BUFFER_POOL_SIZE = 10
+BUFFER_POOL_SIZE = 10                 # 何件ごとにCSVを書き出しておくか(異常終了時の退避用)
+HISTOGRAM_BIN_SIZE = 256
+JOINT_HISTOGRAM_SHIFT = 4             # 主要色の抽出では色相・彩度・明度の上位4bit(16段階)ずつを使う
+JOINT_HISTOGRAM_LEVELS = HISTOGRAM_BIN_SIZE >> JOINT_HISTOGRAM_SHIFT
+HSV_KERNEL_CHUNK_PIXELS = 1 << 16     # HSV変換の作業用配列を確保する画素数の単位(キャッシュに収まる約3MB)
+DATABASE_COMMIT_INTERVAL = 500       # 何件ごとにまとめてトランザクションを確定するか
+QUERY_FETCH_SIZE = 1000
+STREAMING_BYTES_PER_PIXEL = 16        # 分割処理で1画素あたりに必要な作業領域の見積り(切り出し+RGB+HSV+各チャンネル)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+MAX_IN_FLIGHT_FACTOR = 2              # 並列処理時にワーカー数の何倍までタスクを先行投入するか
+HASH_READ_CHUNK_SIZE = 1024 * 1024
+FILE_NAME_INFORMATION_KEYS = ("sales_count", "maker_name", "seles_date", "software_name")     # ファイル名から読み取る項目
+TRANSIENT_RESULT_KEYS = ("histograms", "profile", "image_signature")     # キャッシュに保存しない解析結果の項目
+DEFAULT_MEMORY_BUDGET_RATIO = 0.5     # メモリ予算の指定がない時に空きメモリの何割まで画像の作業領域に使うか
+MIN_WORKER_RSS_LIMIT_MEGABYTES = 512  # ワーカーのRSS上限の自動設定の下限(matplotlibを読み込んだプロセスの常駐分を下回らないように)
+MIN_FALLBACK_TILE_MEGABYTES = 16      # 予算を超える画像を帯状に処理する時の作業領域の下限
+IMAGE_FIXED_OVERHEAD_BYTES = 16 * 1024 * 1024     # 画素数によらない1枚あたりの作業領域(変換の作業用配列、ヒストグラム、グラフなど)
+CHANNEL_IMAGE_BYTES_PER_PIXEL = 3     # 書き出し用に複製するH/S/Vの画像
+HSV_PLANE_BYTES_PER_PIXEL = 3         # HSV変換の出力
+DEFAULT_WATCH_INTERVAL = 1.0          # 監視モードでの待ち時間・ポーリング間隔(秒)
+JSON_TAIL_READ_SIZE = 64              # 監視モードで既存のJSONの配列の閉じ方を調べるために末尾から読む大きさ
+DEFAULT_NEAR_DUPLICATE_DISTANCE = 4   # 近似重複とみなすdHash(64ビット)のハミング距離の上限
+INOTIFY_READ_SIZE = 64 * 1024
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+DEFAULT_SERVICE_HOST = "127.0.0.1"     # 解析サービスは外部に公開しない
+DEFAULT_SERVICE_PORT = 8765
+DEFAULT_SERVICE_MAX_PENDING = 64      # 解析待ちで受け付ける要求の上限(超えた分は503で断る)
+DEFAULT_SERVICE_MAX_BATCH = 8         # 1回でワーカーに渡す要求の上限
+SERVICE_MAX_REQUEST_BYTES = 256 * 1024 * 1024
+SERVICE_LATENCY_WINDOW = 1000         # 応答時間の統計に使う直近の要求数
+SERVICE_RETRY_AFTER_SECONDS = 1
+SERVICE_LISTEN_BACKLOG = 128          # 同時に接続してきたクライアントをOSで待たせておける数(既定の5では接続が切られる)
 
 # グラフタイトル用の変数
 ENGLISH_WINDOW_TITLE_PREFIX = "Figure of "
@@ -67,6 +195,42 @@ BRIGHTNESS_FIGURE_TITLE_NAME = {
   'english': ENGLISH_WINDOW_TITLE_PREFIX + "Brightness" + ENGLISH_WINDOW_TITLE_SUFFIX,
   'japanese': JAPANESE_WINDOW_TITLE_PREFIX + "明度" + JAPANESE_WINDOW_TITLE_SUFFIX
 }
+XLABEL_LIST = {
+  'hue_label': {
+    'english': 'Value of Hue',
+    'japanese': '色相の値'
+  },
+  'saturation_label': {
+    'english': 'Value of saturation',
+    'japanese': '彩度の値'
+  },
+  'brightness_label': {
+    'english': 'Value of brightness',
+    'japanese': '明度の値'
+  },
+}
+YLABEL_LIST = {
+  'hue_label': {
+    'english': 'Frequent',
+    'japanese': '頻出度'
+  },
+  'saturation_label': {
+    'english': 'Frequent',
+    'japanese': '頻出度'
+  },
+  'brightness_label': {
+    'english': 'Frequent',
+    'japanese': '頻出度'
+  },
+}
+MEAN_LABEL = {
+  'english': 'Mean',
+  'japanese': '平均値'
+}
+MEDIAN_LABEL = {
+  'english': 'Median',
+  'japanese': '中央値'
+}
 
 input_file_name = ""
 output_file_name = ""
@@ -76,12 +240,48 @@ is_dny_output = False
 use_interactive_mode = False
 is_memory_trace_mode = False
 verbosity = 0
+number_of_jobs = 1
+is_incremental_mode = False
+sample_pixel_count = 0
+use_histogram_store = False
+is_from_store_mode = False
+use_group_aggregate = False
+use_near_duplicate_index = False
+near_duplicate_distance = DEFAULT_NEAR_DUPLICATE_DISTANCE
+use_result_database = False
+is_query_mode = False
+query_filters = {}
+tile_budget_megabytes = 0
+is_profile_mode = False
+is_allocation_trace_mode = False
+is_stats_only_mode = False
+pipeline_queue_depth = 0
+dominant_color_count = 0
+is_watch_mode = False
+watch_interval = DEFAULT_WATCH_INTERVAL
+is_service_mode = False
+service_port = DEFAULT_SERVICE_PORT
+service_socket_path = ""
+service_max_pending = DEFAULT_SERVICE_MAX_PENDING
+service_max_batch = DEFAULT_SERVICE_MAX_BATCH
+memory_budget_bytes = 0
+worker_rss_limit_bytes = 0
 default_xlim_max = 255
 default_xlim_min = 0
 regex_file_name_pattern = r'.+\.(png|PNG|jpg|jpeg|JPG|JPEG)'
 is_init_process = True
+histogram_figure_templates = {}
+histogram_store = None
+group_aggregate = None
+near_duplicate_index = None
+result_database = None
+hsv_converter = None
+figure_backend = "matplotlib"
+is_composite_figure = False
+raster_fonts = {}
 
 DEFAULT_X_TEXT_POSITON = 5
+EMPTY_HISTOGRAM_Y_TOP = 1.0           # 画素のないヒストグラムの図表の縦軸の上限
 DEFAULT_Y_TEXT_POSITON = 0
 DEFAULT_BACKGROUND_COLOR = "#ffffff"
 
@@ -89,11 +289,11 @@ NOMAL_MODE = 0
 NOISY_MODE = 1
 VERY_NOISY_MODE = 2
 
-MAIN_PROCESS_IS_IN_PROGRESS = "InProgress"
-MAIN_PROCESS_WAS_FINISHED = "Finish"
-MAIN_PROCESS_REQUESTS_SLEEP_CALL = "Wait" 
+PROGRESS_REFRESH_INTERVAL = 0.2     # 進捗表示の更新間隔(秒)
 
-sync_queue = multiprocessing.Queue(16)
+progress_reporter = None
+profile_report = None
+profile_state = threading.local()     # パイプライン処理では解析と出力が別スレッドで同時に進むためスレッドごとに計測する
 
 
 class TraceMemoryForDebug:
@@ -115,61 +315,266 @@ class TraceMemoryForDebug:
     for stat in self.top_stats[:10]:
         print(stat)
 
+##################################################
+#              性能計測用                 
+##################################################
+@contextlib.contextmanager
+def MeasureStage(stage_name: str):
+  global profile_state
+  
+  # プロファイルモード以外では何も計測しない
+  profile_stage_times = getattr(profile_state, "stage_times", None)
+  if profile_stage_times is None:
+    yield
+    return
+  stage_start_time = time.perf_counter()
+  try:
+    yield
+  finally:
+    profile_stage_times[stage_name] = profile_stage_times.get(stage_name, 0.0) + (time.perf_counter() - stage_start_time)
+    SampleImagePeakRss()
+
+def SampleImagePeakRss():
+  global profile_state
+  
+  # 画像ごとの最大RSSは、開始時・各段階の終了時・終了時に読んだ現在のRSSの最大値とする
+  # (ru_maxrssはプロセス開始からの最大値のため、大きな画像を一度処理すると以降の画像も同じ値になる)
+  current_rss_bytes = ReadCurrentRssBytes()
+  if current_rss_bytes is not None:
+    profile_state.peak_rss_bytes = max(getattr(profile_state, "peak_rss_bytes", None) or 0, current_rss_bytes)
+
+def BeginImageProfile():
+  global is_profile_mode
+  global is_allocation_trace_mode
+  global profile_state
+  
+  if is_profile_mode == False:
+    return
+  # tracemallocは全ての確保を記録するため処理が数倍遅くなる。段階別の時間が歪むので明示した時だけ使う
+  if is_allocation_trace_mode == True:
+    if tracemalloc.is_tracing() == False:
+      tracemalloc.start()
+    tracemalloc.reset_peak()
+  profile_state.stage_times = {}
+  profile_state.start_time = time.perf_counter()
+  profile_state.peak_rss_bytes = None
+  SampleImagePeakRss()
+
+def ReadCurrentRssBytes():
+  try:
+    with open("/proc/self/statm", "r") as statm_file:
+      return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return None
+
+def ReadMaxRssBytes():
+  if resource is None:
+    return None
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # macOSはバイト単位、Linuxはキロバイト単位
+  return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def EndImageProfile():
+  global profile_state
+  
+  if getattr(profile_state, "stage_times", None) is None:
+    return None
+  SampleImagePeakRss()
+  image_profile = {
+    "stages": profile_state.stage_times,
+    "total_seconds": time.perf_counter() - profile_state.start_time,
+    "rss_bytes": ReadCurrentRssBytes(),
+    "peak_rss_bytes": profile_state.peak_rss_bytes,
+    "process_max_rss_bytes": ReadMaxRssBytes(),
+    "pid": os.getpid(),
+  }
+  if tracemalloc.is_tracing() == True:
+    image_profile["tracemalloc_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+  profile_state.stage_times = None
+  return image_profile
+
+def AttachImageProfile(image_profile: dict):
+  global profile_state
+  
+  # 解析済みの画像の計測結果に、別スレッドで行う出力処理の時間を書き足す
+  if image_profile is None:
+    return
+  profile_state.stage_times = image_profile["stages"]
+  profile_state.start_time = time.perf_counter()
+  profile_state.peak_rss_bytes = image_profile["peak_rss_bytes"]
+
+def DetachImageProfile(image_profile: dict):
+  global profile_state
+  
+  if image_profile is None:
+    return
+  image_profile["total_seconds"] += time.perf_counter() - profile_state.start_time
+  image_profile["peak_rss_bytes"] = profile_state.peak_rss_bytes
+  profile_state.stage_times = None
+
+class ProfileReport:
+  # 画像ごとの計測結果をJSON Linesに書き出し、終了時にステージ別のパーセンタイルを集計する
+  def __init__(self, profile_file_name: str, summary_file_name: str):
+    self.profile_file = open(profile_file_name, mode='w', encoding='utf-8')
+    self.summary_file_name = summary_file_name
+    self.stage_samples = {stage_name: [] for stage_name in PROFILE_STAGE_NAMES}
+    self.total_samples = []
+    # process_max_rss_bytesはプロセス開始からの最大値(画像ごとの値ではない)
+    self.memory_samples = {"rss_bytes": [], "peak_rss_bytes": [], "process_max_rss_bytes": [], "tracemalloc_peak_bytes": []}
+    self.start_time = time.perf_counter()
+  
+  def Record(self, analysis_result: dict, result_write_seconds: float):
+    image_profile = dict(analysis_result["profile"])
+    image_profile["stages"] = dict(image_profile["stages"], result_write=result_write_seconds)
+    image_profile["file_name"] = analysis_result["file_name"]
+    json.dump(image_profile, self.profile_file, ensure_ascii=False)
+    self.profile_file.write('\n')
+    
+    for stage_name, stage_seconds in image_profile["stages"].items():
+      self.stage_samples.setdefault(stage_name, []).append(stage_seconds)
+    self.total_samples.append(image_profile["total_seconds"] + result_write_seconds)
+    for memory_key, memory_samples in self.memory_samples.items():
+      if image_profile.get(memory_key) is not None:
+        memory_samples.append(image_profile[memory_key])
+  
+  def Summarize(self, samples: list):
+    if len(samples) == 0:
+      return {"count": 0}
+    summary = {"count": len(samples), "total": float(np.sum(samples)), "mean": float(np.mean(samples)), "max": float(np.max(samples))}
+    for percentile, value in zip(PROFILE_PERCENTILES, np.percentile(samples, PROFILE_PERCENTILES)):
+      summary["p" + str(percentile)] = float(value)
+    return summary
+  
+  def Close(self):
+    self.profile_file.close()
+    summary = {
+      "images": len(self.total_samples),
+      "wall_seconds": time.perf_counter() - self.start_time,
+      "per_image_seconds": self.Summarize(self.total_samples),
+      "stages": {stage_name: self.Summarize(stage_samples) for stage_name, stage_samples in self.stage_samples.items()},
+      "memory_bytes": {memory_key: self.Summarize(memory_samples) for memory_key, memory_samples in self.memory_samples.items() if len(memory_samples) > 0},
+    }
+    with open(self.summary_file_name, mode='w', encoding='utf-8') as summary_file:
+      json.dump(summary, summary_file, ensure_ascii=False, indent=2)
+    return summary
+
+def PrintProfileSummary(summary: dict):
+  print("[ Profile summary ] images:", summary["images"], ", wall time: {:.2f} s".format(summary["wall_seconds"]))
+  print('{:<18}{:>10}{:>10}{:>10}{:>10}'.format("stage", "p50 ms", "p95 ms", "p99 ms", "total s"))
+  for stage_name, stage_summary in summary["stages"].items():
+    if stage_summary["count"] == 0:
+      continue
+    print('{:<18}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(stage_name, stage_summary["p50"] * 1000, stage_summary["p95"] * 1000,
+                                                            stage_summary["p99"] * 1000, stage_summary["total"]))
+
 ##################################################
 #              デバッグ情報表示用                 
 ##################################################
-def PrintDebugInfomation(input_image, hsv_image, hue_image, saturation_image, brightness_image):
+def PrintDebugInfomation(input_image, hsv_planes):
   print("\r", input_image.format, input_image.size, input_image.mode)
-  print(hsv_image.format, hsv_image.size, hsv_image.mode)
-  print("hue object: ", hue_image)
-  print("saturation object: ", saturation_image)
-  print("brightness object: ", brightness_image)
+  print("HSV planes: ", hsv_planes.shape, hsv_planes.dtype)
 
 ##################################################
-#         実行中のアニメーション表示用                 
+#             実行中の進捗表示用                 
 ##################################################
-def WaitingAnimate(sync_queue):
-  global NOMAL_MODE
-  global NOISY_MODE
-  global VERY_NOISY_MODE
+class ProgressReporter:
+  # 一括処理全体で1つだけ動かす進捗表示用のスレッド
+  # 解析側はカウンタを加算するだけで待ち合わせは発生しない。端末以外への出力時は何も表示しない
+  def __init__(self, total_count: int, output_stream = sys.stdout):
+    self.total_count = total_count
+    self.completed_count = 0
+    self.completed_bytes = 0
+    self.output_stream = output_stream
+    self.is_enabled = hasattr(output_stream, "isatty") and output_stream.isatty()
+    self.is_paused = False
+    self.lock = threading.Lock()
+    self.stop_event = threading.Event()
+    self.start_time = time.perf_counter()
+    self.animation_cycle = itertools.cycle(['|', '/', '-', '\\'])
+    self.reporter_thread = None
+  
+  def Start(self):
+    self.start_time = time.perf_counter()
+    if self.is_enabled == True:
+      self.reporter_thread = threading.Thread(target=self.Run, daemon=True)
+      self.reporter_thread.start()
+  
+  def Advance(self, processed_bytes: int):
+    with self.lock:
+      self.completed_count += 1
+      self.completed_bytes += processed_bytes
+  
+  def Run(self):
+    while self.stop_event.wait(PROGRESS_REFRESH_INTERVAL) == False:
+      self.Draw()
+  
+  def MakeStatusText(self):
+    elapsed_time = max(time.perf_counter() - self.start_time, 1e-9)
+    images_per_second = self.completed_count / elapsed_time
+    megabytes_per_second = self.completed_bytes / (1024 * 1024) / elapsed_time
+    remaining_count = max(self.total_count - self.completed_count, 0)
+    if images_per_second > 0:
+      eta_text = time.strftime('%H:%M:%S', time.gmtime(remaining_count / images_per_second))
+    else:
+      eta_text = "--:--:--"
+    return '{}/{} images, remaining {} ({:.1f} img/s, {:.1f} MB/s, ETA {})'.format(
+      self.completed_count, self.total_count, remaining_count, images_per_second, megabytes_per_second, eta_text)
+  
+  def Draw(self):
+    with self.lock:
+      if self.is_paused == True:
+        return
+      self.output_stream.write('\r[' + next(self.animation_cycle) + ']: ' + self.MakeStatusText() + '   ')
+      self.output_stream.flush()
+  
+  def ClearLine(self):
+    if self.is_enabled == True:
+      self.output_stream.write('\r' + WHITE_PADDING + WHITE_PADDING + WHITE_PADDING + '\r')
+  
+  def Print(self, *messages):
+    # 進捗の行を消してからメッセージを出力する(次の更新で進捗の行は描き直される)
+    with self.lock:
+      self.ClearLine()
+      print(*messages, file=self.output_stream)
+  
+  def Suspend(self):
+    with self.lock:
+      self.is_paused = True
+      self.ClearLine()
+  
+  def Resume(self):
+    with self.lock:
+      self.is_paused = False
+  
+  def Stop(self):
+    self.stop_event.set()
+    if self.reporter_thread is not None:
+      self.reporter_thread.join()
+      self.reporter_thread = None
+      with self.lock:
+        self.ClearLine()
+        self.output_stream.write('[+]: Done🎉 ' + self.MakeStatusText() + '\n')
+        self.output_stream.flush()
 
-  global MAIN_PROCESS_IS_IN_PROGRESS
-  global MAIN_PROCESS_WAS_FINISHED
-  global MAIN_PROCESS_REQUESTS_SLEEP_CALL
+def PrintProgressMessage(*messages):
+  global progress_reporter
   
-  animation_dot = ['       ', '.      ', '..     ', '...    ', '....   ', '...... ']
-  dot_idx = 0
-  dot_len = len(animation_dot) - 1
-  main_process_state = MAIN_PROCESS_IS_IN_PROGRESS
-  queue_value = ""
+  if progress_reporter is None:
+    print(*messages)
+  else:
+    progress_reporter.Print(*messages)
+
+def SuspendWaitingAnimation():
+  global progress_reporter
   
-  try:
-    for animation_cycle in itertools.cycle(['|', '/', '-', '\\']):
-      if sync_queue.empty() == False:
-        queue_value = sync_queue.get() 
-        if queue_value == MAIN_PROCESS_WAS_FINISHED:
-          break
-        elif queue_value == MAIN_PROCESS_REQUESTS_SLEEP_CALL:
-          main_process_state = MAIN_PROCESS_REQUESTS_SLEEP_CALL
-        elif queue_value == MAIN_PROCESS_IS_IN_PROGRESS:
-          main_process_state = MAIN_PROCESS_IS_IN_PROGRESS
-      if main_process_state == MAIN_PROCESS_REQUESTS_SLEEP_CALL:
-        pass
-      else:
-        sys.stdout.write('\r['+ animation_cycle + ']: Image analyzer is now in progress' + animation_dot[dot_idx])
-        if dot_idx == dot_len:
-          dot_idx = 0
-        else:
-          dot_idx += 1
-      time.sleep(0.1)
-    sys.stdout.write('\r[+]: Done🎉                                                 \n')
-  except Exception as e:
-    print("Unexpected error: " + str(e))
-    sys.exit(ERROR_EXIT)
-  except KeyboardInterrupt:
-    pass
+  if progress_reporter is not None:
+    progress_reporter.Suspend()
 
-  sys.exit(NORMAL_EXIT)
+def ResumeWaitingAnimation():
+  global progress_reporter
+  
+  if progress_reporter is not None:
+    progress_reporter.Resume()
 
 ##################################################
 #                  引数制御用                
@@ -183,6 +588,34 @@ def DefineSystemArgumentsProcess():
   global use_interactive_mode
   global is_memory_trace_mode
   global verbosity
+  global number_of_jobs
+  global is_incremental_mode
+  global sample_pixel_count
+  global use_histogram_store
+  global is_from_store_mode
+  global use_group_aggregate
+  global use_near_duplicate_index
+  global near_duplicate_distance
+  global use_result_database
+  global is_query_mode
+  global query_filters
+  global tile_budget_megabytes
+  global is_profile_mode
+  global is_allocation_trace_mode
+  global is_stats_only_mode
+  global figure_backend
+  global is_composite_figure
+  global pipeline_queue_depth
+  global dominant_color_count
+  global is_watch_mode
+  global watch_interval
+  global is_service_mode
+  global service_port
+  global service_socket_path
+  global service_max_pending
+  global service_max_batch
+  global memory_budget_bytes
+  global worker_rss_limit_bytes
   
   try:
     parser = argparse.ArgumentParser(description="Create a separated HSV parameter image and making these figures.")
@@ -192,10 +625,42 @@ def DefineSystemArgumentsProcess():
     optional.add_argument("-v", "--verbosity", default=0, action="count", help="Increase output verbosity. The value is up to 2.")
     optional.add_argument("-e", "--equal-width", type=int, default=DEFAULT_EQUAL_WIDTH_BINS, help="Set histogram figures's equal-width bins. The default value is 255.")
     optional.add_argument("-o", "--output-file", "--output-file-prefix", type=str, default="", help="The prefix result file name.If batch mode, this parameter will ignore.")
+    optional.add_argument("-n", "--stats-only", action='store_const', default=False, const=True, help="Write only the CSV/JSON statistics. No HSV images and figures are generated and matplotlib is never imported.")
+    optional.add_argument("-z", "--figure-backend", type=str, choices=FIGURE_BACKENDS, default="matplotlib", help="Figure renderer. 'raster' draws the histogram figures directly with NumPy/PIL (much faster for batch runs). Interactive mode always uses matplotlib. The default value is matplotlib.")
+    optional.add_argument("--composite-figure", action='store_const', default=False, const=True, help="With the raster backend, put the H/S/V histograms side by side in one Image_HSV.png per image instead of three files.")
     optional.add_argument("-d", "--is-dny-output", action='store_const', default=False, const=True, help="Deny output to the HSV files.")
     optional.add_argument("-i", "--use-interactive-mode", action='store_const', default=False, const=True, help="Use interactive mode.")
     optional.add_argument("-t", "--is_memory_trace_mode", action='store_const', default=False, const=True, help="Use memory trace mode for develop.")
     optional.add_argument("-f", "--file", type=str, default="", help="The analyzer target file name.")
+    optional.add_argument("-c", "--incremental", action='store_const', default=False, const=True, help="Batch mode only. Reuse cached results of unchanged images and rewrite the CSV/JSON without duplicated rows.")
+    optional.add_argument("-s", "--sample", type=int, default=0, help="Analyze about N pixels per image by draft decoding (JPEG) and subsampling. The estimated errors are written to the CSV/JSON. The default value is 0 (all pixels).")
+    optional.add_argument("-b", "--histogram-store", action='store_const', default=False, const=True, help="Append each image's H/S/V histograms to the binary store in output/store.")
+    optional.add_argument("-r", "--from-store", action='store_const', default=False, const=True, help="Rebuild the CSV/JSON and figures from the histogram store without decoding any image.")
+    optional.add_argument("-y", "--aggregate", action='store_const', default=False, const=True, help="Merge each image's H/S/V histograms into per-maker, per-release-year and per-sales-bucket group histograms in output/aggregate, and export the exact group statistics to group_statistics.csv/json.")
+    optional.add_argument("-x", "--near-duplicates", action='store_const', default=False, const=True, help="Keep a perceptual hash (dHash) index of analyzed images in output/dedup across runs. An image within --near-duplicate-distance of an indexed image reuses its statistics without being decoded in full, gets no HSV images or figures, and is flagged in the CSV/JSON. The original is the image indexed first (earlier runs first, then input path order), not chosen by content.")
+    optional.add_argument("--near-duplicate-distance", type=int, default=DEFAULT_NEAR_DUPLICATE_DISTANCE, help="Maximum Hamming distance between the 64-bit hashes of near-duplicate images. The default value is {}.".format(DEFAULT_NEAR_DUPLICATE_DISTANCE))
+    optional.add_argument("-l", "--sqlite", action='store_const', default=False, const=True, help="Also upsert each result into the SQLite database in output/db.")
+    optional.add_argument("-q", "--query", action='store_const', default=False, const=True, help="Export the rows matching --maker/--date-from/--date-to/--sales-min/--sales-max from the SQLite database to query_result.csv/json.")
+    optional.add_argument("--maker", type=str, default=None, help="Query filter: the maker name.")
+    optional.add_argument("--date-from", type=str, default=None, help="Query filter: the first release date (inclusive, e.g. 20200101).")
+    optional.add_argument("--date-to", type=str, default=None, help="Query filter: the last release date (inclusive).")
+    optional.add_argument("--sales-min", type=int, default=None, help="Query filter: the minimum sales count (inclusive).")
+    optional.add_argument("--sales-max", type=int, default=None, help="Query filter: the maximum sales count (inclusive).")
+    optional.add_argument("-m", "--tile-budget", type=int, default=0, help="Convert and analyze each image in horizontal strips using about N MB of working memory. The default value is 0 (whole image at once).")
+    optional.add_argument("-g", "--memory-budget", type=int, default=0, help="Batch mode only. Admit images (and parallel workers' images) only while their estimated working sets fit in N MB. Images larger than the budget are processed in strips. The default value is 0 (half of the available memory).")
+    optional.add_argument("--worker-rss-limit", type=int, default=0, help="Batch mode only. Release the conversion buffers, and recycle the worker processes if that is not enough, once a process grows past N MB of RSS. The default value is 0 (the budget divided by the jobs, at least 512 MB).")
+    optional.add_argument("-p", "--profile", action='store_const', default=False, const=True, help="Record per-stage timings and memory usage (RSS) of each image to output/profile.")
+    optional.add_argument("--trace-allocations", action='store_const', default=False, const=True, help="With --profile, also record the tracemalloc peak of each image. Tracing slows the whole pipeline down several times, so the stage timings of such a run are not comparable.")
+    optional.add_argument("-k", "--dominant-colors", type=int, default=0, help="Extract the K dominant colors and their coverage from a 16x16x16 joint HSV histogram and add them to the CSV/JSON. The default value is 0 (none).")
+    optional.add_argument("-w", "--watch", action='store_const', default=False, const=True, help="Keep running and analyze images as they are added to or modified in the input folder (inotify on Linux, polling elsewhere).")
+    optional.add_argument("--watch-interval", type=float, default=DEFAULT_WATCH_INTERVAL, help="Polling interval in seconds for watch mode. The default value is 1.0.")
+    optional.add_argument("-a", "--serve", action='store_const', default=False, const=True, help="Run a local analysis service. POST image bytes (?name=<file name>) or a JSON {\"path\": ...} to /analyze and get the statistics_report.json record. GET /stats reports latency and queue depth. Workers are set by -j.")
+    optional.add_argument("--port", type=int, default=DEFAULT_SERVICE_PORT, help="TCP port on 127.0.0.1 for the analysis service. The default value is 8765.")
+    optional.add_argument("--unix-socket", type=str, default="", help="Serve on this Unix domain socket path instead of TCP.")
+    optional.add_argument("--max-pending", type=int, default=DEFAULT_SERVICE_MAX_PENDING, help="Number of queued requests the analysis service accepts before answering 503. The default value is 64.")
+    optional.add_argument("--max-batch", type=int, default=DEFAULT_SERVICE_MAX_BATCH, help="Maximum number of queued requests handed to a worker at once. The default value is 8.")
+    optional.add_argument("-u", "--pipeline", type=int, default=0, help="Batch mode only. Overlap file reading, analysis and output writing in three stages connected by queues of N images. The default value is 0 (sequential).")
+    optional.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes for batch mode. 0 means the number of CPUs. The default value is 1.")
     args = parser.parse_args()
     
     input_file_name = args.file
@@ -207,6 +672,77 @@ def DefineSystemArgumentsProcess():
     use_interactive_mode = args.use_interactive_mode
     is_memory_trace_mode = args.is_memory_trace_mode
     verbosity = args.verbosity 
+    number_of_jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    is_incremental_mode = args.incremental
+    sample_pixel_count = max(args.sample, 0)
+    use_histogram_store = args.histogram_store
+    is_from_store_mode = args.from_store
+    use_group_aggregate = args.aggregate
+    use_near_duplicate_index = args.near_duplicates
+    near_duplicate_distance = min(max(args.near_duplicate_distance, 0), 64)
+    use_result_database = args.sqlite
+    tile_budget_megabytes = max(args.tile_budget, 0)
+    is_allocation_trace_mode = args.trace_allocations
+    is_profile_mode = args.profile or is_allocation_trace_mode
+    is_stats_only_mode = args.stats_only
+    figure_backend = args.figure_backend
+    is_composite_figure = args.composite_figure
+    if is_composite_figure == True:
+      figure_backend = "raster"
+    pipeline_queue_depth = max(args.pipeline, 0)
+    dominant_color_count = max(args.dominant_colors, 0)
+    if args.memory_budget > 0:
+      memory_budget_bytes = args.memory_budget * 1024 * 1024
+    else:
+      available_memory_bytes = ReadAvailableMemoryBytes()
+      memory_budget_bytes = int(available_memory_bytes * DEFAULT_MEMORY_BUDGET_RATIO) if available_memory_bytes is not None else 0
+    if args.worker_rss_limit > 0:
+      worker_rss_limit_bytes = args.worker_rss_limit * 1024 * 1024
+    elif memory_budget_bytes > 0:
+      worker_rss_limit_bytes = max(memory_budget_bytes // number_of_jobs, MIN_WORKER_RSS_LIMIT_MEGABYTES * 1024 * 1024)
+    is_watch_mode = args.watch
+    watch_interval = max(args.watch_interval, 0.01)
+    is_service_mode = args.serve
+    service_port = args.port
+    service_socket_path = args.unix_socket
+    service_max_pending = max(args.max_pending, 1)
+    service_max_batch = max(args.max_batch, 1)
+    if is_service_mode == True:
+      # 解析サービスは統計値だけを返し、画像・グラフ・CSV/JSONは書き出さない
+      is_stats_only_mode = True
+      is_profile_mode = False
+      is_allocation_trace_mode = False
+      use_interactive_mode = False
+      use_near_duplicate_index = False
+    if is_watch_mode == True:
+      # 監視モードは1ファイルずつ届いた順に処理し、結果は既存のCSV/JSONに追記する
+      is_incremental_mode = False
+      number_of_jobs = 1
+      pipeline_queue_depth = 0
+    if is_from_store_mode == True and dominant_color_count > 0:
+      # 保存済みのヒストグラムはチャンネル別のみで、主要色の算出に必要な同時ヒストグラムを持たない
+      print("[!]: --dominant-colors is ignored in rebuild from histogram store mode.")
+      dominant_color_count = 0
+    if is_from_store_mode == True:
+      # 画像を読まないため知覚ハッシュを求められない
+      use_near_duplicate_index = False
+    is_query_mode = args.query
+    query_filters = {
+      "maker_name": args.maker,
+      "date_from": args.date_from,
+      "date_to": args.date_to,
+      "sales_min": args.sales_min,
+      "sales_max": args.sales_max,
+    }
+    if use_interactive_mode == True:
+      # 対話モードのグラフ表示はメインプロセスのメインスレッドでしか行えない
+      number_of_jobs = 1
+      pipeline_queue_depth = 0
+      if figure_backend != "matplotlib":
+        # 直接描画した図表はウィンドウに表示できないため、対話モードではmatplotlibで描く
+        print("[!]: --figure-backend raster is ignored in interactive mode.")
+        figure_backend = "matplotlib"
+        is_composite_figure = False
     
     if verbosity == VERY_NOISY_MODE:
       print(args)
@@ -219,283 +755,2785 @@ def DefineSystemArgumentsProcess():
   
   return NORMAL_EXIT
 
+##################################################
+#                 色空間変換用                 
+##################################################
+class HsvConverter:
+  # PILのImage.convert("HSV")(Convert.cのrgb2hsv)と同じ演算順・精度でRGBからHSVへ変換する
+  # 結果はチャンネルごとに連続した(3, 高さ, 幅)の配列で返し、split()やチャンネルごとのコピーを不要にする
+  # 出力と作業用の配列は使い回すため、返した配列は次の変換で上書きされる
+  def __init__(self, chunk_pixel_count: int = HSV_KERNEL_CHUNK_PIXELS):
+    self.chunk_pixel_count = chunk_pixel_count
+    self.output_buffer = np.empty(0, dtype=np.uint8)
+    self.max_values = np.empty(chunk_pixel_count, dtype=np.uint8)
+    self.min_values = np.empty(chunk_pixel_count, dtype=np.uint8)
+    self.is_red_max = np.empty(chunk_pixel_count, dtype=bool)
+    self.is_green_max = np.empty(chunk_pixel_count, dtype=bool)
+    self.chroma = np.empty(chunk_pixel_count, dtype=np.float32)
+    self.saturation = np.empty(chunk_pixel_count, dtype=np.float32)
+    self.channel_distances = np.empty((3, chunk_pixel_count), dtype=np.float32)
+    self.hue = np.empty(chunk_pixel_count, dtype=np.float64)
+    self.hue_candidate = np.empty(chunk_pixel_count, dtype=np.float64)
+    self.rounded_hue = np.empty(chunk_pixel_count, dtype=np.float32)
+  
+  def NormalizeImage(self, input_image: Image):
+    # 画像モードの違いはここで一度だけ吸収し、変換カーネルには(画素数, チャンネル数)のuint8配列を渡す
+    # RGBA/RGBXの透明度はPILと同様に無視する。Lはそのまま明度になる(色相・彩度は0)
+    if input_image.mode in ("RGB", "RGBA", "RGBX"):
+      return np.asarray(input_image, dtype=np.uint8)
+    if input_image.mode == "L":
+      return np.asarray(input_image, dtype=np.uint8)[:, :, np.newaxis]
+    return np.asarray(input_image.convert("RGB"), dtype=np.uint8)
+  
+  def Convert(self, input_image: Image):
+    return self.ConvertArray(self.NormalizeImage(input_image))
+  
+  def ConvertStack(self, input_images: list):
+    # 同じ大きさの画像をまとめて1回のカーネル呼び出しで変換し、(3, 枚数, 高さ, 幅)の配列を返す
+    return self.ConvertArray(np.stack([self.NormalizeImage(input_image) for input_image in input_images]))
+  
+  def ConvertArray(self, pixel_array: np.array):
+    pixel_shape = pixel_array.shape[:-1]
+    pixel_count = int(np.prod(pixel_shape))
+    if self.output_buffer.size < 3 * pixel_count:
+      self.output_buffer = np.empty(3 * pixel_count, dtype=np.uint8)
+    hsv_planes = self.output_buffer[:3 * pixel_count].reshape(3, pixel_count)
+    flat_pixels = pixel_array.reshape(pixel_count, pixel_array.shape[-1])
+    
+    if flat_pixels.shape[1] == 1:
+      hsv_planes[0:2] = 0
+      hsv_planes[2] = flat_pixels[:, 0]
+    else:
+      for chunk_start in range(0, pixel_count, self.chunk_pixel_count):
+        chunk_end = min(chunk_start + self.chunk_pixel_count, pixel_count)
+        self.ConvertChunk(flat_pixels[chunk_start:chunk_end], hsv_planes[:, chunk_start:chunk_end])
+    return hsv_planes.reshape((3,) + pixel_shape)
+  
+  def ConvertChunk(self, rgb_pixels: np.array, hsv_planes: np.array):
+    chunk_size = rgb_pixels.shape[0]
+    red, green, blue = rgb_pixels[:, 0], rgb_pixels[:, 1], rgb_pixels[:, 2]
+    max_values, min_values = self.max_values[:chunk_size], self.min_values[:chunk_size]
+    is_red_max, is_green_max = self.is_red_max[:chunk_size], self.is_green_max[:chunk_size]
+    chroma, saturation = self.chroma[:chunk_size], self.saturation[:chunk_size]
+    channel_distances = self.channel_distances[:, :chunk_size]
+    hue, hue_candidate, rounded_hue = self.hue[:chunk_size], self.hue_candidate[:chunk_size], self.rounded_hue[:chunk_size]
+    
+    np.maximum(np.maximum(red, green, out=max_values), blue, out=max_values)
+    np.minimum(np.minimum(red, green, out=min_values), blue, out=min_values)
+    np.equal(red, max_values, out=is_red_max)
+    np.equal(green, max_values, out=is_green_max)
+    hsv_planes[2] = max_values
+    
+    # s = cr / maxc (float)
+    # 無彩色(max == min)の画素は cr = 0 のため分母を1以上にしておけば s = 0 になる
+    np.subtract(max_values, min_values, out=chroma, dtype=np.float32)
+    np.maximum(max_values, 1, out=min_values)
+    np.divide(chroma, min_values, out=saturation, dtype=np.float32)
+    # rc, gc, bc = (maxc - 各チャンネル) / cr (float)
+    # 無彩色の画素は cr を1にしておけば rc = gc = bc = 0 となり、r == maxc の分岐で h = 0 になる
+    np.maximum(chroma, 1.0, out=chroma)
+    for channel_index, channel_values in enumerate((red, green, blue)):
+      np.subtract(max_values, channel_values, out=channel_distances[channel_index], dtype=np.float32)
+      channel_distances[channel_index] /= chroma
+    red_distance, green_distance, blue_distance = channel_distances
+    
+    # 色相の分岐ごとの式はCと同じくdoubleで計算し、floatの変数に代入される時点で丸める
+    # r == maxc: h = bc - gc / g == maxc: h = 2.0 + rc - bc / それ以外: h = 4.0 + gc - rc
+    np.add(green_distance, 4.0, out=hue, dtype=np.float64)
+    np.subtract(hue, red_distance, out=hue)
+    np.add(red_distance, 2.0, out=hue_candidate, dtype=np.float64)
+    np.subtract(hue_candidate, blue_distance, out=hue_candidate)
+    np.copyto(hue, hue_candidate, where=is_green_max)
+    np.subtract(blue_distance, green_distance, out=hue_candidate, dtype=np.float64)
+    np.copyto(hue, hue_candidate, where=is_red_max)
+    np.copyto(rounded_hue, hue, casting='same_kind')
+    np.copyto(hue, rounded_hue)
+    # h = fmod(h / 6.0 + 1.0, 1.0) をfloatに丸めてから (int)(h * 255.0)
+    # h >= -1 より h / 6.0 + 1.0 は [5/6, 2) に収まるため、fmodは1以上の時に1を引くのと同じ(誤差なし)
+    hue /= 6.0
+    hue += 1.0
+    np.subtract(hue, 1.0, out=hue, where=(hue >= 1.0))
+    np.copyto(rounded_hue, hue, casting='same_kind')
+    np.copyto(hue, rounded_hue)
+    hue *= 255.0
+    hsv_planes[0] = hue
+    # (int)(s * 255.0)
+    np.multiply(saturation, 255.0, out=hue, dtype=np.float64)
+    hsv_planes[1] = hue
+
+def GetHsvConverter():
+  global hsv_converter
+  
+  # 作業用配列を画像をまたいで使い回すため1つだけ作る(解析を行うスレッドからのみ呼ぶ)
+  if hsv_converter is None:
+    hsv_converter = HsvConverter()
+  return hsv_converter
+
 ##################################################
 #                  算術換算用                 
 ##################################################
-def CalcMeanValues(hue_data: np.array, saturation_data: np.array, brightness_data: np.array):
+def CalcChannelHistogram(channel_data: np.array):
+  global HISTOGRAM_BIN_SIZE
+  
+  return np.bincount(channel_data, minlength=HISTOGRAM_BIN_SIZE).astype(np.int64)
+
+def CalcHistogramMean(histogram: np.array):
+  total_count = int(histogram.sum())
+  if total_count == 0:
+    return np.float64(np.nan)
+  
+  # 整数の総和で計算するため丸め誤差が生じない
+  weighted_sum = int(np.dot(histogram, np.arange(histogram.size, dtype=np.int64)))
+  return np.float64(weighted_sum / total_count)
+
+def CalcHistogramPercentile(histogram: np.array, percentile: float):
+  # np.percentile(method='linear')と同じ補間をヒストグラムから O(256) で求める
+  total_count = int(histogram.sum())
+  if total_count == 0:
+    return np.float64(np.nan)
+  
+  cumulative_count = np.cumsum(histogram)
+  position = (total_count - 1) * (percentile / 100.0)
+  lower_rank = int(np.floor(position))
+  upper_rank = min(lower_rank + 1, total_count - 1)
+  fraction = position - lower_rank
+  
+  # 昇順に並べた時の k 番目(0始まり)の値 = 累積度数が k を超える最初のビン
+  lower_value, upper_value = np.searchsorted(cumulative_count, [lower_rank, upper_rank], side='right')
+  if lower_value == upper_value:
+    return np.float64(lower_value)
+  return np.float64(lower_value + (upper_value - lower_value) * fraction)
+
+def CalcHistogramMedian(histogram: np.array):
+  return CalcHistogramPercentile(histogram, 50.0)
+
+def RebinHistogram(histogram: np.array, equal_width_bins: int):
+  # figure.hist(画素値, bins=equal_width_bins, density=True) と同じ区間分け(画素値の最小～最大)を256ビンの度数から求める
+  occupied_values = np.flatnonzero(histogram)
+  if occupied_values.size == 0:
+    # 画素のない画像や標本が空のチャンネルでは区間を決められないため、空の度数を返す(図表には棒を描かない)
+    return np.zeros(0), np.zeros(1)
+  return np.histogram(np.arange(histogram.size), bins=equal_width_bins,
+                      range=(occupied_values[0], occupied_values[-1]), weights=histogram, density=True)
+
+def CalcHistogramStandardErrors(histogram: np.array, population_count: int):
+  # 標本の平均値・中央値の標準誤差(有限母集団修正あり)
+  # 中央値はヒストグラムから求めた中央値付近の密度 f(m) を用いて 1 / (2 f(m) √n) で近似する
+  sample_count = int(histogram.sum())
+  if sample_count == 0:
+    return np.float64(np.nan), np.float64(np.nan)
+  if population_count <= 1 or sample_count >= population_count:
+    return np.float64(0.0), np.float64(0.0)
+  
+  bin_values = np.arange(histogram.size, dtype=np.float64)
+  mean_value = float(np.dot(histogram, bin_values)) / sample_count
+  variance = float(np.dot(histogram, (bin_values - mean_value) ** 2)) / max(sample_count - 1, 1)
+  finite_population_correction = math.sqrt((population_count - sample_count) / (population_count - 1))
+  
+  mean_error = math.sqrt(variance / sample_count) * finite_population_correction
+  median_density = histogram[int(CalcHistogramMedian(histogram))] / sample_count
+  if median_density > 0:
+    median_error = finite_population_correction / (2.0 * median_density * math.sqrt(sample_count))
+  else:
+    median_error = math.sqrt(math.pi / 2.0) * mean_error
+  return np.float64(mean_error), np.float64(median_error)
+
+def CalcStandardErrorValues(hue_histogram: np.array, saturation_histogram: np.array, brightness_histogram: np.array, population_count: int):
+  global DEFAULT_ERROR_OUTPUT_FORMAT
+  
+  standard_errors = []
+  for histogram in (hue_histogram, saturation_histogram, brightness_histogram):
+    mean_error, median_error = CalcHistogramStandardErrors(histogram, population_count)
+    standard_errors += [np.float64(DEFAULT_ERROR_OUTPUT_FORMAT.format(mean_error)), np.float64(DEFAULT_ERROR_OUTPUT_FORMAT.format(median_error))]
+  return standard_errors
+
+def CalcMeanValues(hue_histogram: np.array, saturation_histogram: np.array, brightness_histogram: np.array):
   global DEFAULT_NUMBER_OUTPUT_FORMAT
   
-  return np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(np.mean(hue_data, dtype=np.float64))), \
-            np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(np.mean(saturation_data, dtype=np.float64))), \
-              np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(np.mean(brightness_data, dtype=np.float64)))
+  return np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(CalcHistogramMean(hue_histogram))), \
+            np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(CalcHistogramMean(saturation_histogram))), \
+              np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(CalcHistogramMean(brightness_histogram)))
               
-def CalcMedianValues(hue_data: np.array, saturation_data: np.array, brightness_data: np.array):
+def CalcMedianValues(hue_histogram: np.array, saturation_histogram: np.array, brightness_histogram: np.array):
+  global DEFAULT_NUMBER_OUTPUT_FORMAT
+  
+  return np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(CalcHistogramMedian(hue_histogram))), \
+            np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(CalcHistogramMedian(saturation_histogram))), \
+              np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(CalcHistogramMedian(brightness_histogram)))
+
+def CalcPercentileValues(hue_histogram: np.array, saturation_histogram: np.array, brightness_histogram: np.array, percentile: float):
+  global DEFAULT_NUMBER_OUTPUT_FORMAT
+  
+  return np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(CalcHistogramPercentile(hue_histogram, percentile))), \
+            np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(CalcHistogramPercentile(saturation_histogram, percentile))), \
+              np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(CalcHistogramPercentile(brightness_histogram, percentile)))
+
+def CalcJointHistogram(hue_data: np.array, saturation_data: np.array, brightness_data: np.array):
+  # 3チャンネルの上位4bitを12bitの番号に詰め、1回のbincountで16×16×16の同時ヒストグラムを作る
+  joint_index = (hue_data >> JOINT_HISTOGRAM_SHIFT).astype(np.uint16) << (2 * (8 - JOINT_HISTOGRAM_SHIFT))
+  joint_index |= (saturation_data >> JOINT_HISTOGRAM_SHIFT).astype(np.uint16) << (8 - JOINT_HISTOGRAM_SHIFT)
+  joint_index |= brightness_data >> JOINT_HISTOGRAM_SHIFT
+  return np.bincount(joint_index.reshape(-1), minlength=JOINT_HISTOGRAM_LEVELS ** 3)
+
+def ExtractDominantColors(joint_histogram: np.array, color_count: int):
   global DEFAULT_NUMBER_OUTPUT_FORMAT
+  global DEFAULT_ERROR_OUTPUT_FORMAT
+  
+  # 度数の多いビンから順に選び、選んだビンと隣接するビン(色相は循環)をその色の領域として以降の候補から外す
+  # (隣り合うビンに分かれた同じ色が上位を占めないようにする)
+  histogram_cube = joint_histogram.reshape(JOINT_HISTOGRAM_LEVELS, JOINT_HISTOGRAM_LEVELS, JOINT_HISTOGRAM_LEVELS)
+  total_count = int(joint_histogram.sum())
+  is_claimed = np.zeros(histogram_cube.shape, dtype=bool)
+  bin_width = 1 << JOINT_HISTOGRAM_SHIFT
+  dominant_colors = []
+  if total_count == 0:
+    return dominant_colors
   
-  return np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(np.median(hue_data))), \
-            np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(np.median(saturation_data))), \
-              np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(np.median(brightness_data)))
+  for flat_index in np.argsort(joint_histogram, kind='stable')[::-1]:
+    if len(dominant_colors) >= color_count or joint_histogram[flat_index] == 0:
+      break
+    hue_bin, saturation_bin, brightness_bin = np.unravel_index(flat_index, histogram_cube.shape)
+    if is_claimed[hue_bin, saturation_bin, brightness_bin]:
+      continue
+    
+    hue_offsets = np.array([-1, 0, 1])
+    saturation_bins = np.arange(max(saturation_bin - 1, 0), min(saturation_bin + 2, JOINT_HISTOGRAM_LEVELS))
+    brightness_bins = np.arange(max(brightness_bin - 1, 0), min(brightness_bin + 2, JOINT_HISTOGRAM_LEVELS))
+    region = np.ix_((hue_bin + hue_offsets) % JOINT_HISTOGRAM_LEVELS, saturation_bins, brightness_bins)
+    region_counts = np.where(is_claimed[region], 0, histogram_cube[region])
+    is_claimed[region] = True
+    region_total = int(region_counts.sum())
+    
+    # 代表色は領域内の度数で重み付けしたビン中心(色相は選んだビンからのずれで平均して循環させる)
+    hue_value = ((hue_bin + np.dot(region_counts.sum(axis=(1, 2)), hue_offsets) / region_total) * bin_width + bin_width / 2) % HISTOGRAM_BIN_SIZE
+    saturation_value = np.dot(region_counts.sum(axis=(0, 2)), saturation_bins) / region_total * bin_width + bin_width / 2
+    brightness_value = np.dot(region_counts.sum(axis=(0, 1)), brightness_bins) / region_total * bin_width + bin_width / 2
+    dominant_colors.append([np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(hue_value)),
+                            np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(saturation_value)),
+                            np.float64(DEFAULT_NUMBER_OUTPUT_FORMAT.format(brightness_value)),
+                            np.float64(DEFAULT_ERROR_OUTPUT_FORMAT.format(region_total / total_count))])
+  # 領域をまとめた後の占有率の高い順に並べ直す
+  dominant_colors.sort(key=lambda dominant_color: dominant_color[3], reverse=True)
+  return dominant_colors
 
 ##################################################
 #                  グラフ制御用                 
 ##################################################
-def MakePlotFigure(hsv_base_image: Image, figure, plot_color: str, 
-                   figure_title: str, xlabel: str, ylabel: str, equal_width_bins: int,
-                   output_prefix_name: str, output_suffix_name: str):
-  global sync_queue
+class HistogramFigureTemplate:
+  # タイトル・軸ラベル・フォント設定済みの図表を使い回し、画像ごとにはデータと文字列だけを差し替える
+  def __init__(self, window_title: str, plot_color: str, xlabel: str, ylabel: str, use_pyplot: bool):
+    global default_xlim_max
+    global default_xlim_min
+    
+    if use_pyplot == True:
+      self.figure = plt.figure(window_title)
+    else:
+      # pyplotの管理外で作成するため閉じ忘れによるメモリ・リークが起きない
+      self.figure = matplotlib.figure.Figure()
+    self.plot = self.figure.add_subplot(1,1,1)
+    self.plot.set_xlabel(xlabel)
+    self.plot.set_ylabel(ylabel)
+    self.plot.set_xlim(left=default_xlim_min, right=default_xlim_max)
+    self.histogram_patch = self.plot.stairs([0.0], [0.0, 1.0], fill=True, color=plot_color)
+    self.analytics_text = self.plot.text(DEFAULT_X_TEXT_POSITON, DEFAULT_Y_TEXT_POSITON, "", \
+                                         fontsize=8,verticalalignment="top", backgroundcolor=DEFAULT_BACKGROUND_COLOR)
+  
+  def UpdateHistogram(self, histogram: np.array, equal_width_bins: int, figure_title: str):
+    bin_density, bin_edges = RebinHistogram(histogram, equal_width_bins)
+    self.histogram_patch.set_visible(bin_density.size > 0)
+    if bin_density.size > 0:
+      self.histogram_patch.set_data(bin_density, bin_edges)
+    self.plot.set_ylim(bottom=0.0, top=bin_density.max() * 1.05 if bin_density.size > 0 else EMPTY_HISTOGRAM_Y_TOP)    # figure.histの自動調整と同じ余白
+    self.plot.set_title(figure_title)
+  
+  def UpdateAnalyticsText(self, analytics_text: str):
+    y_bottom, y_top = self.plot.get_ylim()
+    self.analytics_text.set_position((DEFAULT_X_TEXT_POSITON, y_top * 0.98))      # 係数は暫定
+    self.analytics_text.set_text(analytics_text)
+  
+  def Save(self, output_figure_file_name: str):
+    self.figure.savefig(output_figure_file_name)
+  
+  def Close(self):
+    plt.close(self.figure)
+
+class RasterHistogramFigure:
+  # matplotlibを使わずにHistogramFigureTemplateと同じ配置の図表をNumPyの配列とPILの文字描画で直接描く(一括処理向け)
+  # 軸ラベルやx軸の目盛りなど画像によらない部分は最初に1度だけ描いておき、画像ごとには棒・y軸の目盛り・タイトル・統計値だけを描く
+  def __init__(self, plot_color: str, xlabel: str, ylabel: str):
+    global default_xlim_max
+    global default_xlim_min
+    
+    self.palette = list(RASTER_COLORS[plot_color]) + [level for gray_level in range(1, 256) for level in (gray_level,) * 3]
+    self.axes_left, self.axes_top, self.axes_right, self.axes_bottom = RASTER_AXES_BOX
+    self.axes_height = self.axes_bottom - self.axes_top
+    # 各列の中心が表すx軸の値(棒の高さを列ごとに求めるために使う)
+    self.column_values = default_xlim_min + (np.arange(self.axes_left, self.axes_right) + 0.5 - self.axes_left) \
+                         * (default_xlim_max - default_xlim_min) / (self.axes_right - self.axes_left)
+    self.row_positions = np.arange(self.axes_top, self.axes_bottom)[:, np.newaxis]
+    self.base_canvas = self.RenderBaseCanvas(xlabel, ylabel)
+    self.image = None
+    self.y_top = 1.0
+  
+  def RenderBaseCanvas(self, xlabel: str, ylabel: str):
+    global default_xlim_max
+    global default_xlim_min
+    
+    base_image = Image.new("L", RASTER_FIGURE_SIZE, RASTER_BACKGROUND_LEVEL)
+    base_draw = ImageDraw.Draw(base_image)
+    tick_font = GetRasterFont(RASTER_TICK_FONT_SIZE)
+    label_font = GetRasterFont(RASTER_LABEL_FONT_SIZE)
+    for tick_value in range(0, default_xlim_max + 1, RASTER_X_TICK_STEP):
+      tick_x = self.MapX(tick_value)
+      base_draw.line([(tick_x, self.axes_bottom), (tick_x, self.axes_bottom + RASTER_TICK_LENGTH)], fill=RASTER_TEXT_LEVEL)
+      base_draw.text((tick_x, self.axes_bottom + RASTER_TICK_LENGTH + 2), str(tick_value), fill=RASTER_TEXT_LEVEL, font=tick_font, anchor="ma")
+    base_draw.text(((self.axes_left + self.axes_right) // 2, RASTER_FIGURE_SIZE[1] - 6), xlabel, fill=RASTER_TEXT_LEVEL, font=label_font, anchor="md")
+    # 縦書きのy軸ラベルは横向きに描いてから回転して貼り付ける
+    ylabel_size = base_draw.textbbox((0, 0), ylabel, font=label_font)[2:]
+    ylabel_image = Image.new("L", ylabel_size, 0)
+    ImageDraw.Draw(ylabel_image).text((0, 0), ylabel, fill=255, font=label_font)
+    ylabel_image = ylabel_image.rotate(90, expand=True)
+    base_image.paste(RASTER_TEXT_LEVEL, (6, (self.axes_top + self.axes_bottom - ylabel_image.height) // 2), ylabel_image)
+    return np.asarray(base_image)
+  
+  def MapX(self, x_value: float):
+    return self.axes_left + int(round((x_value - default_xlim_min) * (self.axes_right - self.axes_left) / (default_xlim_max - default_xlim_min)))
+  
+  def MapY(self, y_value: float):
+    return self.axes_bottom - int(round(y_value / self.y_top * self.axes_height))
+  
+  def UpdateHistogram(self, histogram: np.array, equal_width_bins: int, figure_title: str):
+    bin_density, bin_edges = RebinHistogram(histogram, equal_width_bins)
+    self.y_top = bin_density.max() * 1.05 if bin_density.size > 0 else EMPTY_HISTOGRAM_Y_TOP    # HistogramFigureTemplateと同じ余白
+    
+    # 列ごとにその位置の区間の密度を棒の高さに変換し、高さより下の画素を塗る
+    bar_heights = np.zeros(self.column_values.shape)
+    if bin_density.size > 0:
+      bin_indexes = np.clip(np.searchsorted(bin_edges, self.column_values, side='right') - 1, 0, bin_density.size - 1)
+      is_inside_bins = (self.column_values >= bin_edges[0]) & (self.column_values <= bin_edges[-1])
+      bar_heights = np.where(is_inside_bins, np.rint(bin_density[bin_indexes] / self.y_top * self.axes_height), 0)
+    canvas = self.base_canvas.copy()
+    plot_area = canvas[self.axes_top:self.axes_bottom, self.axes_left:self.axes_right]
+    plot_area[self.row_positions >= (self.axes_bottom - bar_heights)[np.newaxis, :]] = RASTER_BAR_LEVEL
+    # 軸の枠は棒の上から描く
+    canvas[self.axes_top, self.axes_left:self.axes_right + 1] = RASTER_TEXT_LEVEL
+    canvas[self.axes_bottom, self.axes_left:self.axes_right + 1] = RASTER_TEXT_LEVEL
+    canvas[self.axes_top:self.axes_bottom + 1, self.axes_left] = RASTER_TEXT_LEVEL
+    canvas[self.axes_top:self.axes_bottom + 1, self.axes_right] = RASTER_TEXT_LEVEL
+    
+    self.image = Image.fromarray(canvas)
+    figure_draw = ImageDraw.Draw(self.image)
+    tick_font = GetRasterFont(RASTER_TICK_FONT_SIZE)
+    tick_step, tick_decimals = CalcRasterTickStep(self.y_top)
+    for tick_index in range(int(self.y_top / tick_step) + 1):
+      tick_y = self.MapY(tick_index * tick_step)
+      figure_draw.line([(self.axes_left - RASTER_TICK_LENGTH, tick_y), (self.axes_left, tick_y)], fill=RASTER_TEXT_LEVEL)
+      figure_draw.text((self.axes_left - RASTER_TICK_LENGTH - 3, tick_y), "{:.{}f}".format(tick_index * tick_step, tick_decimals),
+                       fill=RASTER_TEXT_LEVEL, font=tick_font, anchor="rm")
+    figure_draw.text(((self.axes_left + self.axes_right) // 2, self.axes_top - 8), figure_title,
+                     fill=RASTER_TEXT_LEVEL, font=GetRasterFont(RASTER_TITLE_FONT_SIZE), anchor="md")
+  
+  def UpdateAnalyticsText(self, analytics_text: str):
+    figure_draw = ImageDraw.Draw(self.image)
+    text_font = GetRasterFont(RASTER_ANALYTICS_FONT_SIZE)
+    text_position = (self.MapX(DEFAULT_X_TEXT_POSITON), self.MapY(self.y_top * 0.98))      # HistogramFigureTemplateと同じ位置
+    text_box = figure_draw.multiline_textbbox(text_position, analytics_text, font=text_font, spacing=1)
+    figure_draw.rectangle(text_box, fill=RASTER_BACKGROUND_LEVEL)
+    figure_draw.multiline_text(text_position, analytics_text, fill=RASTER_TEXT_LEVEL, font=text_font, spacing=1)
+  
+  def Save(self, output_figure_file_name: str):
+    SaveRasterFigureImage(self.image, self.palette, output_figure_file_name)
+  
+  def Close(self):
+    self.image = None
+
+def SaveRasterFigureImage(figure_image, palette: list, output_figure_file_name: str):
+  # 濃淡の値をそのままパレットの番号として書き出す(RGBの3分の1の大きさになり、PNGの圧縮も速い)
+  palette_image = Image.frombytes("P", figure_image.size, figure_image.tobytes())
+  palette_image.putpalette(palette)
+  palette_image.save(output_figure_file_name, compress_level=RASTER_PNG_COMPRESS_LEVEL)
+
+def CalcRasterTickStep(y_top: float):
+  # matplotlibの目盛りと同様に 1, 2, 2.5, 5 x 10^n のうち目盛りの数が上限に収まる最小の間隔を選ぶ
+  magnitude = 10.0 ** math.floor(math.log10(y_top / RASTER_MAX_Y_TICKS))
+  for step_factor in (1.0, 2.0, 2.5, 5.0, 10.0):
+    tick_step = step_factor * magnitude
+    if y_top / tick_step <= RASTER_MAX_Y_TICKS:
+      break
+  tick_decimals = max(0, -int(math.floor(math.log10(tick_step))) + (1 if step_factor == 2.5 else 0))
+  return tick_step, tick_decimals
+
+def GetRasterFont(font_size: int):
+  global raster_fonts
+  
+  # japanize-matplotlibに同梱のIPAexゴシックを、matplotlibを読み込まずにファイルの場所だけ調べて使う
+  if font_size not in raster_fonts:
+    try:
+      font_module_spec = importlib.util.find_spec("japanize_matplotlib")
+      raster_fonts[font_size] = ImageFont.truetype(os.path.join(os.path.dirname(font_module_spec.origin), RASTER_FONT_FILE_NAME), font_size)
+    except (AttributeError, TypeError, OSError):
+      # フォントが見つからない場合はPIL内蔵のフォントで描く(日本語は表示できない)
+      raster_fonts[font_size] = ImageFont.load_default()
+  return raster_fonts[font_size]
+
+def ImportPlottingModules():
+  global matplotlib
+  global plt
+  
+  if plt is not None:
+    return
+  import matplotlib
+  matplotlib.use('Agg')                 # お試し
+  import matplotlib.pyplot as plt
+  import matplotlib.figure
+  import japanize_matplotlib
+
+def GetHistogramFigureTemplate(channel_name: str, window_title: str, plot_color: str, xlabel: str, ylabel: str):
+  global histogram_figure_templates
+  global use_interactive_mode
+  global figure_backend
   
+  if figure_backend == "raster":
+    if channel_name not in histogram_figure_templates:
+      histogram_figure_templates[channel_name] = RasterHistogramFigure(plot_color, xlabel, ylabel)
+    return histogram_figure_templates[channel_name]
+  ImportPlottingModules()
+  if channel_name not in histogram_figure_templates:
+    histogram_figure_templates[channel_name] = HistogramFigureTemplate(window_title, plot_color, xlabel, ylabel, use_interactive_mode)
+  return histogram_figure_templates[channel_name]
+
+def ReleaseHistogramFigureTemplates():
+  global histogram_figure_templates
+  
+  for figure_template in histogram_figure_templates.values():
+    figure_template.Close()
+  histogram_figure_templates = {}
+
+def MakePlotFigure(histogram: np.array, figure: HistogramFigureTemplate,
+                   figure_title: str, equal_width_bins: int, output_suffix_name: str):
   global NOMAL_MODE
   global NOISY_MODE
   global VERY_NOISY_MODE
-
-  global MAIN_PROCESS_IS_IN_PROGRESS
-  global MAIN_PROCESS_WAS_FINISHED
-  global MAIN_PROCESS_REQUESTS_SLEEP_CALL
-                   
-  global is_dny_output
   
-  figure_base_data=list(hsv_base_image.getdata())
   if verbosity == VERY_NOISY_MODE:
-    sync_queue.put_nowait(MAIN_PROCESS_REQUESTS_SLEEP_CALL)
-    time.sleep(0.5)
+    occupied_values = np.flatnonzero(histogram)
+    SuspendWaitingAnimation()
     print("\r>", output_suffix_name, WHITE_PADDING)
-    print("\r   MAX:", max(figure_base_data), " , min: ", min(figure_base_data), WHITE_PADDING)
-    sync_queue.put(MAIN_PROCESS_IS_IN_PROGRESS)
+    print("\r   MAX:", occupied_values[-1], " , min: ", occupied_values[0], WHITE_PADDING)
+    ResumeWaitingAnimation()
+  
+  figure.UpdateHistogram(histogram, equal_width_bins, figure_title)
+
+def RenderHistogramFigures(channel_histograms: np.array, analysis_result: dict, figure_titles: list, image_output_file_name: str):
+  global use_interactive_mode
+  global is_composite_figure
+  
+  hue_figure_title_name_with_prefix, saturation_figure_title_name_with_prefix, brightness_figure_title_name_with_prefix = figure_titles
+  
+  figure_hue = GetHistogramFigureTemplate('hue', hue_figure_title_name_with_prefix, COLORS["blue"],
+                                          XLABEL_LIST['hue_label']['japanese'], YLABEL_LIST['hue_label']['japanese'])
+  figure_saturation = GetHistogramFigureTemplate('saturation', saturation_figure_title_name_with_prefix, COLORS["blue"],
+                                                 XLABEL_LIST['saturation_label']['japanese'], YLABEL_LIST['saturation_label']['japanese'])
+  figure_brightness = GetHistogramFigureTemplate('brightness', brightness_figure_title_name_with_prefix, COLORS["blue"],
+                                                 XLABEL_LIST['brightness_label']['japanese'], YLABEL_LIST['brightness_label']['japanese'])
+  
+  with MeasureStage("histogram_render"):
+    RenderHistogramData(channel_histograms, analysis_result, figure_titles, figure_hue, figure_saturation, figure_brightness)
+  
+  with MeasureStage("figure_savefig"):
+    if is_composite_figure == True:
+      # 3つの図表を横に並べて1枚にまとめる(直接描画の場合のみ)
+      composite_image = Image.new("L", (RASTER_FIGURE_SIZE[0] * 3, RASTER_FIGURE_SIZE[1]))
+      for figure_index, figure in enumerate((figure_hue, figure_saturation, figure_brightness)):
+        composite_image.paste(figure.image, (RASTER_FIGURE_SIZE[0] * figure_index, 0))
+      SaveRasterFigureImage(composite_image, figure_hue.palette, OUTPUT_FIGURE_DIR + "/" + image_output_file_name + COMPOSITE_FIGURE_SUFFIX_NAME)
+    else:
+      figure_hue.Save(OUTPUT_FIGURE_DIR + "/" + image_output_file_name + 'Image_Hue.png')
+      figure_saturation.Save(OUTPUT_FIGURE_DIR + "/" + image_output_file_name + 'Image_Saturation.png')
+      figure_brightness.Save(OUTPUT_FIGURE_DIR + "/" + image_output_file_name + 'Image_Brightness.png')
+  
+  if use_interactive_mode == True:
+    plt.show()
+    # 後処理(表示済みのウィンドウは次の画像で使い回さない)
+    ReleaseHistogramFigureTemplates()
+
+def RenderHistogramData(channel_histograms: np.array, analysis_result: dict, figure_titles: list,
+                        figure_hue: HistogramFigureTemplate, figure_saturation: HistogramFigureTemplate, figure_brightness: HistogramFigureTemplate):
+  hue_histogram, saturation_histogram, brightness_histogram = channel_histograms
+  hue_figure_title_name_with_prefix, saturation_figure_title_name_with_prefix, brightness_figure_title_name_with_prefix = figure_titles
+  
+  MakePlotFigure(histogram = hue_histogram,
+                figure = figure_hue,
+                figure_title = hue_figure_title_name_with_prefix,
+                equal_width_bins = equal_width,
+                output_suffix_name = 'Image_Hue.png')
+  
+  MakePlotFigure(histogram = saturation_histogram,
+                figure = figure_saturation,
+                figure_title = saturation_figure_title_name_with_prefix,
+                equal_width_bins = equal_width,
+                output_suffix_name = 'Image_Saturation.png')
+                
+  MakePlotFigure(histogram = brightness_histogram,
+                figure = figure_brightness,
+                figure_title = brightness_figure_title_name_with_prefix,
+                equal_width_bins = equal_width,
+                output_suffix_name = 'Image_Brightness.png')
+  
+  template_phrase_show_analytics_values = '{:>7}: {:>4.1f}\n{:>7}: {:>4.1f}'
+  figure_hue.UpdateAnalyticsText(template_phrase_show_analytics_values.format(MEAN_LABEL['japanese'], analysis_result["hue_mean"], MEDIAN_LABEL['japanese'], analysis_result["hue_median"]))
+  figure_saturation.UpdateAnalyticsText(template_phrase_show_analytics_values.format(MEAN_LABEL['japanese'], analysis_result["saturation_mean"], MEDIAN_LABEL['japanese'], analysis_result["saturation_median"]))
+  figure_brightness.UpdateAnalyticsText(template_phrase_show_analytics_values.format(MEAN_LABEL['japanese'], analysis_result["brightness_mean"], MEDIAN_LABEL['japanese'], analysis_result["brightness_median"]))
+
+def SaveChannelImage(hsv_base_image: Image, output_prefix_name: str, output_suffix_name: str):
+  global NOISY_MODE
+  global VERY_NOISY_MODE
+  
+  global is_dny_output
   
-  figure.hist(figure_base_data, bins=equal_width_bins, density=True, color=plot_color)
-  figure.set_title(figure_title)
-  figure.set_xlabel(xlabel)
-  figure.set_ylabel(ylabel)
   if verbosity == NOISY_MODE or verbosity == VERY_NOISY_MODE:
     hsv_base_image.show()
   if is_dny_output == False:
     with open(OUTPUT_IMAGE_DIR  + "/" + output_prefix_name + output_suffix_name, "wb") as pointer_of_output_image_file:
       hsv_base_image.save(pointer_of_output_image_file, 'PNG')
 
+##################################################
+#                 分割処理用                 
+##################################################
+class StreamingPngWriter:
+  # 8bitグレースケールのPNGを帯状に受け取った行から順次書き出す(画像全体をメモリに載せない)
+  def __init__(self, output_image_file_name: str, width: int, height: int):
+    self.output_image_file = open(output_image_file_name, "wb")
+    self.compressor = zlib.compressobj(6)
+    self.output_image_file.write(PNG_SIGNATURE)
+    self.WriteChunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+  
+  def WriteChunk(self, chunk_type: bytes, chunk_data: bytes):
+    self.output_image_file.write(struct.pack('>I', len(chunk_data)))
+    self.output_image_file.write(chunk_type)
+    self.output_image_file.write(chunk_data)
+    self.output_image_file.write(struct.pack('>I', zlib.crc32(chunk_type + chunk_data) & 0xffffffff))
+  
+  def WriteRows(self, channel_rows: np.array):
+    # 各行にSubフィルタ(種別1: 左隣の画素との差分)を掛けて圧縮率を上げる
+    filtered_rows = np.empty((channel_rows.shape[0], channel_rows.shape[1] + 1), dtype=np.uint8)
+    filtered_rows[:, 0] = 1
+    filtered_rows[:, 1] = channel_rows[:, 0]
+    np.subtract(channel_rows[:, 1:], channel_rows[:, :-1], out=filtered_rows[:, 2:])
+    compressed_data = self.compressor.compress(filtered_rows.tobytes())
+    if len(compressed_data) > 0:
+      self.WriteChunk(b'IDAT', compressed_data)
+  
+  def Close(self):
+    self.WriteChunk(b'IDAT', self.compressor.flush())
+    self.WriteChunk(b'IEND', b'')
+    self.output_image_file.close()
+  
+  def Abort(self):
+    # 書きかけのファイルは壊れたPNGになるため残さない
+    self.output_image_file.close()
+    os.remove(self.output_image_file.name)
+
+def CalcStripHeight(image_width: int, tile_budget: int):
+  return max(1, (tile_budget * 1024 * 1024) // (max(image_width, 1) * STREAMING_BYTES_PER_PIXEL))
+
+def AnalyzeImageByStrips(input_image: Image, tile_budget: int, dominant_color_count: int, hsv_converter: HsvConverter, channel_writers: list):
+  # HSV変換・チャンネル分離・ヒストグラム集計を帯状に分けて行い、作業領域をタイル予算内に抑える
+  # (PILは圧縮画像を部分的にデコードできないため、デコード済みの元画像だけは全体を保持する)
+  # チャンネル画像はchannel_writersに帯ごとに書き出す(空のリストなら書き出さない)
+  image_width, image_height = input_image.size
+  strip_height = CalcStripHeight(image_width, tile_budget)
+  channel_histograms = np.zeros((3, HISTOGRAM_BIN_SIZE), dtype=np.int64)
+  joint_histogram = np.zeros(JOINT_HISTOGRAM_LEVELS ** 3, dtype=np.int64) if dominant_color_count > 0 else None
+  
+  try:
+    for strip_top in range(0, image_height, strip_height):
+      strip_bottom = min(strip_top + strip_height, image_height)
+      with MeasureStage("hsv_convert"):
+        hsv_strip = hsv_converter.Convert(input_image.crop((0, strip_top, image_width, strip_bottom)))
+      for channel_index in range(3):
+        channel_rows = hsv_strip[channel_index]
+        with MeasureStage("statistics"):
+          channel_histograms[channel_index] += np.bincount(channel_rows.reshape(-1), minlength=HISTOGRAM_BIN_SIZE)
+        if len(channel_writers) > 0:
+          with MeasureStage("channel_png_save"):
+            channel_writers[channel_index].WriteRows(channel_rows)
+      if joint_histogram is not None:
+        with MeasureStage("statistics"):
+          joint_histogram += CalcJointHistogram(hsv_strip[0], hsv_strip[1], hsv_strip[2])
+      del hsv_strip
+  except BaseException:
+    for channel_writer in channel_writers:
+      channel_writer.Abort()
+    raise
+  
+  with MeasureStage("channel_png_save"):
+    for channel_writer in channel_writers:
+      channel_writer.Close()
+  
+  return channel_histograms, joint_histogram
+
 ##################################################
 #                   主処理                 
 ##################################################
-def AnalyzeImage(process_file_name: str, batch_mode: bool, result_csv_writer, result_json_file):
-  global sync_queue
+def ParseFileNameInformation(base_file_name: str):
+  # ファイル名の規約: 売上_メーカー_発売日_タイトル(空白は'_'区切り)
+  base_file_name_with_split = base_file_name.split('_')
+  return {
+    "sales_count": int(base_file_name_with_split[0]),
+    "maker_name": base_file_name_with_split[1],
+    "seles_date": base_file_name_with_split[2],
+    "software_name": ' '.join(base_file_name_with_split[3:]),
+  }
+
+def TryParseFileNameInformation(base_file_name: str):
+  # 規約に従わないファイル名(ライブラリAPIに渡される任意の画像など)では売上・メーカーなどの項目をNoneにする
+  try:
+    return ParseFileNameInformation(base_file_name)
+  except (ValueError, IndexError):
+    return dict.fromkeys(FILE_NAME_INFORMATION_KEYS)
+
+def ReduceImageForSampling(input_image: Image, target_pixel_count: int):
+  if input_image.width * input_image.height <= target_pixel_count:
+    return input_image
+  
+  scale = math.sqrt(input_image.width * input_image.height / target_pixel_count)
+  target_size = (max(1, int(input_image.width / scale)), max(1, int(input_image.height / scale)))
+  if input_image.format == "JPEG":
+    # JPEGはDCTの段階で1/2, 1/4, 1/8に縮小してデコードできる(target_size以上の大きさになる)
+    input_image.draft(input_image.mode, target_size)
+  if input_image.width * input_image.height > target_pixel_count:
+    # 最近傍法で間引くことで画素値を混ぜずに標本を取り出す
+    input_image = input_image.resize(target_size, Image.NEAREST)
+  return input_image
+
+def ListBatchOutputFiles(process_file_name: str, analysis_result: dict = None):
+  global is_dny_output
+  global is_stats_only_mode
+  global is_composite_figure
+  
+  # 近似重複として統計値を引き継いだ画像はHSV画像・グラフを作らないため、出力ファイルはない
+  if is_stats_only_mode == True or (analysis_result is not None and analysis_result.get("image_outputs_skipped") == True):
+    return []
+  base_file_name = os.path.basename(process_file_name).split('.')[0]
+  figure_suffix_names = [COMPOSITE_FIGURE_SUFFIX_NAME] if is_composite_figure == True else OUTPUT_SUFFIX_NAMES
+  output_files = [OUTPUT_FIGURE_DIR + "/" + base_file_name + "_" + suffix_name for suffix_name in figure_suffix_names]
+  if is_dny_output == False:
+    output_files += [OUTPUT_IMAGE_DIR + "/" + base_file_name + "_" + suffix_name for suffix_name in OUTPUT_SUFFIX_NAMES]
+  return output_files
+
+def MakeFigureTitleNames(base_file_name: str, batch_mode: bool):
+  global output_file_name
+  global prefix_figure_title_name
+  
+  if batch_mode == True:
+    # グラフのタイトルをファイル名から動的に付与
+    suffix_figure_title_name = " - " + base_file_name
+    return [HUE_FIGURE_TITLE_NAME['japanese'] + suffix_figure_title_name,
+            SATURATION_FIGURE_TITLE_NAME['japanese'] + suffix_figure_title_name,
+            BRIGHTNESS_FIGURE_TITLE_NAME['japanese'] + suffix_figure_title_name], base_file_name + "_"
+  
+  return [prefix_figure_title_name + HUE_FIGURE_TITLE_NAME['japanese'],
+          prefix_figure_title_name + SATURATION_FIGURE_TITLE_NAME['japanese'],
+          prefix_figure_title_name + BRIGHTNESS_FIGURE_TITLE_NAME['japanese']], output_file_name
+
+def CalcAnalysisValues(analysis_result: dict, channel_histograms: np.array, total_pixel_count: int, is_sampled: bool):
+  hue_histogram, saturation_histogram, brightness_histogram = channel_histograms
+  
+  hue_mean, saturation_mean, brightness_mean = CalcMeanValues(hue_histogram, saturation_histogram, brightness_histogram)
+  hue_median, saturation_median, brightness_median = CalcMedianValues(hue_histogram, saturation_histogram, brightness_histogram)
+  analysis_result.update({
+    "hue_mean": hue_mean,
+    "hue_median": hue_median,
+    "saturation_mean": saturation_mean,
+    "saturation_median": saturation_median,
+    "brightness_mean": brightness_mean,
+    "brightness_median": brightness_median,
+  })
+  if is_sampled == True:
+    hue_mean_error, hue_median_error, saturation_mean_error, saturation_median_error, brightness_mean_error, brightness_median_error = \
+      CalcStandardErrorValues(hue_histogram, saturation_histogram, brightness_histogram, total_pixel_count)
+    analysis_result.update({
+      "sample_size": int(hue_histogram.sum()),
+      "total_pixel_count": total_pixel_count,
+      "hue_mean_error": hue_mean_error,
+      "hue_median_error": hue_median_error,
+      "saturation_mean_error": saturation_mean_error,
+      "saturation_median_error": saturation_median_error,
+      "brightness_mean_error": brightness_mean_error,
+      "brightness_median_error": brightness_median_error,
+    })
+  return analysis_result
+
+def AnalyzeImageProcess(process_file_name: str, batch_mode: bool, tile_budget: int = None):
+  analysis_result, image_outputs = AnalyzeImageData(process_file_name, batch_mode, tile_budget=tile_budget)
+  WriteImageOutputs(analysis_result, image_outputs)
+  analysis_result["profile"] = EndImageProfile()
+  return analysis_result
+
+def AnalyzeImageStream(pointer_of_input_image, analysis_options, hsv_converter: HsvConverter, channel_writer_factory = None, input_image: Image = None):
+  # 画像1枚分の解析の本体。グローバル変数を参照しないため、CLIとライブラリAPI(analyze)の両方から使う
+  # 帯状に処理する場合、チャンネル画像はchannel_writer_factory(幅, 高さ)が返す書き出し先へ順次書き出し、hsv_planesはNoneを返す
+  # (hsv_planesはhsv_converterの作業用配列のため、次の変換で上書きされる)
+  # input_imageにデコード済みの画像(縮小前)を渡すと、ファイルを読み直さずにそのまま使う
+  with MeasureStage("decode"):
+    if input_image is None:
+      input_image = Image.open(pointer_of_input_image)
+    total_pixel_count = input_image.width * input_image.height
+    if analysis_options.sample_pixel_count > 0:
+      input_image = ReduceImageForSampling(input_image, analysis_options.sample_pixel_count)
+    input_image.load()
+  
+  hsv_planes = None
+  if analysis_options.tile_budget_megabytes > 0:
+    channel_writers = channel_writer_factory(input_image.width, input_image.height) if channel_writer_factory is not None else []
+    channel_histograms, joint_histogram = AnalyzeImageByStrips(input_image, analysis_options.tile_budget_megabytes,
+                                                               analysis_options.dominant_color_count, hsv_converter, channel_writers)
+  else:
+    with MeasureStage("hsv_convert"):
+      hsv_planes = hsv_converter.Convert(input_image)
+    with MeasureStage("statistics"):
+      # チャンネルごとに連続した配列のため、コピーせずに1次元で参照できる
+      hue_data, saturation_data, brightness_data = (hsv_plane.reshape(-1) for hsv_plane in hsv_planes)
+      channel_histograms = np.stack([CalcChannelHistogram(hue_data),
+                                     CalcChannelHistogram(saturation_data),
+                                     CalcChannelHistogram(brightness_data)])
+      joint_histogram = CalcJointHistogram(hue_data, saturation_data, brightness_data) if analysis_options.dominant_color_count > 0 else None
+  
+  analysis_result = {}
+  with MeasureStage("statistics"):
+    CalcAnalysisValues(analysis_result, channel_histograms, total_pixel_count, analysis_options.sample_pixel_count > 0)
+    if joint_histogram is not None:
+      analysis_result["dominant_colors"] = ExtractDominantColors(joint_histogram, analysis_options.dominant_color_count)
+  analysis_result["histograms"] = channel_histograms
+  return analysis_result, input_image, hsv_planes
+
+def AnalyzeImageSource(path_or_bytes, file_name: str, analysis_options, hsv_converter: HsvConverter, file_name_parser,
+                       channel_writer_factory = None, near_duplicate_lookup = None):
+  # ファイル名の情報を読み取って画像を開き、解析する。ライブラリAPI(analyze)とCLI(AnalyzeImageData)の共通部分
+  # near_duplicate_lookup(署名, 総画素数)が統計値を返した場合は解析を省き、input_imageとhsv_planesはNoneを返す
+  analysis_result = {}
+  if file_name is not None:
+    analysis_result = file_name_parser(os.path.basename(file_name).split('.')[0])
+    analysis_result["file_name"] = file_name
+  
+  is_bytes_input = isinstance(path_or_bytes, (bytes, bytearray, memoryview))
+  with (io.BytesIO(path_or_bytes) if is_bytes_input == True else open(path_or_bytes, "rb")) as pointer_of_input_image:
+    decoded_image = None
+    if near_duplicate_lookup is not None:
+      with MeasureStage("decode"):
+        image_signature, total_pixel_count, decoded_image = ReadImageSignature(pointer_of_input_image)
+      analysis_result["image_signature"] = image_signature
+      near_duplicate_values = near_duplicate_lookup(image_signature, total_pixel_count)
+      if near_duplicate_values is not None:
+        analysis_result.update(near_duplicate_values)
+        return analysis_result, None, None
+    
+    image_values, input_image, hsv_planes = AnalyzeImageStream(pointer_of_input_image, analysis_options, hsv_converter, channel_writer_factory, decoded_image)
+  analysis_result.update(image_values)
+  return analysis_result, input_image, hsv_planes
+
+def MakeAnalysisOptions(tile_budget: int = None):
+  global sample_pixel_count
+  global dominant_color_count
+  global tile_budget_megabytes
+  
+  # コマンドライン引数の設定をライブラリAPIと同じ解析設定にまとめる
+  # tile_budgetはメモリ予算を超える画像だけを帯状に処理するための指定で、省略時は -m の値に従う
+  return AnalysisOptions(sample_pixel_count=sample_pixel_count, dominant_color_count=dominant_color_count,
+                         tile_budget_megabytes=tile_budget_megabytes if tile_budget is None else tile_budget, keep_histograms=True)
+
+def CreateChannelImageWriters(image_output_file_name: str, image_width: int, image_height: int):
+  global is_dny_output
+  global is_stats_only_mode
   
+  if is_dny_output == True or is_stats_only_mode == True:
+    return []
+  channel_writers = []
+  try:
+    for output_suffix_name in OUTPUT_SUFFIX_NAMES:
+      channel_writers.append(StreamingPngWriter(OUTPUT_IMAGE_DIR + "/" + image_output_file_name + output_suffix_name, image_width, image_height))
+  except BaseException:
+    for channel_writer in channel_writers:
+      channel_writer.Abort()
+    raise
+  return channel_writers
+
+def AnalyzeImageData(process_file_name: str, batch_mode: bool, input_file_data: bytes = None, tile_budget: int = None):
   global NOMAL_MODE
   global NOISY_MODE
   global VERY_NOISY_MODE
+  global is_stats_only_mode
+  global near_duplicate_index
+  
+  analysis_options = MakeAnalysisOptions(tile_budget)
+  base_file_name = os.path.basename(process_file_name).split('.')[0]
+  figure_titles, image_output_file_name = MakeFigureTitleNames(base_file_name, batch_mode)
+  
+  def FindNearDuplicateValues(image_signature: tuple, total_pixel_count: int):
+    near_duplicate = near_duplicate_index.Find(process_file_name, image_signature)
+    if near_duplicate is None:
+      return None
+    return MakeNearDuplicateValues(near_duplicate, total_pixel_count, analysis_options.sample_pixel_count > 0)
+  
+  ## for csv & json
+  # CLIではファイル名が規約に従わない画像は失敗として扱う。先読み済みのファイル内容があればディスクを読み直さない
+  BeginImageProfile()
+  channel_images = []
+  analysis_result, input_image, hsv_planes = AnalyzeImageSource(input_file_data if input_file_data is not None else process_file_name, process_file_name,
+                                                                analysis_options, GetHsvConverter(), ParseFileNameInformation,
+                                                                lambda image_width, image_height: CreateChannelImageWriters(image_output_file_name, image_width, image_height),
+                                                                FindNearDuplicateValues if near_duplicate_index is not None else None)
+  if input_image is None:
+    # 近似重複の画像は変換・集計・図表の作成を省き、索引にある統計値を引き継ぐ
+    return analysis_result, {"channel_images": [], "figure_titles": figure_titles, "image_output_file_name": image_output_file_name, "is_near_duplicate": True}
+  
+  if hsv_planes is None:
+    if verbosity >= VERY_NOISY_MODE:
+      print("\r", input_image.format, input_image.size, input_image.mode, "strip height:", CalcStripHeight(input_image.width, analysis_options.tile_budget_megabytes))
+  else:
+    if is_stats_only_mode == False:
+      with MeasureStage("channel_extract"):
+        # 変換結果の配列は次の画像で上書きされるため、書き出し用の画像はコピーから作る
+        channel_images = [Image.fromarray(hsv_plane.copy(), "L") for hsv_plane in hsv_planes]
+    if verbosity >= VERY_NOISY_MODE:
+      PrintDebugInfomation(input_image, hsv_planes)
+  
+  if verbosity == VERY_NOISY_MODE:
+    SuspendWaitingAnimation()
+    print("\rhue mean:", analysis_result["hue_mean"], ", hue median :", analysis_result["hue_median"], WHITE_PADDING)
+    print("\rsaturation mean:", analysis_result["saturation_mean"], ", saturation median :", analysis_result["saturation_median"], WHITE_PADDING)
+    print("\rbrightness mean:", analysis_result["brightness_mean"], ", brightness median :", analysis_result["brightness_median"], WHITE_PADDING)
+    ResumeWaitingAnimation()
+  
+  # 画像とグラフの書き出しはパイプライン処理では出力スレッドに任せるため分けて返す
+  return analysis_result, {"channel_images": channel_images, "figure_titles": figure_titles, "image_output_file_name": image_output_file_name, "is_near_duplicate": False}
 
-  global MAIN_PROCESS_IS_IN_PROGRESS
-  global MAIN_PROCESS_WAS_FINISHED
-  global MAIN_PROCESS_REQUESTS_SLEEP_CALL
+def WriteImageOutputs(analysis_result: dict, image_outputs: dict):
+  global is_stats_only_mode
   
-  global input_file_name
-  global output_file_name
-  global prefix_figure_title_name
-  global use_interactive_mode
+  if is_stats_only_mode == True or image_outputs["is_near_duplicate"] == True:
+    return
+  with MeasureStage("channel_png_save"):
+    for channel_image, output_suffix_name in zip(image_outputs["channel_images"], OUTPUT_SUFFIX_NAMES):
+      SaveChannelImage(channel_image, image_outputs["image_output_file_name"], output_suffix_name)
+  RenderHistogramFigures(analysis_result["histograms"], analysis_result, image_outputs["figure_titles"], image_outputs["image_output_file_name"])
+
+def AnalyzeImage(process_file_name: str, batch_mode: bool, result_csv_writer, result_json_file, result_cache = None, tile_budget: int = None):
+  try:
+    analysis_result = AnalyzeImageProcess(process_file_name, batch_mode, tile_budget)
+    WriteAnalysisResult(analysis_result, result_csv_writer, result_json_file)
+    if result_cache is not None:
+      result_cache.Store(process_file_name, analysis_result)
+  except Exception as e:
+    PrintProgressMessage("Unexpected error: " + str(e))
+    # 一括処理モードでは1ファイルの失敗で全体を止めない
+    if batch_mode == True:
+      return ERROR_EXIT
+    sys.exit(ERROR_EXIT)
+  except KeyboardInterrupt:
+    print("\nKeyboard Interrupt: The script aborted.")
+    sys.exit(NORMAL_EXIT)
+  
+  return NORMAL_EXIT
+
+##################################################
+#                 ライブラリAPI用                 
+##################################################
+# 他のPythonのコードから import main として呼び出すための入口(グローバル変数を読み書きせず、失敗は画像ごとに例外で返す)
+#   result = analyze("input/100_Nintendo_20200101_Some_Game.png", AnalysisOptions(dominant_color_count=3))
+#   for result in analyze_many(paths): csv_writer.writerow(result.ToCsvRow())
+class AnalysisOptions:
+  # 解析の設定(コマンドライン引数の -s, -k, -m に対応する)
+  __slots__ = ("sample_pixel_count", "dominant_color_count", "tile_budget_megabytes", "keep_histograms")
+  
+  def __init__(self, sample_pixel_count: int = 0, dominant_color_count: int = 0, tile_budget_megabytes: int = 0, keep_histograms: bool = False):
+    self.sample_pixel_count = max(int(sample_pixel_count), 0)
+    self.dominant_color_count = max(int(dominant_color_count), 0)
+    self.tile_budget_megabytes = max(int(tile_budget_megabytes), 0)
+    self.keep_histograms = keep_histograms      # Trueなら3チャンネル分のヒストグラム(3 x 256)も結果に残す
+
+HSV_RESULT_FIELDS = ("file_name", "sales_count", "maker_name", "seles_date", "software_name",
+                     "hue_mean", "hue_median", "saturation_mean", "saturation_median", "brightness_mean", "brightness_median") + \
+                    ("sample_size", "total_pixel_count",
+                     "hue_mean_error", "hue_median_error", "saturation_mean_error", "saturation_median_error", "brightness_mean_error", "brightness_median_error",
+                     "dominant_colors", "histograms")
+HSV_RESULT_REQUIRED_FIELD_COUNT = 11     # 先頭のファイル名と統計値は常に出力し、残りは値がある場合だけ出力する
+
+class HSVResult:
+  # 画像1枚分の解析結果。値がない項目(標本化しない場合の標準誤差など)はNoneになる
+  # ToCsvRow / ToJsonRecord はCLIが書き出すCSV/JSONの1件と同じ形式を返す
+  __slots__ = HSV_RESULT_FIELDS + ("dominant_color_count",)
+  
+  def __init__(self, analysis_result: dict, dominant_color_count: int = 0):
+    for field_name in HSV_RESULT_FIELDS:
+      setattr(self, field_name, analysis_result.get(field_name))
+    self.dominant_color_count = dominant_color_count
+  
+  def ToDict(self):
+    # CLIの解析結果と同じ形の辞書(標本化や主要色の項目は値がある場合だけ含める)
+    return {field_name: getattr(self, field_name) for field_index, field_name in enumerate(HSV_RESULT_FIELDS)
+            if field_index < HSV_RESULT_REQUIRED_FIELD_COUNT or getattr(self, field_name) is not None}
+  
+  def ToCsvRow(self):
+    return MakeCsvRow(self.ToDict(), self.dominant_color_count)
+  
+  def ToJsonRecord(self):
+    return MakeJsonRecord(self.ToDict())
+  
+  def __repr__(self):
+    return "HSVResult(file_name={!r}, hue_mean={}, saturation_mean={}, brightness_mean={})".format(self.file_name, self.hue_mean, self.saturation_mean, self.brightness_mean)
+
+class ImageAnalysisError(Exception):
+  # 1枚の画像の解析に失敗したことを表す(元の例外は __cause__ に残る)
+  def __init__(self, file_name: str, message: str):
+    super().__init__("{}: {}".format(file_name, message))
+    self.file_name = file_name
+
+def analyze(path_or_bytes, options: AnalysisOptions = None, name: str = None, hsv_converter: HsvConverter = None):
+  # path_or_bytesは画像のパスかバイト列。nameを省略するとパスのファイル名から売上・メーカーなどを読み取る
+  # (ファイル名が「売上_メーカー_発売日_タイトル」の規約に従わない場合や、バイト列でnameもない場合はそれらの項目をNoneにする)
+  if options is None:
+    options = AnalysisOptions()
+  if name is None and isinstance(path_or_bytes, (bytes, bytearray, memoryview)) == False:
+    name = os.fspath(path_or_bytes)
+  if hsv_converter is None:
+    hsv_converter = HsvConverter()
+  
+  try:
+    analysis_result, _, _ = AnalyzeImageSource(path_or_bytes, name, options, hsv_converter, TryParseFileNameInformation)
+  except Exception as e:
+    raise ImageAnalysisError(name if name is not None else "<bytes>", str(e)) from e
+  
+  if options.keep_histograms == False:
+    del analysis_result["histograms"]
+  return HSVResult(analysis_result, options.dominant_color_count)
+
+def analyze_many(paths, options: AnalysisOptions = None, return_exceptions: bool = False):
+  # 画像を1枚ずつ解析して結果を順に返す。HSV変換の作業用配列は全ての画像で使い回す
+  # return_exceptions=Trueなら失敗した画像の位置にImageAnalysisErrorを返して次の画像へ進む
+  hsv_converter = HsvConverter()
+  for path in paths:
+    try:
+      yield analyze(path, options, hsv_converter=hsv_converter)
+    except ImageAnalysisError as e:
+      if return_exceptions == False:
+        raise
+      yield e
+
+##################################################
+#                  結果出力用                 
+##################################################
+def MakeCsvRow(analysis_result: dict, color_count: int):
+  return [analysis_result["sales_count"], analysis_result["maker_name"], analysis_result["seles_date"], analysis_result["software_name"],
+          analysis_result["hue_mean"], analysis_result["hue_median"],
+          analysis_result["saturation_mean"], analysis_result["saturation_median"],
+          analysis_result["brightness_mean"], analysis_result["brightness_median"]] + MakeSamplingCsvColumns(analysis_result) + MakeDominantColorCsvColumns(analysis_result, color_count)
+
+def MakeSamplingCsvColumns(analysis_result: dict):
+  if "sample_size" not in analysis_result:
+    return []
+  return [analysis_result["sample_size"], analysis_result["total_pixel_count"],
+          analysis_result["hue_mean_error"], analysis_result["hue_median_error"],
+          analysis_result["saturation_mean_error"], analysis_result["saturation_median_error"],
+          analysis_result["brightness_mean_error"], analysis_result["brightness_median_error"]]
+
+def MakeDominantColorCsvHeader(color_count: int):
+  return [header_format.format(color_number) for color_number in range(1, color_count + 1) for header_format in DOMINANT_COLOR_CSV_HEADER_FORMATS]
+
+def MakeDominantColorCsvColumns(analysis_result: dict, color_count: int):
+  if "dominant_colors" not in analysis_result:
+    return []
+  # 色数の少ない画像でも列がずれないよう空欄で埋める
+  dominant_colors = analysis_result["dominant_colors"]
+  missing_count = max(color_count - len(dominant_colors), 0)
+  return [value for dominant_color in dominant_colors for value in dominant_color] + [None] * (missing_count * len(DOMINANT_COLOR_CSV_HEADER_FORMATS))
+
+def MakeJsonRecord(analysis_result: dict):
+  json_result_data = {
+      "発売元": analysis_result["maker_name"],
+      "発売日": analysis_result["seles_date"],
+      "売上": analysis_result["sales_count"],
+      "パッケージ名": analysis_result["software_name"],
+      "色相": [{
+        "平均値": analysis_result["hue_mean"],
+        "頻出値": analysis_result["hue_median"],
+      }],
+      "彩度": [{
+        "平均値": analysis_result["saturation_mean"],
+        "頻出値": analysis_result["saturation_median"],
+      }],
+      "明度": [{
+        "平均値": analysis_result["brightness_mean"],
+        "頻出値": analysis_result["brightness_median"],
+      }],
+  }
+  if "sample_size" in analysis_result:
+    json_result_data["標本数"] = analysis_result["sample_size"]
+    json_result_data["総画素数"] = analysis_result["total_pixel_count"]
+    for json_key, result_key in (("色相", "hue"), ("彩度", "saturation"), ("明度", "brightness")):
+      json_result_data[json_key][0]["平均値の標準誤差"] = analysis_result[result_key + "_mean_error"]
+      json_result_data[json_key][0]["頻出値の標準誤差"] = analysis_result[result_key + "_median_error"]
+  if "near_duplicate_of" in analysis_result:
+    json_result_data["近似重複元"] = {"ファイル名": analysis_result["near_duplicate_of"], "ハミング距離": analysis_result["near_duplicate_distance"]}
+  if "dominant_colors" in analysis_result:
+    json_result_data["主要色"] = [{"色相": hue_value, "彩度": saturation_value, "明度": brightness_value, "占有率": coverage}
+                                  for hue_value, saturation_value, brightness_value, coverage in analysis_result["dominant_colors"]]
+  return json_result_data
+
+def MakeCsvHeader(analysis_options):
+  return CSV_HEADER + (SAMPLING_CSV_HEADER if analysis_options.sample_pixel_count > 0 else []) + MakeDominantColorCsvHeader(analysis_options.dominant_color_count)
+
+def ReadCsvHeader(csv_file_name: str):
+  # 空のファイルはヘッダがないものとしてNoneを返す
+  with open(csv_file_name, mode='r', encoding='utf-8', newline='') as existing_csv_file:
+    return next(csv.reader(existing_csv_file), None)
+
+def WriteAnalysisResult(analysis_result: dict, result_csv_writer, result_json_file):
   global is_init_process
+  global dominant_color_count
+  global histogram_store
+  global group_aggregate
+  global near_duplicate_index
+  global use_near_duplicate_index
+  global result_database
+  global profile_report
   
-  global default_xlim_max
-  global default_xlim_min
-  
-  # グラフ表示の制御用変数
-  hue_figure_title_name_with_prefix = prefix_figure_title_name + HUE_FIGURE_TITLE_NAME['japanese']
-  saturation_figure_title_name_with_prefix = prefix_figure_title_name + SATURATION_FIGURE_TITLE_NAME['japanese']
-  brightness_figure_title_name_with_prefix = prefix_figure_title_name + BRIGHTNESS_FIGURE_TITLE_NAME['japanese']
-  xlabel_list = {
-    'hue_label': {
-      'english': 'Value of Hue',
-      'japanese': '色相の値'
-    },
-    'saturation_label': {
-      'english': 'Value of saturation',
-      'japanese': '彩度の値'
-    },
-    'brightness_label': {
-      'english': 'Value of brightness',
-      'japanese': '明度の値'
-    },
+  write_start_time = time.perf_counter()
+  if near_duplicate_index is not None and "image_signature" in analysis_result:
+    # 近似重複の関係はCSV/JSONに書く前に確定させる
+    near_duplicate_index.Register(analysis_result)
+  if histogram_store is not None and "histograms" in analysis_result:
+    histogram_store.Append(analysis_result)
+  if group_aggregate is not None and "histograms" in analysis_result:
+    group_aggregate.Add(analysis_result)
+  if result_database is not None:
+    result_database.Upsert(analysis_result)
+  result_csv_writer.writerow(MakeCsvRow(analysis_result, dominant_color_count) + (MakeNearDuplicateCsvColumns(analysis_result) if use_near_duplicate_index == True else []))
+  if is_init_process == True:
+    is_init_process = False
+  else:
+    result_json_file.write(',')
+
+  json.dump(MakeJsonRecord(analysis_result), result_json_file, ensure_ascii=False)
+  result_json_file.write('\n')
+  
+  if profile_report is not None and analysis_result.get("profile") is not None:
+    profile_report.Record(analysis_result, time.perf_counter() - write_start_time)
+
+##################################################
+#                結果キャッシュ用                 
+##################################################
+def CalcFileContentHash(process_file_name: str):
+  content_hash = hashlib.sha256()
+  with open(process_file_name, "rb") as pointer_of_input_file:
+    for chunk in iter(lambda: pointer_of_input_file.read(HASH_READ_CHUNK_SIZE), b""):
+      content_hash.update(chunk)
+  return content_hash.hexdigest()
+
+def CollectAnalysisParameters():
+  # 出力結果に影響する引数のみをキャッシュのキーに含める
+  return {
+    "equal_width": equal_width,
+    "is_dny_output": is_dny_output,
+    "is_stats_only_mode": is_stats_only_mode,
+    "figure_backend": figure_backend,
+    "is_composite_figure": is_composite_figure,
+    "sample_pixel_count": sample_pixel_count,
+    "use_histogram_store": use_histogram_store,
+    "use_group_aggregate": use_group_aggregate,
+    "dominant_color_count": dominant_color_count,
+    "use_near_duplicate_index": use_near_duplicate_index,
+    "near_duplicate_distance": near_duplicate_distance,
   }
-  ylabel_list = {
-    'hue_label': {
-      'english': 'Frequent',
-      'japanese': '頻出度'
-    },
-    'saturation_label': {
-      'english': 'Frequent',
-      'japanese': '頻出度'
-    },
-    'brightness_label': {
-      'english': 'Frequent',
-      'japanese': '頻出度'
-    },
+
+class AnalysisResultCache:
+  def __init__(self, manifest_file_name: str, analysis_parameters: dict):
+    self.manifest_file_name = manifest_file_name
+    self.analysis_parameters = analysis_parameters
+    self.entries = {}
+    self.visited_entries = {}
+    self.pending_file_status = {}
+    self.reused_count = 0
+    
+    if os.path.isfile(manifest_file_name):
+      with open(manifest_file_name, mode='r', encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+      if manifest.get("version") == MANIFEST_FORMAT_VERSION:
+        self.entries = manifest.get("entries", {})
+  
+  def Lookup(self, process_file_name: str):
+    # サイズと更新日時が一致すればハッシュ計算を省略し、不一致の場合のみ内容のハッシュで判定する
+    file_status = os.stat(process_file_name)
+    entry = self.entries.get(process_file_name)
+    content_hash = None
+    
+    if entry is not None and entry["parameters"] == self.analysis_parameters:
+      if entry["size"] != file_status.st_size:
+        entry = None
+      elif entry["mtime_ns"] != file_status.st_mtime_ns:
+        content_hash = CalcFileContentHash(process_file_name)
+        if entry["content_hash"] != content_hash:
+          entry = None
+      if entry is not None and all(os.path.isfile(output_file) for output_file in ListBatchOutputFiles(process_file_name, entry["result"])):
+        entry["mtime_ns"] = file_status.st_mtime_ns
+        self.visited_entries[process_file_name] = entry
+        self.reused_count += 1
+        return entry["result"]
+    
+    self.pending_file_status[process_file_name] = (file_status, content_hash)
+    return None
+  
+  def Store(self, process_file_name: str, analysis_result: dict):
+    file_status, content_hash = self.pending_file_status.pop(process_file_name, (None, None))
+    if file_status is None:
+      file_status = os.stat(process_file_name)
+    if content_hash is None:
+      content_hash = CalcFileContentHash(process_file_name)
+    
+    self.visited_entries[process_file_name] = {
+      "size": file_status.st_size,
+      "mtime_ns": file_status.st_mtime_ns,
+      "content_hash": content_hash,
+      "parameters": self.analysis_parameters,
+      "result": {key: value for key, value in analysis_result.items() if key not in TRANSIENT_RESULT_KEYS},
+    }
+  
+  def Save(self):
+    # 今回の実行で見つからなかったファイルの情報は破棄する
+    # 途中で中断されても壊れたマニフェストが残らないように一時ファイル経由で置き換える
+    temporary_file_name = self.manifest_file_name + ".tmp"
+    with open(temporary_file_name, mode='w', encoding='utf-8') as manifest_file:
+      json.dump({"version": MANIFEST_FORMAT_VERSION, "entries": self.visited_entries}, manifest_file, ensure_ascii=False)
+    os.replace(temporary_file_name, self.manifest_file_name)
+
+##################################################
+#               ヒストグラム保存用                 
+##################################################
+class HistogramStore:
+  # 画像1枚につき 3 x 256 のuint32配列を追記するだけの固定長レコードのファイルと、
+  # レコード番号とファイル名の情報を1行ずつ追記する索引ファイル(JSON Lines)の組で保存する
+  RECORD_SHAPE = (3, HISTOGRAM_BIN_SIZE)
+  
+  def __init__(self, store_file_name: str, index_file_name: str):
+    self.store_file_name = store_file_name
+    self.index_file_name = index_file_name
+    self.record_size = HISTOGRAM_STORE_DTYPE.itemsize * self.RECORD_SHAPE[0] * self.RECORD_SHAPE[1]
+    self.store_file = None
+    self.index_file = None
+  
+  def Append(self, analysis_result: dict):
+    if self.store_file is None:
+      self.store_file = open(self.store_file_name, mode='ab')
+      self.index_file = open(self.index_file_name, mode='a', encoding='utf-8')
+    
+    # 途中で中断されても索引が壊れないよう、レコード番号は常に実ファイルの大きさから求める
+    record_number = self.store_file.tell() // self.record_size
+    self.store_file.write(np.ascontiguousarray(analysis_result["histograms"], dtype=HISTOGRAM_STORE_DTYPE).tobytes())
+    index_entry = {"record": record_number}
+    for key in ("file_name", "sales_count", "maker_name", "seles_date", "software_name", "total_pixel_count"):
+      if key in analysis_result:
+        index_entry[key] = analysis_result[key]
+    self.store_file.flush()
+    json.dump(index_entry, self.index_file, ensure_ascii=False)
+    self.index_file.write('\n')
+  
+  def Flush(self):
+    if self.index_file is not None:
+      self.index_file.flush()
+  
+  def LoadIndex(self):
+    # 同じファイルが複数回保存されている場合は最後のレコードを採用する
+    index_entries = {}
+    if os.path.isfile(self.index_file_name):
+      with open(self.index_file_name, mode='r', encoding='utf-8') as index_file:
+        for index_line in index_file:
+          if index_line.strip() == "":
+            continue
+          index_entry = json.loads(index_line)
+          index_entries[index_entry["file_name"]] = index_entry
+    return index_entries
+  
+  def MapHistograms(self):
+    record_count = os.path.getsize(self.store_file_name) // self.record_size if os.path.isfile(self.store_file_name) else 0
+    if record_count == 0:
+      return np.zeros((0,) + self.RECORD_SHAPE, dtype=HISTOGRAM_STORE_DTYPE)
+    return np.memmap(self.store_file_name, dtype=HISTOGRAM_STORE_DTYPE, mode='r', shape=(record_count,) + self.RECORD_SHAPE)
+  
+  def Close(self):
+    if self.store_file is not None:
+      self.store_file.close()
+      self.index_file.close()
+      self.store_file = None
+      self.index_file = None
+
+def RebuildFromHistogramStore(result_csv_writer, result_json_file):
+  global sample_pixel_count
+  global is_stats_only_mode
+  
+  store = HistogramStore(HISTOGRAM_STORE_FILE_NAME, HISTOGRAM_INDEX_FILE_NAME)
+  index_entries = store.LoadIndex()
+  histogram_records = store.MapHistograms()
+  
+  rebuilt_count = 0
+  unsampled_count = 0
+  for process_file_name in sorted(index_entries):
+    index_entry = index_entries[process_file_name]
+    if index_entry["record"] >= len(histogram_records):
+      continue
+    
+    base_file_name = os.path.basename(process_file_name).split('.')[0]
+    channel_histograms = np.asarray(histogram_records[index_entry["record"]], dtype=np.int64)
+    analysis_result = {key: value for key, value in index_entry.items() if key not in ("record", "total_pixel_count")}
+    # CSVのヘッダは今回の -s の有無で決まるため、標本化の列も保存時ではなく今回の設定に揃える
+    # (-s で保存した記録を -s なしで作り直す場合は標準誤差を出さず、-s なしで保存した記録は全画素を標本として扱う)
+    if sample_pixel_count == 0 and "total_pixel_count" in index_entry:
+      unsampled_count += 1
+    CalcAnalysisValues(analysis_result, channel_histograms, index_entry.get("total_pixel_count", int(channel_histograms[0].sum())), sample_pixel_count > 0)
+    
+    figure_titles, image_output_file_name = MakeFigureTitleNames(base_file_name, True)
+    if is_stats_only_mode == False:
+      RenderHistogramFigures(channel_histograms, analysis_result, figure_titles, image_output_file_name)
+    WriteAnalysisResult(analysis_result, result_csv_writer, result_json_file)
+    rebuilt_count += 1
+  
+  if unsampled_count > 0:
+    print("[!]:", unsampled_count, "records were stored by -s runs. Rebuilt without their sampling columns (add -s to keep them).")
+  return rebuilt_count
+
+##################################################
+#                 グループ集計用                 
+##################################################
+def MakeSalesBucketLabel(sales_count: int):
+  # 売上の桁ごとに区切る(例: 10000-99999)。最後の区切り以上はまとめる
+  lower_bound = 0
+  for upper_bound in SALES_BUCKET_BOUNDARIES:
+    if sales_count < upper_bound:
+      return "{}-{}".format(lower_bound, upper_bound - 1)
+    lower_bound = upper_bound
+  return "{}-".format(lower_bound)
+
+def MakeAggregateGroupKeys(analysis_result: dict):
+  return [("maker", analysis_result["maker_name"]),
+          ("release_year", analysis_result["seles_date"][:4]),
+          ("sales_bucket", MakeSalesBucketLabel(analysis_result["sales_count"]))]
+
+class GroupAggregate:
+  # 画像ごとのH/S/Vヒストグラムをメーカー・発売年・売上帯ごとに足し合わせ、グループ全体の画素の中央値や分位点を O(グループ数 x 256) で求める
+  # 画像ごとの寄与はHistogramStoreと同じ固定長レコード(枠)に保存し、同じファイルを解析し直した時は前回の寄与を引いてから足す
+  # グループごとの合計は保存時にJSONへ書き出し、枠の索引と件数が合わない場合(中断時など)は枠から作り直す
+  RECORD_SHAPE = (3, HISTOGRAM_BIN_SIZE)
+  
+  def __init__(self, member_file_name: str, member_index_file_name: str, group_file_name: str):
+    self.member_file_name = member_file_name
+    self.member_index_file_name = member_index_file_name
+    self.group_file_name = group_file_name
+    self.record_size = HISTOGRAM_STORE_DTYPE.itemsize * self.RECORD_SHAPE[0] * self.RECORD_SHAPE[1]
+    self.members = {}
+    self.index_line_count = 0
+    self.groups = {}
+    self.updated_count = 0
+    
+    if os.path.isfile(member_index_file_name):
+      with open(member_index_file_name, mode='r', encoding='utf-8') as member_index_file:
+        for index_line in member_index_file:
+          if index_line.strip() == "":
+            continue
+          index_entry = json.loads(index_line)
+          self.members[index_entry["file_name"]] = {"slot": index_entry["slot"], "groups": [tuple(group_key) for group_key in index_entry["groups"]]}
+          self.index_line_count += 1
+    self.member_file = open(member_file_name, mode='r+b' if os.path.isfile(member_file_name) else 'w+b')
+    self.member_index_file = open(member_index_file_name, mode='a', encoding='utf-8')
+    
+    group_state = None
+    if os.path.isfile(group_file_name):
+      with open(group_file_name, mode='r', encoding='utf-8') as group_file:
+        group_state = json.load(group_file)
+    if group_state is not None and group_state.get("version") == AGGREGATE_FORMAT_VERSION and group_state.get("index_line_count") == self.index_line_count:
+      for group_entry in group_state["groups"]:
+        self.groups[(group_entry["type"], group_entry["name"])] = {
+          "image_count": group_entry["image_count"],
+          "histograms": np.array(group_entry["histograms"], dtype=np.int64),
+        }
+    else:
+      self.RebuildGroups()
+  
+  def ReadMemberHistograms(self, slot: int):
+    self.member_file.seek(slot * self.record_size)
+    return np.frombuffer(self.member_file.read(self.record_size), dtype=HISTOGRAM_STORE_DTYPE).reshape(self.RECORD_SHAPE).astype(np.int64)
+  
+  def RebuildGroups(self):
+    self.groups = {}
+    for member in self.members.values():
+      self.AddToGroups(member["groups"], self.ReadMemberHistograms(member["slot"]), 1)
+  
+  def AddToGroups(self, group_keys: list, channel_histograms: np.array, image_count: int):
+    for group_key in group_keys:
+      group = self.groups.setdefault(group_key, {"image_count": 0, "histograms": np.zeros(self.RECORD_SHAPE, dtype=np.int64)})
+      group["image_count"] += image_count
+      group["histograms"] += channel_histograms * image_count
+      if group["image_count"] == 0:
+        del self.groups[group_key]
+  
+  def Add(self, analysis_result: dict):
+    process_file_name = analysis_result["file_name"]
+    channel_histograms = np.asarray(analysis_result["histograms"], dtype=np.int64)
+    group_keys = MakeAggregateGroupKeys(analysis_result)
+    
+    member = self.members.get(process_file_name)
+    if member is None:
+      # 新しい画像は枠をファイルの末尾に追加する
+      self.member_file.seek(0, os.SEEK_END)
+      member = {"slot": self.member_file.tell() // self.record_size, "groups": []}
+    else:
+      previous_histograms = self.ReadMemberHistograms(member["slot"])
+      if member["groups"] == group_keys and np.array_equal(previous_histograms, channel_histograms):
+        # 同じ内容の再解析(追記モードでの再実行など)は二重に数えない
+        return
+      self.AddToGroups(member["groups"], previous_histograms, -1)
+    
+    self.member_file.seek(member["slot"] * self.record_size)
+    self.member_file.write(np.ascontiguousarray(channel_histograms, dtype=HISTOGRAM_STORE_DTYPE).tobytes())
+    member["groups"] = group_keys
+    self.members[process_file_name] = member
+    json.dump({"file_name": process_file_name, "slot": member["slot"], "groups": group_keys}, self.member_index_file, ensure_ascii=False)
+    self.member_index_file.write('\n')
+    self.index_line_count += 1
+    self.AddToGroups(group_keys, channel_histograms, 1)
+    self.updated_count += 1
+  
+  def Save(self):
+    self.member_file.flush()
+    self.member_index_file.flush()
+    group_state = {
+      "version": AGGREGATE_FORMAT_VERSION,
+      "index_line_count": self.index_line_count,
+      "groups": [{"type": group_type, "name": group_name, "image_count": group["image_count"], "histograms": group["histograms"].tolist()}
+                 for (group_type, group_name), group in sorted(self.groups.items())],
+    }
+    # 書き込み途中で中断されても前回の状態が残るよう、一時ファイルに書いてから置き換える
+    with open(self.group_file_name + ".tmp", mode='w', encoding='utf-8') as group_file:
+      json.dump(group_state, group_file, ensure_ascii=False)
+    os.replace(self.group_file_name + ".tmp", self.group_file_name)
+  
+  def Export(self, csv_file_name: str, json_file_name: str):
+    aggregate_results = [MakeGroupStatistics(group_type, group_name, group) for (group_type, group_name), group in sorted(self.groups.items())]
+    with open(csv_file_name, mode='w', encoding='utf-8', newline='') as aggregate_csv_file:
+      aggregate_csv_writer = csv.writer(aggregate_csv_file, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
+      aggregate_csv_writer.writerow(MakeAggregateCsvHeader())
+      for aggregate_result in aggregate_results:
+        aggregate_csv_writer.writerow(MakeAggregateCsvRow(aggregate_result))
+    with open(json_file_name, mode='w', encoding='utf-8', newline='') as aggregate_json_file:
+      json.dump([MakeAggregateJsonRecord(aggregate_result) for aggregate_result in aggregate_results], aggregate_json_file, ensure_ascii=False, indent=2)
+    return len(aggregate_results)
+  
+  def Close(self):
+    self.Save()
+    self.member_file.close()
+    self.member_index_file.close()
+
+def MakeGroupStatistics(group_type: str, group_name: str, group: dict):
+  # 合算したヒストグラムから求めるため、値はグループに含まれる全画素の平均値・中央値・分位点になる
+  hue_histogram, saturation_histogram, brightness_histogram = group["histograms"]
+  aggregate_result = {
+    "group_type": group_type,
+    "group_name": group_name,
+    "image_count": group["image_count"],
+    "pixel_count": int(brightness_histogram.sum()),
   }
-  mean_label = {
-    'english': 'Mean',
-    'japanese': '平均値'
+  for channel_name, channel_mean, channel_median in zip(("hue", "saturation", "brightness"),
+                                                        CalcMeanValues(hue_histogram, saturation_histogram, brightness_histogram),
+                                                        CalcMedianValues(hue_histogram, saturation_histogram, brightness_histogram)):
+    aggregate_result[channel_name + "_mean"] = channel_mean
+    aggregate_result[channel_name + "_median"] = channel_median
+  for percentile in AGGREGATE_PERCENTILES:
+    for channel_name, channel_value in zip(("hue", "saturation", "brightness"),
+                                           CalcPercentileValues(hue_histogram, saturation_histogram, brightness_histogram, percentile)):
+      aggregate_result[channel_name + "_p" + str(percentile)] = channel_value
+  return aggregate_result
+
+def MakeAggregateCsvHeader():
+  aggregate_csv_header = ['集計単位', 'グループ', '画像数', '画素数']
+  for channel_label in ('色相', '彩度', '明度'):
+    aggregate_csv_header += [channel_label + 'の平均値', channel_label + 'の中央値']
+    aggregate_csv_header += [channel_label + 'の{}パーセンタイル'.format(percentile) for percentile in AGGREGATE_PERCENTILES]
+  return aggregate_csv_header
+
+def MakeAggregateCsvRow(aggregate_result: dict):
+  aggregate_csv_row = [AGGREGATE_GROUP_TYPE_NAMES[aggregate_result["group_type"]], aggregate_result["group_name"],
+                       aggregate_result["image_count"], aggregate_result["pixel_count"]]
+  for channel_name in ("hue", "saturation", "brightness"):
+    aggregate_csv_row += [aggregate_result[channel_name + "_mean"], aggregate_result[channel_name + "_median"]]
+    aggregate_csv_row += [aggregate_result[channel_name + "_p" + str(percentile)] for percentile in AGGREGATE_PERCENTILES]
+  return aggregate_csv_row
+
+def MakeAggregateJsonRecord(aggregate_result: dict):
+  json_aggregate_data = {
+    "集計単位": AGGREGATE_GROUP_TYPE_NAMES[aggregate_result["group_type"]],
+    "グループ": aggregate_result["group_name"],
+    "画像数": aggregate_result["image_count"],
+    "画素数": aggregate_result["pixel_count"],
   }
-  median_label = {
-    'english': 'Median',
-    'japanese': '中央値'
+  for json_key, channel_name in (("色相", "hue"), ("彩度", "saturation"), ("明度", "brightness")):
+    json_aggregate_data[json_key] = [{
+      "平均値": aggregate_result[channel_name + "_mean"],
+      "頻出値": aggregate_result[channel_name + "_median"],
+      "パーセンタイル": {str(percentile): aggregate_result[channel_name + "_p" + str(percentile)] for percentile in AGGREGATE_PERCENTILES},
+    }]
+  return json_aggregate_data
+
+##################################################
+#                 近似重複検出用                 
+##################################################
+def CalcHammingDistance(hash_value: int, other_hash_value: int):
+  return bin(hash_value ^ other_hash_value).count("1")
+
+class MultiIndexHashTable:
+  # 64ビットのハッシュを (許容距離 + 1) 個のブロックに分け、ブロックごとの値で項目を引く表
+  # 距離が許容範囲内の2つのハッシュは、鳩の巣原理により少なくとも1つのブロックの値が完全に一致するため、
+  # 一致したブロックの項目だけを候補として距離を確かめればよい(全件との比較をしない)
+  def __init__(self, max_distance: int):
+    self.max_distance = max_distance
+    block_count = min(max_distance + 1, 64)
+    block_boundaries = [64 * block_index // block_count for block_index in range(block_count + 1)]
+    self.blocks = [(block_start, (1 << (block_end - block_start)) - 1) for block_start, block_end in zip(block_boundaries, block_boundaries[1:])]
+    self.buckets = [{} for _ in self.blocks]
+  
+  def Insert(self, hash_value: int, item):
+    for bucket, (block_shift, block_mask) in zip(self.buckets, self.blocks):
+      bucket.setdefault((hash_value >> block_shift) & block_mask, []).append((hash_value, item))
+  
+  def Search(self, hash_value: int):
+    candidates = set()
+    for bucket, (block_shift, block_mask) in zip(self.buckets, self.blocks):
+      candidates.update(bucket.get((hash_value >> block_shift) & block_mask, ()))
+    matches = []
+    for candidate_hash, item in candidates:
+      distance = CalcHammingDistance(hash_value, candidate_hash)
+      if distance <= self.max_distance:
+        matches.append((distance, candidate_hash, item))
+    return matches
+
+def CalcImageSignature(input_image: Image):
+  # 9 x 8 に縮小した画像の横に隣り合う画素の明るさの大小(dHash, 64ビット)と、平均色(RGB)を返す
+  # 透明度はHSVの解析と同様に無視する
+  if input_image.mode not in ("RGB", "L"):
+    input_image = input_image.convert("RGB")
+  thumbnail_image = input_image.resize(NEAR_DUPLICATE_THUMBNAIL_SIZE, Image.BOX)
+  luminance = np.asarray(thumbnail_image.convert("L"), dtype=np.int16)
+  hash_bits = np.packbits(luminance[:, 1:] > luminance[:, :-1])
+  average_color = np.asarray(thumbnail_image.convert("RGB"), dtype=np.float64).reshape(-1, 3).mean(axis=0)
+  return int.from_bytes(hash_bits.tobytes(), "big"), tuple(int(round(color_value)) for color_value in average_color)
+
+def ReadImageSignature(pointer_of_input_image):
+  # JPEGはDCTの段階で1/8に縮小してデコードするだけで済ませ、解析する場合はファイルを読み直す
+  # それ以外の形式は縮小してデコードできないため、デコードした画像を解析にもそのまま使えるように返す
+  input_image = Image.open(pointer_of_input_image)
+  total_pixel_count = input_image.width * input_image.height
+  if input_image.format == "JPEG":
+    input_image.draft(input_image.mode, NEAR_DUPLICATE_THUMBNAIL_SIZE)
+    image_signature = CalcImageSignature(input_image)
+    pointer_of_input_image.seek(0)
+    return image_signature, total_pixel_count, None
+  input_image.load()
+  return CalcImageSignature(input_image), total_pixel_count, input_image
+
+class NearDuplicateIndex:
+  # 解析した画像の知覚ハッシュ・平均色・統計値を実行をまたいで保持し、ハミング距離の近い画像をマルチインデックスの表で探す
+  # 索引ファイル(JSON Lines)に1枚1行で追記し、ヒストグラムは 3 x 256 のuint32の固定長レコードとして別のファイルに追記する
+  # メモリにはハッシュと平均色と行の位置だけを持ち、統計値は近似重複が見つかった時に索引ファイルから読み直す
+  # 近似重複と判定された画像は索引に加えない(元の画像だけが候補になる)
+  # 元の画像は内容ではなく処理した順で決まる。以前の実行で索引に登録済みの画像が優先され、同じ実行の中では入力ファイルのパス順に先の画像が元になる
+  RECORD_SHAPE = (3, HISTOGRAM_BIN_SIZE)
+  
+  def __init__(self, index_file_name: str, histogram_file_name: str, analysis_parameters: dict, max_distance: int):
+    self.index_file_name = index_file_name
+    self.histogram_file_name = histogram_file_name
+    # 引き継ぐ統計値に影響する設定が同じ記録だけを使う
+    self.parameters_key = hashlib.sha256(json.dumps(analysis_parameters, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    self.record_size = HISTOGRAM_STORE_DTYPE.itemsize * self.RECORD_SHAPE[0] * self.RECORD_SHAPE[1]
+    self.entries = {}       # ファイル名 -> (ハッシュ, 平均色, レコード番号, 索引ファイルの行の位置)
+    self.hash_table = MultiIndexHashTable(max_distance)
+    self.index_file = None
+    self.histogram_file = None
+    self.lock = threading.Lock()      # パイプライン処理では検索(解析スレッド)と追加(出力スレッド)が同時に行われる
+    self.reused_count = 0
+    self.flagged_count = 0
+    self.LoadIndex()
+  
+  def LoadIndex(self):
+    if os.path.isfile(self.index_file_name) == False:
+      return
+    record_count = os.path.getsize(self.histogram_file_name) // self.record_size if os.path.isfile(self.histogram_file_name) else 0
+    with open(self.index_file_name, mode='rb') as index_file:
+      line_offset = 0
+      for index_line in index_file:
+        try:
+          index_entry = json.loads(index_line)
+        except ValueError:
+          # 中断で書きかけになった行は読み飛ばす
+          index_entry = None
+        if index_entry is not None and index_entry.get("version") == NEAR_DUPLICATE_FORMAT_VERSION and index_entry.get("parameters") == self.parameters_key:
+          # 同じファイルの記録が複数ある場合は最後の行を採用する
+          if index_entry.get("removed") == True:
+            self.entries.pop(index_entry["file_name"], None)
+          elif index_entry["record"] < record_count:
+            self.entries[index_entry["file_name"]] = (int(index_entry["dhash"], 16), tuple(index_entry["color"]), index_entry["record"], line_offset)
+        line_offset += len(index_line)
+    for file_name, entry in self.entries.items():
+      self.hash_table.Insert(entry[0], file_name)
+  
+  def OpenFiles(self):
+    if self.index_file is not None:
+      return
+    self.histogram_file = open(self.histogram_file_name, mode='ab')
+    # 書きかけのレコードや行があれば、その後ろに続けて書かないように切り詰める・改行する
+    self.histogram_file.truncate(self.histogram_file.tell() - self.histogram_file.tell() % self.record_size)
+    self.index_file = open(self.index_file_name, mode='ab')
+    if self.index_file.tell() > 0:
+      with open(self.index_file_name, mode='rb') as index_file:
+        index_file.seek(-1, os.SEEK_END)
+        if index_file.read(1) != b"\n":
+          self.index_file.write(b"\n")
+  
+  def WriteIndexLine(self, index_entry: dict):
+    line_offset = self.index_file.tell()
+    self.index_file.write((json.dumps(index_entry, ensure_ascii=False) + "\n").encode("utf-8"))
+    # 直後の検索で読み直せるよう、1件ごとに書き出す
+    self.index_file.flush()
+    return line_offset
+  
+  def ReadIndexEntry(self, line_offset: int):
+    with open(self.index_file_name, mode='rb') as index_file:
+      index_file.seek(line_offset)
+      return json.loads(index_file.readline())
+  
+  def ReadHistograms(self, record_number: int):
+    with open(self.histogram_file_name, mode='rb') as histogram_file:
+      histogram_file.seek(record_number * self.record_size)
+      return np.frombuffer(histogram_file.read(self.record_size), dtype=HISTOGRAM_STORE_DTYPE).reshape(self.RECORD_SHAPE)
+  
+  def FindNearest(self, process_file_name: str, image_signature: tuple):
+    image_hash, image_color = image_signature
+    candidates = []
+    for distance, entry_hash, file_name in self.hash_table.Search(image_hash):
+      entry = self.entries.get(file_name)
+      # 同じファイルの以前の記録や、置き換え・削除された記録の古い節点は候補にしない
+      if file_name == process_file_name or entry is None or entry[0] != entry_hash:
+        continue
+      if max(abs(color_value - entry_color_value) for color_value, entry_color_value in zip(image_color, entry[1])) > NEAR_DUPLICATE_MAX_COLOR_DIFFERENCE:
+        continue
+      candidates.append((distance, file_name))
+    return min(candidates) if len(candidates) > 0 else None
+  
+  def Find(self, process_file_name: str, image_signature: tuple):
+    with self.lock:
+      nearest = self.FindNearest(process_file_name, image_signature)
+      if nearest is None:
+        return None
+      distance, file_name = nearest
+      _, _, record_number, line_offset = self.entries[file_name]
+      return {"file_name": file_name, "distance": distance, "result": self.ReadIndexEntry(line_offset)["result"], "histograms": self.ReadHistograms(record_number)}
+  
+  def Register(self, analysis_result: dict):
+    process_file_name = analysis_result["file_name"]
+    if "near_duplicate_of" in analysis_result:
+      # 解析前に近似重複と判定され、統計値を引き継いだ画像
+      self.reused_count += 1
+      self.Remove(process_file_name)
+      return
+    with self.lock:
+      nearest = self.FindNearest(process_file_name, analysis_result["image_signature"])
+    if nearest is not None:
+      # 並列処理で同時に解析されるなどして解析前には見つからなかった近似重複は、解析した統計値のまま関係だけを記録する
+      analysis_result["near_duplicate_distance"], analysis_result["near_duplicate_of"] = nearest
+      self.flagged_count += 1
+      self.Remove(process_file_name)
+      return
+    self.Add(analysis_result)
+  
+  def Add(self, analysis_result: dict):
+    process_file_name = analysis_result["file_name"]
+    image_hash, image_color = analysis_result["image_signature"]
+    result_values = {key: analysis_result[key] for key in NEAR_DUPLICATE_RESULT_KEYS if key in analysis_result}
+    with self.lock:
+      entry = self.entries.get(process_file_name)
+      if entry is not None and entry[:2] == (image_hash, image_color) and \
+         self.ReadIndexEntry(entry[3])["result"] == json.loads(json.dumps(result_values)):
+        # 前回から変わっていない画像は追記しない
+        return
+      self.OpenFiles()
+      record_number = self.histogram_file.tell() // self.record_size
+      self.histogram_file.write(np.ascontiguousarray(analysis_result["histograms"], dtype=HISTOGRAM_STORE_DTYPE).tobytes())
+      self.histogram_file.flush()
+      line_offset = self.WriteIndexLine({
+        "version": NEAR_DUPLICATE_FORMAT_VERSION,
+        "parameters": self.parameters_key,
+        "file_name": process_file_name,
+        "dhash": "{:016x}".format(image_hash),
+        "color": list(image_color),
+        "record": record_number,
+        "result": result_values,
+      })
+      self.entries[process_file_name] = (image_hash, image_color, record_number, line_offset)
+      self.hash_table.Insert(image_hash, process_file_name)
+  
+  def Remove(self, process_file_name: str):
+    with self.lock:
+      if process_file_name not in self.entries:
+        return
+      del self.entries[process_file_name]
+      self.OpenFiles()
+      self.WriteIndexLine({"version": NEAR_DUPLICATE_FORMAT_VERSION, "parameters": self.parameters_key, "file_name": process_file_name, "removed": True})
+  
+  def Close(self):
+    if self.index_file is not None:
+      self.histogram_file.close()
+      self.index_file.close()
+      self.histogram_file = None
+      self.index_file = None
+
+def CreateNearDuplicateIndex():
+  global sample_pixel_count
+  global dominant_color_count
+  global near_duplicate_distance
+  
+  return NearDuplicateIndex(NEAR_DUPLICATE_INDEX_FILE_NAME, NEAR_DUPLICATE_HISTOGRAM_FILE_NAME,
+                            {"sample_pixel_count": sample_pixel_count, "dominant_color_count": dominant_color_count}, near_duplicate_distance)
+
+def MakeNearDuplicateValues(near_duplicate: dict, total_pixel_count: int, is_sampled: bool):
+  near_duplicate_values = dict(near_duplicate["result"])
+  histograms = near_duplicate["histograms"].astype(np.int64)
+  if is_sampled == True:
+    # 標本数と標準誤差は元の画像のものを引き継ぎ、総画素数だけはこの画像の値にする
+    near_duplicate_values["total_pixel_count"] = total_pixel_count
+  else:
+    # ヒストグラムは画素数の比で拡大・縮小し、グループ集計などでこの画像の大きさに応じた重みになるようにする
+    histograms = np.rint(histograms * (total_pixel_count / max(int(histograms[0].sum()), 1))).astype(np.int64)
+  near_duplicate_values["histograms"] = histograms
+  near_duplicate_values["near_duplicate_of"] = near_duplicate["file_name"]
+  near_duplicate_values["near_duplicate_distance"] = near_duplicate["distance"]
+  # 差分実行(-c)のキャッシュでは、この印でHSV画像・グラフがないことを完了として扱う
+  near_duplicate_values["image_outputs_skipped"] = True
+  return near_duplicate_values
+
+def MakeNearDuplicateCsvColumns(analysis_result: dict):
+  return [analysis_result.get("near_duplicate_of"), analysis_result.get("near_duplicate_distance")]
+
+##################################################
+#                結果データベース用                 
+##################################################
+DATABASE_COLUMNS = ["file_name", "sales_count", "maker_name", "seles_date", "software_name",
+                    "hue_mean", "hue_median", "saturation_mean", "saturation_median", "brightness_mean", "brightness_median",
+                    "sample_size", "total_pixel_count",
+                    "hue_mean_error", "hue_median_error", "saturation_mean_error", "saturation_median_error",
+                    "brightness_mean_error", "brightness_median_error", "dominant_colors"]
+
+class ResultDatabase:
+  def __init__(self, database_file_name: str):
+    self.connection = sqlite3.connect(database_file_name)
+    self.connection.row_factory = sqlite3.Row
+    self.pending_rows = []
+    self.connection.executescript('''
+      CREATE TABLE IF NOT EXISTS image_statistics (
+        file_name TEXT PRIMARY KEY,
+        sales_count INTEGER,
+        maker_name TEXT,
+        seles_date TEXT,
+        software_name TEXT,
+        hue_mean REAL, hue_median REAL,
+        saturation_mean REAL, saturation_median REAL,
+        brightness_mean REAL, brightness_median REAL,
+        sample_size INTEGER, total_pixel_count INTEGER,
+        hue_mean_error REAL, hue_median_error REAL,
+        saturation_mean_error REAL, saturation_median_error REAL,
+        brightness_mean_error REAL, brightness_median_error REAL,
+        dominant_colors TEXT
+      );
+      CREATE INDEX IF NOT EXISTS index_maker_name ON image_statistics (maker_name);
+      CREATE INDEX IF NOT EXISTS index_seles_date ON image_statistics (seles_date);
+      CREATE INDEX IF NOT EXISTS index_sales_count ON image_statistics (sales_count);
+    ''')
+    # 主要色の列がない古いデータベースには列を追加する
+    existing_columns = [row["name"] for row in self.connection.execute("PRAGMA table_info(image_statistics)")]
+    if "dominant_colors" not in existing_columns:
+      with self.connection:
+        self.connection.execute("ALTER TABLE image_statistics ADD COLUMN dominant_colors TEXT")
+  
+  def Upsert(self, analysis_result: dict):
+    # 1件ごとにコミットすると遅いため、一定件数ごとに1つのトランザクションでまとめて書き込む
+    self.pending_rows.append([ConvertDatabaseValue(analysis_result.get(column)) for column in DATABASE_COLUMNS])
+    if len(self.pending_rows) >= DATABASE_COMMIT_INTERVAL:
+      self.Commit()
+  
+  def Commit(self):
+    if len(self.pending_rows) == 0:
+      return
+    with self.connection:
+      self.connection.executemany("INSERT OR REPLACE INTO image_statistics (" + ", ".join(DATABASE_COLUMNS) + ") VALUES (" +
+                                  ", ".join(["?"] * len(DATABASE_COLUMNS)) + ")", self.pending_rows)
+    self.pending_rows = []
+  
+  def MakeQueryCondition(self, filters: dict):
+    conditions = []
+    parameters = []
+    for column, operator, filter_key in (("maker_name", "=", "maker_name"), ("seles_date", ">=", "date_from"), ("seles_date", "<=", "date_to"),
+                                         ("sales_count", ">=", "sales_min"), ("sales_count", "<=", "sales_max")):
+      if filters.get(filter_key) is not None:
+        conditions.append(column + " " + operator + " ?")
+        parameters.append(filters[filter_key])
+    if len(conditions) == 0:
+      return "", parameters
+    return " WHERE " + " AND ".join(conditions), parameters
+  
+  def QueryCsvWidths(self, filters: dict):
+    # -s/-k の有無が異なる実行の結果が混在するため、条件に合う行に標本化の項目があるかと主要色の最大数を先に調べる
+    condition, parameters = self.MakeQueryCondition(filters)
+    has_sampling_columns = False
+    color_count = 0
+    for row in self.connection.execute("SELECT sample_size, dominant_colors FROM image_statistics" + condition, parameters):
+      if row["sample_size"] is not None:
+        has_sampling_columns = True
+      if row["dominant_colors"] is not None:
+        color_count = max(color_count, len(json.loads(row["dominant_colors"])))
+    return has_sampling_columns, color_count
+  
+  def Query(self, filters: dict):
+    condition, parameters = self.MakeQueryCondition(filters)
+    # 全件を読み込まずに一定件数ずつ取り出す
+    cursor = self.connection.execute("SELECT * FROM image_statistics" + condition + " ORDER BY file_name", parameters)
+    while True:
+      rows = cursor.fetchmany(QUERY_FETCH_SIZE)
+      if len(rows) == 0:
+        break
+      for row in rows:
+        analysis_result = {key: row[key] for key in row.keys() if row[key] is not None}
+        if "dominant_colors" in analysis_result:
+          analysis_result["dominant_colors"] = json.loads(analysis_result["dominant_colors"])
+        yield analysis_result
+  
+  def Close(self):
+    self.Commit()
+    self.connection.close()
+
+def ConvertDatabaseValue(value):
+  # numpyの数値型はsqlite3にそのまま渡せないためPythonの型に戻す
+  if isinstance(value, np.generic):
+    return value.item()
+  if isinstance(value, list):
+    # 主要色のような入れ子の値はJSON文字列として1列に収める
+    return json.dumps(value)
+  return value
+
+def MakeQueryCsvRow(analysis_result: dict, has_sampling_columns: bool, color_count: int):
+  # 標本化の項目や主要色がない行は空欄で埋め、ヘッダと全行の列を揃える
+  csv_row = MakeCsvRow(analysis_result, 0)[:len(CSV_HEADER)]
+  if has_sampling_columns == True:
+    csv_row += MakeSamplingCsvColumns(analysis_result) or [None] * len(SAMPLING_CSV_HEADER)
+  return csv_row + MakeDominantColorCsvColumns({"dominant_colors": analysis_result.get("dominant_colors", [])}, color_count)
+
+def ExportDatabaseQuery(filters: dict):
+  database = ResultDatabase(DATABASE_FILE_NAME)
+  exported_count = 0
+  try:
+    has_sampling_columns, color_count = database.QueryCsvWidths(filters)
+    with open(OUTPUT_CSV_DIR + "/" + output_file_name + QUERY_CSV_FILE_NAME, mode='w', encoding='utf-8', newline='') as query_csv_file:
+      query_csv_writer = csv.writer(query_csv_file, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
+      query_csv_writer.writerow(CSV_HEADER + (SAMPLING_CSV_HEADER if has_sampling_columns == True else []) + MakeDominantColorCsvHeader(color_count))
+      with open(OUTPUT_JSON_DIR + "/" + output_file_name + QUERY_JSON_FILE_NAME, mode='w', encoding='utf-8', newline='') as query_json_file:
+        query_json_file.write('[')
+        for analysis_result in database.Query(filters):
+          if exported_count > 0:
+            query_json_file.write(',')
+          query_csv_writer.writerow(MakeQueryCsvRow(analysis_result, has_sampling_columns, color_count))
+          json.dump(MakeJsonRecord(analysis_result), query_json_file, ensure_ascii=False)
+          query_json_file.write('\n')
+          exported_count += 1
+        query_json_file.write(']')
+  finally:
+    database.Close()
+  
+  return exported_count
+
+##################################################
+#                 メモリ管理用                 
+##################################################
+def ReadAvailableMemoryBytes():
+  # Linuxではページキャッシュなど解放可能な分を含むMemAvailableを使う
+  try:
+    with open("/proc/meminfo", "r") as meminfo_file:
+      for meminfo_line in meminfo_file:
+        if meminfo_line.startswith("MemAvailable:"):
+          return int(meminfo_line.split()[1]) * 1024
+  except (OSError, ValueError):
+    pass
+  try:
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return None
+
+def CalcDecodedBytesPerPixel(image_mode: str):
+  # PILは複数チャンネルの画像を1画素4バイトで保持する(RGBも4バイト)
+  if len(image_mode) > 1 and image_mode.startswith("I;16"):
+    return 2
+  if image_mode in ("I", "F") or Image.getmodebands(image_mode) > 1:
+    return 4
+  return 1
+
+def CalcNormalizedBytesPerPixel(image_mode: str):
+  # HsvConverter.NormalizeImageで作る配列(PILからの受け渡しで一時的に2倍になる)と、RGB以外のモードで挟まる変換
+  if image_mode == "L":
+    return 1 * 2
+  if image_mode == "RGB":
+    return 3 * 2
+  if image_mode in ("RGBA", "RGBX"):
+    return 4 * 2
+  return 4 + 3 * 2
+
+def EstimateImageMemory(process_file_name: str):
+  global sample_pixel_count
+  global is_stats_only_mode
+  
+  # ヘッダだけを読み、デコード済みの元画像と変換・集計の作業領域の大きさを見積もる(画素のデコードはしない)
+  with Image.open(process_file_name) as header_image:
+    image_width, image_height = header_image.size
+    image_mode = header_image.mode
+    image_format = header_image.format
+  total_pixel_count = image_width * image_height
+  decoded_pixel_count = total_pixel_count
+  working_pixel_count = total_pixel_count
+  if 0 < sample_pixel_count < total_pixel_count:
+    working_pixel_count = sample_pixel_count
+    if image_format == "JPEG":
+      # 縮小デコードは目標以上で最も小さい1/2^nの大きさになるため、面積は目標の4倍未満に収まる
+      decoded_pixel_count = min(total_pixel_count, sample_pixel_count * 4)
+  
+  decoded_bytes = decoded_pixel_count * CalcDecodedBytesPerPixel(image_mode)
+  working_bytes_per_pixel = CalcNormalizedBytesPerPixel(image_mode) + HSV_PLANE_BYTES_PER_PIXEL
+  if is_stats_only_mode == False:
+    working_bytes_per_pixel += CHANNEL_IMAGE_BYTES_PER_PIXEL
+  return decoded_bytes, working_pixel_count * working_bytes_per_pixel + IMAGE_FIXED_OVERHEAD_BYTES
+
+class MemoryBudgetScheduler:
+  # 見積もった作業領域の合計がメモリ予算に収まる間だけ画像の処理を始めさせる
+  # 処理中の画像が無ければ予算を超える画像も1枚だけは通し、その場合は帯状の処理に切り替えて作業領域を予算に合わせる
+  def __init__(self, budget_bytes: int):
+    self.budget_bytes = budget_bytes
+    self.admitted_bytes = 0
+    self.peak_admitted_bytes = 0
+    self.strip_fallback_count = 0
+    self.recycle_count = 0
+    self.condition = threading.Condition()
+  
+  def PlanImage(self, process_file_name: str, extra_bytes: int = 0):
+    global tile_budget_megabytes
+    
+    try:
+      decoded_bytes, working_bytes = EstimateImageMemory(process_file_name)
+    except Exception:
+      # 読めない画像は解析側でエラーとして報告されるため、ここでは作業領域なしとして通す
+      return {"estimated_bytes": extra_bytes, "tile_budget": None}
+    tile_budget = None
+    if tile_budget_megabytes > 0:
+      working_bytes = tile_budget_megabytes * 1024 * 1024 + IMAGE_FIXED_OVERHEAD_BYTES
+    elif self.budget_bytes > 0 and decoded_bytes + working_bytes + extra_bytes > self.budget_bytes:
+      # デコード済みの元画像は分割できないため、残りの予算を帯状の処理の作業領域に充てる
+      tile_budget = max((self.budget_bytes - decoded_bytes - extra_bytes - IMAGE_FIXED_OVERHEAD_BYTES) // (1024 * 1024), MIN_FALLBACK_TILE_MEGABYTES)
+      working_bytes = tile_budget * 1024 * 1024 + IMAGE_FIXED_OVERHEAD_BYTES
+      with self.condition:
+        self.strip_fallback_count += 1
+    return {"estimated_bytes": decoded_bytes + working_bytes + extra_bytes, "tile_budget": tile_budget}
+  
+  def Admit(self, image_plan: dict, blocking: bool = True):
+    with self.condition:
+      while self.budget_bytes > 0 and self.admitted_bytes > 0 and self.admitted_bytes + image_plan["estimated_bytes"] > self.budget_bytes:
+        if blocking == False:
+          return False
+        self.condition.wait()
+      self.admitted_bytes += image_plan["estimated_bytes"]
+      self.peak_admitted_bytes = max(self.peak_admitted_bytes, self.admitted_bytes)
+      return True
+  
+  def Release(self, image_plan: dict):
+    with self.condition:
+      self.admitted_bytes -= image_plan["estimated_bytes"]
+      self.condition.notify_all()
+  
+  def CountRecycle(self):
+    with self.condition:
+      self.recycle_count += 1
+  
+  def PrintSummary(self):
+    print("Peak admitted memory: {:.1f} MB / budget {:.1f} MB".format(self.peak_admitted_bytes / (1024 * 1024), self.budget_bytes / (1024 * 1024)))
+    if self.strip_fallback_count > 0:
+      print("Images processed in strips:", self.strip_fallback_count)
+    if self.recycle_count > 0:
+      print("Recycled worker pools:", self.recycle_count)
+
+def ReleaseConversionBuffers():
+  global hsv_converter
+  
+  # HSV変換の出力配列は処理した最大の画像の大きさのまま残るため、RSSが上限を超えたら手放す
+  hsv_converter = None
+  gc.collect()
+
+def TrimProcessMemory():
+  global worker_rss_limit_bytes
+  
+  # 画像1枚の処理後に呼び、上限を超えていれば使い回している配列を解放してからのRSSを返す
+  rss_bytes = ReadCurrentRssBytes()
+  if rss_bytes is None or worker_rss_limit_bytes <= 0 or rss_bytes <= worker_rss_limit_bytes:
+    return rss_bytes
+  ReleaseConversionBuffers()
+  return ReadCurrentRssBytes()
+
+##################################################
+#                  並列処理用                 
+##################################################
+def CollectWorkerSettings():
+  # spawn方式(Windows)でも子プロセスに引数の設定を引き継ぐため明示的に渡す
+  return {
+    "output_file_name": output_file_name,
+    "prefix_figure_title_name": prefix_figure_title_name,
+    "equal_width": equal_width,
+    "is_dny_output": is_dny_output,
+    "is_stats_only_mode": is_stats_only_mode,
+    "figure_backend": figure_backend,
+    "is_composite_figure": is_composite_figure,
+    "verbosity": verbosity,
+    "sample_pixel_count": sample_pixel_count,
+    "tile_budget_megabytes": tile_budget_megabytes,
+    "is_profile_mode": is_profile_mode,
+    "is_allocation_trace_mode": is_allocation_trace_mode,
+    "dominant_color_count": dominant_color_count,
+    "use_near_duplicate_index": use_near_duplicate_index,
+    "near_duplicate_distance": near_duplicate_distance,
+    "worker_rss_limit_bytes": worker_rss_limit_bytes,
   }
+
+def InitializeWorkerProcess(worker_settings: dict):
+  global progress_reporter
+  global output_file_name
+  global prefix_figure_title_name
+  global equal_width
+  global is_dny_output
+  global use_interactive_mode
+  global verbosity
+  global sample_pixel_count
+  global tile_budget_megabytes
+  global is_profile_mode
+  global is_allocation_trace_mode
+  global is_stats_only_mode
+  global figure_backend
+  global is_composite_figure
+  global dominant_color_count
+  global use_near_duplicate_index
+  global near_duplicate_distance
+  global near_duplicate_index
+  global worker_rss_limit_bytes
   
+  # 進捗表示は親プロセスのみが行う
+  progress_reporter = None
+  output_file_name = worker_settings["output_file_name"]
+  prefix_figure_title_name = worker_settings["prefix_figure_title_name"]
+  equal_width = worker_settings["equal_width"]
+  is_dny_output = worker_settings["is_dny_output"]
+  is_stats_only_mode = worker_settings["is_stats_only_mode"]
+  figure_backend = worker_settings["figure_backend"]
+  is_composite_figure = worker_settings["is_composite_figure"]
+  use_interactive_mode = False
+  verbosity = worker_settings["verbosity"]
+  sample_pixel_count = worker_settings["sample_pixel_count"]
+  tile_budget_megabytes = worker_settings["tile_budget_megabytes"]
+  is_profile_mode = worker_settings["is_profile_mode"]
+  is_allocation_trace_mode = worker_settings["is_allocation_trace_mode"]
+  dominant_color_count = worker_settings["dominant_color_count"]
+  use_near_duplicate_index = worker_settings["use_near_duplicate_index"]
+  near_duplicate_distance = worker_settings["near_duplicate_distance"]
+  worker_rss_limit_bytes = worker_settings["worker_rss_limit_bytes"]
+  # ワーカーは起動時点の索引を読み込んで検索だけを行い、索引への追加は結果を書き出す親プロセスが行う
+  # (同じ実行の中で別のワーカーが解析した近似重複は、親プロセスが書き出す時に関係だけを記録する)
+  near_duplicate_index = CreateNearDuplicateIndex() if use_near_duplicate_index == True else None
+
+def AnalyzeImageInWorker(process_file_name: str, tile_budget: int = None):
+  # 処理後のRSSも返し、解放しても上限を超えたままなら親プロセスがワーカーを入れ替える
   try:
-    wait_controller = multiprocessing.Process(target=WaitingAnimate, args=(sync_queue,))
-    wait_controller.start()
+    analysis_result = AnalyzeImageProcess(process_file_name, True, tile_budget)
+    return process_file_name, analysis_result, "", TrimProcessMemory()
+  except Exception as e:
+    return process_file_name, None, str(e), TrimProcessMemory()
 
-    if batch_mode == True:
-      input_file_name = process_file_name
-      base_file_name = os.path.basename(process_file_name).split('.')[0]
-      output_file_name = base_file_name + "_"
-      prefix_figure_title_name = ""
-      suffix_figure_title_name = " - " + base_file_name
-
-      ## for csv & json
-      base_file_name_with_split = base_file_name.split('_')
-      sales_count = int(base_file_name_with_split[0])
-      maker_name = base_file_name_with_split[1]
-      seles_date = base_file_name_with_split[2]
-      software_name = ' '.join(base_file_name_with_split[3:])
-      
-      # グラフのタイトルをファイル名から動的に付与
-      hue_figure_title_name_with_prefix = HUE_FIGURE_TITLE_NAME['japanese'] + suffix_figure_title_name
-      saturation_figure_title_name_with_prefix = SATURATION_FIGURE_TITLE_NAME['japanese'] + suffix_figure_title_name
-      brightness_figure_title_name_with_prefix = BRIGHTNESS_FIGURE_TITLE_NAME['japanese'] + suffix_figure_title_name
-    else:
-      base_file_name = os.path.basename(process_file_name).split('.')[0]
-      
-    with open(input_file_name, "rb") as pointer_of_input_image:
-      input_image = Image.open(pointer_of_input_image)
+def CreateWorkerPool(number_of_jobs: int):
+  return concurrent.futures.ProcessPoolExecutor(max_workers=number_of_jobs,
+                                                initializer=InitializeWorkerProcess,
+                                                initargs=(CollectWorkerSettings(),))
+
+def RunParallelBatch(target_file_names, number_of_jobs: int, result_csv_file, result_csv_writer, result_json_file, result_cache = None, memory_scheduler = None):
+  # 出力の書き込みは親プロセスのみが行い、投入順(=ファイル名順)で書き出す
+  # メモリ予算がある場合は、見積りが予算に収まるまで先に投入した結果を書き出してから次を投入する
+  max_in_flight = number_of_jobs * MAX_IN_FLIGHT_FACTOR
+  pending_futures = collections.deque()
+  processed_count = 0
+  failed_count = 0
+  executor = CreateWorkerPool(number_of_jobs)
+  executor_generation = 0
+  is_recycle_requested = False
+  
+  def RecreateBrokenPool(worker_generation: int):
+    nonlocal executor
+    nonlocal executor_generation
     
-      hsv_image = input_image.convert("HSV")
-      hue_image, saturation_image, brightness_image = input_image.convert("HSV").split()
-      
-      if verbosity >= VERY_NOISY_MODE:
-        PrintDebugInfomation(input_image, hsv_image, hue_image, saturation_image, brightness_image)
-      
-      hue_data = np.array(list(hue_image.getdata()))
-      saturation_data = np.array(list(saturation_image.getdata()))
-      brightness_data = np.array(list(brightness_image.getdata()))
-      
-      hue_mean, saturation_mean, brightness_mean = CalcMeanValues(hue_data, saturation_data, brightness_data)
-      hue_median, saturation_median, brightness_median = CalcMedianValues(hue_data, saturation_data, brightness_data)
-      
-      result_csv_writer.writerow([sales_count, maker_name, seles_date, software_name, hue_mean, hue_median, saturation_mean, saturation_median, brightness_mean, brightness_median])
-      json_retult_data = {
-          "発売元": maker_name,
-          "発売日": seles_date,
-          "売上": sales_count,
-          "パッケージ名": software_name,
-          "色相": [{
-            "平均値": hue_mean,
-            "頻出値": hue_median,
-          }],
-          "彩度": [{
-            "平均値": saturation_mean,
-            "頻出値": saturation_median,
-          }],
-          "明度": [{
-            "平均値": brightness_mean,
-            "頻出値": brightness_median,
-          }],
-      }
-      if is_init_process == True:
-        is_init_process = False
-      else:
-        result_json_file.write(',')
-
-      json.dump(json_retult_data, result_json_file, ensure_ascii=False)
-      result_json_file.write('\n')
-
-      if verbosity == VERY_NOISY_MODE:
-        sync_queue.put_nowait(MAIN_PROCESS_REQUESTS_SLEEP_CALL)
-        time.sleep(0.5)
-        print("\rhue mean:", hue_mean, ", hue median :", hue_median, WHITE_PADDING)
-        print("\rsaturation mean:", saturation_mean, ", saturation median :", saturation_median, WHITE_PADDING)
-        print("\rbrightness mean:", brightness_mean, ", brightness median :", brightness_median, WHITE_PADDING)
-        sync_queue.put(MAIN_PROCESS_IS_IN_PROGRESS)
-      
-      figure_hue = plt.figure(hue_figure_title_name_with_prefix)
-      figure_saturation = plt.figure(saturation_figure_title_name_with_prefix)
-      figure_brightness = plt.figure(brightness_figure_title_name_with_prefix)
-      hue_plot = figure_hue.add_subplot(1,1,1)
-      saturation_plot = figure_saturation.add_subplot(1,1,1)
-      brightness_plot = figure_brightness.add_subplot(1,1,1)
-      
-      MakePlotFigure(hsv_base_image = hue_image,
-                    figure = hue_plot,
-                    plot_color = COLORS["blue"],
-                    figure_title = hue_figure_title_name_with_prefix,
-                    xlabel = xlabel_list['hue_label']['japanese'], ylabel = ylabel_list['hue_label']['japanese'],
-                    equal_width_bins = equal_width,
-                    output_prefix_name = output_file_name,
-                    output_suffix_name = 'Image_Hue.png')
-      
-      MakePlotFigure(hsv_base_image = saturation_image,
-                    figure = saturation_plot,
-                    plot_color = COLORS["blue"],
-                    figure_title = saturation_figure_title_name_with_prefix,
-                    xlabel = xlabel_list['saturation_label']['japanese'], ylabel = ylabel_list['saturation_label']['japanese'],
-                    equal_width_bins = equal_width,
-                    output_prefix_name = output_file_name,
-                    output_suffix_name = 'Image_Saturation.png')
-                    
-      MakePlotFigure(hsv_base_image = brightness_image,
-                    figure = brightness_plot,
-                    plot_color = COLORS["blue"],
-                    figure_title = brightness_figure_title_name_with_prefix,
-                    xlabel = xlabel_list['brightness_label']['japanese'], ylabel = ylabel_list['brightness_label']['japanese'],
-                    equal_width_bins = equal_width,
-                    output_prefix_name = output_file_name,
-                    output_suffix_name = 'Image_Brightness.png')
-                    
-      hue_plot.set_xlim(left=default_xlim_min, right=default_xlim_max)
-      saturation_plot.set_xlim(left=default_xlim_min, right=default_xlim_max)
-      brightness_plot.set_xlim(left=default_xlim_min, right=default_xlim_max)
+    # メモリ不足での強制終了やデコーダの異常終了などでワーカーが落ちると、プールに投入済みの全ての画像が失敗するため作り直す
+    if worker_generation == executor_generation:
+      executor.shutdown(wait=False)
+      executor = CreateWorkerPool(number_of_jobs)
+      executor_generation += 1
+  
+  def SubmitImage(process_file_name: str, tile_budget: int):
+    try:
+      return executor.submit(AnalyzeImageInWorker, process_file_name, tile_budget)
+    except concurrent.futures.process.BrokenProcessPool:
+      # 投入済みの画像の結果を受け取る前にプールが壊れていることがある
+      RecreateBrokenPool(executor_generation)
+      return executor.submit(AnalyzeImageInWorker, process_file_name, tile_budget)
+  
+  def WriteCompletedResult(future, is_cached_result: bool, image_plan: dict, worker_generation: int, submitted_file_name: str, is_retry: bool = False):
+    nonlocal processed_count
+    nonlocal failed_count
+    nonlocal is_recycle_requested
+    
+    try:
+      process_file_name, analysis_result, error_message, worker_rss_bytes = future.result()
+    except concurrent.futures.process.BrokenProcessPool as e:
+      RecreateBrokenPool(worker_generation)
+      if is_retry == False:
+        # どの画像が原因かは分からないため、同じプールにいた画像は新しいプールで1枚ずつやり直す
+        retry_future = SubmitImage(submitted_file_name, image_plan["tile_budget"] if image_plan is not None else None)
+        WriteCompletedResult(retry_future, is_cached_result, image_plan, executor_generation, submitted_file_name, True)
+        return
+      process_file_name, analysis_result, error_message, worker_rss_bytes = submitted_file_name, None, "Worker process died: " + str(e), None
+    if image_plan is not None:
+      memory_scheduler.Release(image_plan)
+    if worker_rss_bytes is not None and worker_rss_limit_bytes > 0 and worker_rss_bytes > worker_rss_limit_bytes and worker_generation == executor_generation:
+      # 断片化などで解放しきれないワーカーは、次の投入の前にプールごと新しいプロセスに入れ替える
+      PrintProgressMessage("Recycle workers: RSS {:.1f} MB".format(worker_rss_bytes / (1024 * 1024)))
+      is_recycle_requested = True
+    PrintProgressMessage(process_file_name)
+    if progress_reporter is not None:
+      progress_reporter.Advance(os.path.getsize(process_file_name))
+    if analysis_result is None:
+      PrintProgressMessage("Unexpected error: " + error_message)
+      failed_count += 1
+      return
+    WriteAnalysisResult(analysis_result, result_csv_writer, result_json_file)
+    if result_cache is not None and is_cached_result == False:
+      result_cache.Store(process_file_name, analysis_result)
+    processed_count += 1
+    if (processed_count % BUFFER_POOL_SIZE) == 0:
+      result_csv_file.flush()         # 応急退避
+  
+  try:
+    for str_file_name in target_file_names:
+      if len(pending_futures) >= max_in_flight:
+        WriteCompletedResult(*pending_futures.popleft())
       
-      y_bottom = 0.0
-      y_top = 0.0
-      y_position = 0.0
-      template_phrase_show_analytics_values = '{:>7}: {:>4.1f}\n{:>7}: {:>4.1f}'
+      if is_recycle_requested == True:
+        # 新旧のプールが同時にメモリを使わないよう、投入済みの結果を書き出して古いプールを終了させてから作り直す
+        while pending_futures:
+          WriteCompletedResult(*pending_futures.popleft())
+        executor.shutdown(wait=True)
+        executor = CreateWorkerPool(number_of_jobs)
+        executor_generation += 1
+        is_recycle_requested = False
+        if memory_scheduler is not None:
+          memory_scheduler.CountRecycle()
       
-      y_bottom, y_top = hue_plot.get_ylim()
-      y_position = y_top * 0.98                   # 係数は暫定
-      hue_plot.text(DEFAULT_X_TEXT_POSITON, y_position, template_phrase_show_analytics_values.format(mean_label['japanese'], hue_mean, median_label['japanese'], hue_median), \
-                        fontsize=8,verticalalignment="top", backgroundcolor=DEFAULT_BACKGROUND_COLOR)
-      y_bottom, y_top = saturation_plot.get_ylim()
-      y_position = y_top * 0.98                   # 係数は暫定
-      saturation_plot.text(DEFAULT_X_TEXT_POSITON, y_position, template_phrase_show_analytics_values.format(mean_label['japanese'], saturation_mean, median_label['japanese'], saturation_median), \
-                        fontsize=8,verticalalignment="top", backgroundcolor=DEFAULT_BACKGROUND_COLOR)
-      y_bottom, y_top = brightness_plot.get_ylim()
-      y_position = y_top * 0.98                   # 係数は暫定
-      brightness_plot.text(DEFAULT_X_TEXT_POSITON, y_position, template_phrase_show_analytics_values.format(mean_label['japanese'], brightness_mean, median_label['japanese'], brightness_median), \
-                        fontsize=8,verticalalignment="top", backgroundcolor=DEFAULT_BACKGROUND_COLOR)
+      cached_result = result_cache.Lookup(str_file_name) if result_cache is not None else None
+      if cached_result is not None:
+        # キャッシュ済みの結果も解析結果と同じ順序で書き出すため完了済みのFutureとして並べる
+        future = concurrent.futures.Future()
+        future.set_result((str_file_name, cached_result, "", None))
+        pending_futures.append((future, True, None, executor_generation, str_file_name))
+        continue
       
-      figure_hue.savefig(OUTPUT_FIGURE_DIR + "/" + output_file_name + 'Image_Hue.png')
-      figure_saturation.savefig(OUTPUT_FIGURE_DIR + "/" + output_file_name + 'Image_Saturation.png')
-      figure_brightness.savefig(OUTPUT_FIGURE_DIR + "/" + output_file_name + 'Image_Brightness.png')
+      image_plan = None
+      if memory_scheduler is not None:
+        image_plan = memory_scheduler.PlanImage(str_file_name)
+        while pending_futures and memory_scheduler.Admit(image_plan, blocking=False) == False:
+          WriteCompletedResult(*pending_futures.popleft())
+        if not pending_futures:
+          memory_scheduler.Admit(image_plan)
+      tile_budget = image_plan["tile_budget"] if image_plan is not None else None
+      pending_futures.append((SubmitImage(str_file_name, tile_budget), False, image_plan, executor_generation, str_file_name))
+    while pending_futures:
+      WriteCompletedResult(*pending_futures.popleft())
+  finally:
+    executor.shutdown(wait=True)
+  
+  return processed_count, failed_count
+
+##################################################
+#               パイプライン処理用                 
+##################################################
+def PrefetchInputFiles(target_file_names, prefetch_queue: queue.Queue, memory_scheduler = None):
+  # 解析中の画像の次のファイルを先に読み込んでおき、ディスク・ネットワークの待ち時間を隠す
+  # メモリ予算がある場合は、読み込む前に見積り(ファイル内容を含む)が予算に収まるまで待つ(出力スレッドが書き出し後に返す)
+  for str_file_name in target_file_names:
+    image_plan = None
+    if memory_scheduler is not None:
+      try:
+        input_file_size = os.path.getsize(str_file_name)
+      except OSError:
+        input_file_size = 0
+      image_plan = memory_scheduler.PlanImage(str_file_name, input_file_size)
+      memory_scheduler.Admit(image_plan)
+    try:
+      with open(str_file_name, "rb") as pointer_of_input_file:
+        prefetch_queue.put((str_file_name, pointer_of_input_file.read(), "", image_plan))
+    except OSError as e:
+      prefetch_queue.put((str_file_name, None, str(e), image_plan))
+  prefetch_queue.put(None)
+
+def RunPipelinedBatch(target_file_names, queue_depth: int, result_csv_file, result_csv_writer, result_json_file, result_cache = None, memory_scheduler = None):
+  # 先読み・解析・出力の3段をキューでつなぎ、キューの長さで同時に保持する画像の数を抑える
+  # 解析はメインスレッド、PNGの書き出しと結果の書き込みは出力スレッドのみが行うため、書き込み順はファイル名順のまま
+  prefetch_queue = queue.Queue(maxsize=queue_depth)
+  output_queue = queue.Queue(maxsize=queue_depth)
+  processed_count = 0
+  failed_count = 0
+  
+  # キャッシュの参照はスレッドを起こす前に済ませ、解析が必要なファイルだけを先読みする
+  cached_results = {}
+  if result_cache is not None:
+    for str_file_name in target_file_names:
+      cached_results[str_file_name] = result_cache.Lookup(str_file_name)
+  prefetch_file_names = [str_file_name for str_file_name in target_file_names if cached_results.get(str_file_name) is None]
+  
+  def WriteOutputs():
+    nonlocal processed_count
+    nonlocal failed_count
+    
+    while True:
+      output_job = output_queue.get()
+      if output_job is None:
+        return
+      process_file_name, analysis_result, image_outputs, error_message, image_plan = output_job
+      PrintProgressMessage(process_file_name)
+      if progress_reporter is not None:
+        progress_reporter.Advance(os.path.getsize(process_file_name))
+      if analysis_result is None:
+        PrintProgressMessage("Unexpected error: " + error_message)
+        failed_count += 1
+        if image_plan is not None:
+          memory_scheduler.Release(image_plan)
+        continue
+      try:
+        # image_outputsがNoneの場合はキャッシュ済みの結果で、書き出す画像はない
+        if image_outputs is not None:
+          AttachImageProfile(analysis_result["profile"])
+          try:
+            WriteImageOutputs(analysis_result, image_outputs)
+          finally:
+            DetachImageProfile(analysis_result["profile"])
+        WriteAnalysisResult(analysis_result, result_csv_writer, result_json_file)
+        if result_cache is not None and image_outputs is not None:
+          result_cache.Store(process_file_name, analysis_result)
+      except Exception as e:
+        # 出力スレッドが止まると解析側がキューで待ち続けるため、1ファイルの失敗として扱い処理を続ける
+        PrintProgressMessage("Unexpected error: " + str(e))
+        failed_count += 1
+        continue
+      finally:
+        # 書き出し用の画像を手放した時点で作業領域を予算に返す
+        output_job = image_outputs = None
+        if image_plan is not None:
+          memory_scheduler.Release(image_plan)
+      processed_count += 1
+      if (processed_count % BUFFER_POOL_SIZE) == 0:
+        result_csv_file.flush()         # 応急退避
+  
+  prefetch_thread = threading.Thread(target=PrefetchInputFiles, args=(prefetch_file_names, prefetch_queue, memory_scheduler), daemon=True)
+  output_thread = threading.Thread(target=WriteOutputs, daemon=True)
+  prefetch_thread.start()
+  output_thread.start()
+  try:
+    for str_file_name in target_file_names:
+      cached_result = cached_results.get(str_file_name)
+      if cached_result is not None:
+        output_queue.put((str_file_name, cached_result, None, "", None))
+        continue
       
-      sync_queue.put(MAIN_PROCESS_WAS_FINISHED)
-      time.sleep(0.5)
-      if wait_controller.is_alive() == True:
-        wait_controller.kill()
+      process_file_name, input_file_data, error_message, image_plan = prefetch_queue.get()
+      if input_file_data is None:
+        output_queue.put((process_file_name, None, None, error_message, image_plan))
+        continue
+      tile_budget = image_plan["tile_budget"] if image_plan is not None else None
+      try:
+        analysis_result, image_outputs = AnalyzeImageData(process_file_name, True, input_file_data, tile_budget)
+        analysis_result["profile"] = EndImageProfile()
+        output_queue.put((process_file_name, analysis_result, image_outputs, "", image_plan))
+      except Exception as e:
+        EndImageProfile()
+        output_queue.put((process_file_name, None, None, str(e), image_plan))
+      # 先読みした内容はここで手放し、上限を超えていれば変換用の配列も解放する
+      del input_file_data
+      TrimProcessMemory()
+  finally:
+    output_queue.put(None)
+    output_thread.join()
+  prefetch_thread.join()
+  
+  return processed_count, failed_count
+
+def EnumerateInputFiles():
+  global regex_file_name_pattern
+  
+  # 実行ごとに結果の並び順が変わらないようにファイル名順で処理する
+  filter_pattern = re.compile(regex_file_name_pattern)
+  return [str_file_name for str_file_name in sorted(glob.iglob(INPUT_DIR + '/**', recursive=True))
+          if filter_pattern.search(str_file_name) != None]
+
+##################################################
+#                  監視モード用                 
+##################################################
+class InotifyWatcher:
+  # Linuxのinotifyで書き込みを閉じた(IN_CLOSE_WRITE)・移動してきた(IN_MOVED_TO)ファイルだけを受け取る
+  # 書き込み途中のファイルは通知されず、ディレクトリを走査し直す必要もない
+  name = "inotify"
+  
+  def __init__(self, root_dir: str):
+    import ctypes
+    import ctypes.util
+    
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    self.root_dir = root_dir
+    self.inotify_fd = self.libc.inotify_init()
+    if self.inotify_fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init failed")
+    self.watch_dirs = {}
+    self.AddWatchRecursive(root_dir)
+  
+  def AddWatchRecursive(self, watch_dir: str):
+    # 新しく作られた(移動してきた)ディレクトリの中に既にあるファイルも返す
+    existing_file_names = []
+    for dir_path, _, file_names in os.walk(watch_dir):
+      watch_descriptor = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(dir_path), INOTIFY_WATCH_MASK)
+      if watch_descriptor >= 0:
+        self.watch_dirs[watch_descriptor] = dir_path
+      existing_file_names += [os.path.join(dir_path, file_name) for file_name in file_names]
+    return existing_file_names
+  
+  def ReadChanges(self, timeout: float):
+    import select
+    
+    readable_fds, _, _ = select.select([self.inotify_fd], [], [], timeout)
+    if len(readable_fds) == 0:
+      return []
+    detected_time = time.perf_counter()
+    event_data = os.read(self.inotify_fd, INOTIFY_READ_SIZE)
+    changed_file_names = []
+    offset = 0
+    while offset < len(event_data):
+      watch_descriptor, event_mask, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(event_data, offset)
+      event_name = os.fsdecode(event_data[offset + INOTIFY_EVENT_HEADER.size:offset + INOTIFY_EVENT_HEADER.size + name_length].rstrip(b'\0'))
+      offset += INOTIFY_EVENT_HEADER.size + name_length
       
-      if use_interactive_mode == True:
-        plt.show()
+      if event_mask & IN_Q_OVERFLOW:
+        # 通知が溢れた場合は取りこぼしを避けるため全ファイルを候補にする(処理済みの判定は呼び出し側で行う)
+        changed_file_names += [os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(self.root_dir) for file_name in file_names]
+        continue
+      if event_mask & IN_IGNORED:
+        self.watch_dirs.pop(watch_descriptor, None)
+        continue
+      if watch_descriptor not in self.watch_dirs:
+        continue
+      event_path = os.path.join(self.watch_dirs[watch_descriptor], event_name)
+      if event_mask & IN_ISDIR:
+        if event_mask & (IN_CREATE | IN_MOVED_TO):
+          changed_file_names += self.AddWatchRecursive(event_path)
+      elif event_mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        changed_file_names.append(event_path)
+    return [(file_name, detected_time) for file_name in changed_file_names]
+  
+  def Close(self):
+    os.close(self.inotify_fd)
+
+class PollingWatcher:
+  # inotifyが使えない環境向けに、一定間隔でディレクトリを走査して大きさと更新時刻の変化を検出する
+  name = "polling"
+  
+  def __init__(self, root_dir: str):
+    self.root_dir = root_dir
+    self.file_statuses = self.Scan()
+    self.pending_files = {}
+  
+  def Scan(self):
+    # os.scandirはディレクトリ一覧の取得と種別判定を1回で行えるためglobより軽い
+    file_statuses = {}
+    scan_dirs = [self.root_dir]
+    while scan_dirs:
+      try:
+        with os.scandir(scan_dirs.pop()) as dir_entries:
+          for dir_entry in dir_entries:
+            if dir_entry.is_dir(follow_symlinks=False):
+              scan_dirs.append(dir_entry.path)
+            elif dir_entry.is_file():
+              file_status = dir_entry.stat()
+              file_statuses[dir_entry.path] = (file_status.st_size, file_status.st_mtime_ns)
+      except OSError:
+        continue
+    return file_statuses
+  
+  def ReadChanges(self, timeout: float):
+    time.sleep(timeout)
+    scan_time = time.perf_counter()
+    current_statuses = self.Scan()
+    changed_files = []
+    for file_name, file_status in current_statuses.items():
+      if self.file_statuses.get(file_name) == file_status:
+        continue
+      # 書き込み途中のファイルを拾わないよう、前回の走査から大きさと更新時刻が変わっていないものだけを返す
+      pending_status = self.pending_files.get(file_name)
+      if pending_status is not None and pending_status[0] == file_status:
+        changed_files.append((file_name, pending_status[1]))
+        self.file_statuses[file_name] = file_status
+        del self.pending_files[file_name]
+      else:
+        self.pending_files[file_name] = (file_status, scan_time if pending_status is None else pending_status[1])
+    for file_name in set(self.file_statuses) - set(current_statuses):
+      del self.file_statuses[file_name]
+    for file_name in set(self.pending_files) - set(current_statuses):
+      del self.pending_files[file_name]
+    return changed_files
+  
+  def Close(self):
+    pass
+
+def CreateInputWatcher(root_dir: str):
+  if sys.platform.startswith("linux"):
+    try:
+      return InotifyWatcher(root_dir)
+    except (OSError, AttributeError, TypeError):
+      pass
+  return PollingWatcher(root_dir)
+
+def FlushAnalysisOutputs(result_csv_file, result_json_file):
+  global histogram_store
+  global group_aggregate
+  global result_database
+  
+  # 1件ごとに書き出して読み手が途中までの行を見ないようにする(追記は1回のwriteにまとまる)
+  for output_file in (result_csv_file, result_json_file):
+    output_file.flush()
+    os.fsync(output_file.fileno())
+  if histogram_store is not None:
+    histogram_store.Flush()
+  if group_aggregate is not None:
+    group_aggregate.Save()
+    group_aggregate.Export(AGGREGATE_CSV_FILE_NAME, AGGREGATE_JSON_FILE_NAME)
+  if result_database is not None:
+    result_database.Commit()
+
+def ResumeJsonArray(result_json_file):
+  global is_init_process
+  
+  # 監視モードでは既存のJSONの配列の続きに追記し、ファイル全体を1つの配列に保つ
+  result_json_file.flush()
+  json_file_size = os.fstat(result_json_file.fileno()).st_size
+  with open(result_json_file.name, mode='rb') as existing_json_file:
+    existing_json_file.seek(max(json_file_size - JSON_TAIL_READ_SIZE, 0))
+    json_tail = existing_json_file.read()
+  stripped_json_tail = json_tail.rstrip()
+  if stripped_json_tail.endswith(b']'):
+    # 閉じ括弧(とその後ろの空白)を取り除く
+    os.ftruncate(result_json_file.fileno(), json_file_size - (len(json_tail) - len(stripped_json_tail)) - 1)
+    result_json_file.seek(0, os.SEEK_END)
+    stripped_json_tail = stripped_json_tail[:-1].rstrip()
+  
+  if stripped_json_tail == b'':
+    result_json_file.write('[')
+  elif stripped_json_tail.endswith(b'[') == False:
+    # 既に記録がある配列では、次の記録の前に区切りを入れる
+    is_init_process = False
+
+def CloseJsonArray(result_json_file):
+  # 監視中も読み手が常に正しいJSONとして読めるよう、1件ごとに配列を閉じた状態で書き出す
+  result_json_file.write(']')
+  result_json_file.flush()
+
+def ReopenJsonArray(result_json_file):
+  # CloseJsonArrayで書いた閉じ括弧を外して、次の記録を追記できるようにする
+  result_json_file.flush()
+  os.ftruncate(result_json_file.fileno(), os.fstat(result_json_file.fileno()).st_size - 1)
+  result_json_file.seek(0, os.SEEK_END)
+
+def RunWatchMode(result_csv_file, result_csv_writer, result_json_file):
+  global regex_file_name_pattern
+  global watch_interval
+  import signal
+  
+  filter_pattern = re.compile(regex_file_name_pattern)
+  watcher = CreateInputWatcher(INPUT_DIR)
+  print("Watching:", INPUT_DIR, "(" + watcher.name + ")")
+  print("Press Ctrl+C to stop.")
+  # SIGTERMでも処理中の1件を書き終えてから監視を止め、通常の終了処理でファイルを閉じる
+  stop_requests = []
+  previous_sigterm_handler = signal.signal(signal.SIGTERM, lambda signal_number, stack_frame: stop_requests.append(signal_number))
+  
+  # 同じ内容のまま閉じられたファイルなどを二重に処理しないよう、処理時の大きさと更新時刻を覚えておく
+  analyzed_statuses = {}
+  latencies = []
+  failed_count = 0
+  CloseJsonArray(result_json_file)
+  try:
+    while len(stop_requests) == 0:
+      for str_file_name, detected_time in sorted(watcher.ReadChanges(watch_interval)):
+        if len(stop_requests) > 0:
+          break
+        if filter_pattern.search(str_file_name) == None:
+          continue
+        try:
+          file_status = os.stat(str_file_name)
+        except OSError:
+          continue
+        if analyzed_statuses.get(str_file_name) == (file_status.st_size, file_status.st_mtime_ns):
+          continue
+        analyzed_statuses[str_file_name] = (file_status.st_size, file_status.st_mtime_ns)
         
-      # 後処理(メモリ・リーク対策)
-      plt.clf()
-      plt.close(figure_hue)
-      plt.close(figure_saturation)
-      plt.close(figure_brightness)
-      
-  except Exception as e:
-    wait_controller.terminate()
-    print("\nUnexpected error: " + str(e)) 
-    sys.exit(ERROR_EXIT)
+        PrintProgressMessage(str_file_name)
+        ReopenJsonArray(result_json_file)
+        try:
+          analysis_status = AnalyzeImage(str_file_name, True, result_csv_writer, result_json_file)
+        finally:
+          CloseJsonArray(result_json_file)
+        if analysis_status != NORMAL_EXIT:
+          failed_count += 1
+          continue
+        FlushAnalysisOutputs(result_csv_file, result_json_file)
+        latencies.append(time.perf_counter() - detected_time)
+        PrintProgressMessage("Latency: {:.1f} ms".format(latencies[-1] * 1000))
+    print("\nStopped watching (SIGTERM).")
   except KeyboardInterrupt:
-    wait_controller.terminate()
-    print("\nKeyboard Interrupt: The script aborted.")
-    sys.exit(NORMAL_EXIT)
+    print("\nStopped watching.")
+  finally:
+    watcher.Close()
+    signal.signal(signal.SIGTERM, previous_sigterm_handler)
   
-  return NORMAL_EXIT
+  # 配列は呼び出し元が閉じる
+  ReopenJsonArray(result_json_file)
+  if len(latencies) > 0:
+    latency_percentiles = np.percentile(latencies, [50, 95]) * 1000
+    print("Watched results:", len(latencies), ", latency p50: {:.1f} ms, p95: {:.1f} ms, max: {:.1f} ms".format(latency_percentiles[0], latency_percentiles[1], max(latencies) * 1000))
+  if failed_count > 0:
+    print("Skipped files:", failed_count)
+  return len(latencies), failed_count
+
+##################################################
+#                解析サービス用                 
+##################################################
+def InitializeServiceWorkerProcess(worker_settings: dict):
+  import signal
+  
+  InitializeWorkerProcess(worker_settings)
+  # Ctrl+Cは親プロセスが受けて順に止めるため、処理中のワーカーは割り込まれないようにする
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def WarmUpWorker(worker_index: int):
+  # 最初の要求で変換用の作業領域の確保やNumPyの初期化を待たせないよう、起動直後に小さな画像を1枚解析しておく
+  GetHsvConverter().Convert(Image.new("RGB", (16, 16)))
+  return os.getpid()
+
+def AnalyzeRequestBatchInWorker(service_requests: list):
+  # 親プロセスとの受け渡しを減らすため、まとめて受け取った要求を順に解析して結果だけを返す
+  batch_results = []
+  for process_file_name, input_file_data in service_requests:
+    try:
+      analysis_result, _ = AnalyzeImageData(process_file_name, True, input_file_data)
+      batch_results.append((MakeJsonRecord(analysis_result), ""))
+    except Exception as e:
+      batch_results.append((None, str(e)))
+    finally:
+      EndImageProfile()
+  return batch_results
+
+class AnalysisService:
+  # 起動済みのワーカープロセスに解析要求を振り分ける
+  # 同時に解析する束の数はワーカー数までとし、空いたワーカーが出た時点で待っている要求をまとめて渡す
+  def __init__(self, number_of_jobs: int, max_pending: int, max_batch: int):
+    self.number_of_jobs = number_of_jobs
+    self.max_pending = max_pending
+    self.max_batch = max_batch
+    self.executor = self.CreateExecutor()
+    self.pending_requests = queue.Queue(maxsize=max_pending)
+    self.worker_slots = threading.Semaphore(number_of_jobs)
+    self.lock = threading.Lock()
+    self.start_time = time.perf_counter()
+    self.request_count = 0
+    self.completed_count = 0
+    self.failed_count = 0
+    self.rejected_count = 0
+    self.in_flight_count = 0
+    self.batch_count = 0
+    self.batched_request_count = 0
+    self.latencies = collections.deque(maxlen=SERVICE_LATENCY_WINDOW)
+    self.dispatcher_thread = threading.Thread(target=self.Dispatch, daemon=True)
+  
+  def CreateExecutor(self):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=self.number_of_jobs,
+                                                  initializer=InitializeServiceWorkerProcess,
+                                                  initargs=(CollectWorkerSettings(),))
+  
+  def Start(self):
+    # 空いているワーカーがなければ投入ごとにプロセスが増えるため、ワーカー数だけ投入すれば全員が起動する
+    warm_up_futures = [self.executor.submit(WarmUpWorker, worker_index) for worker_index in range(self.number_of_jobs)]
+    worker_pids = {warm_up_future.result() for warm_up_future in warm_up_futures}
+    self.start_time = time.perf_counter()
+    self.dispatcher_thread.start()
+    return len(worker_pids)
+  
+  def Submit(self, process_file_name: str, input_file_data: bytes):
+    # 待ち行列が一杯なら受け付けずにNoneを返し、呼び出し側に再試行を促す
+    result_future = concurrent.futures.Future()
+    try:
+      self.pending_requests.put_nowait((process_file_name, input_file_data, result_future))
+    except queue.Full:
+      with self.lock:
+        self.rejected_count += 1
+      return None
+    with self.lock:
+      self.request_count += 1
+    return result_future
+  
+  def Dispatch(self):
+    while True:
+      self.worker_slots.acquire()
+      service_request = self.pending_requests.get()
+      if service_request is None:
+        return
+      # ワーカーが塞がっている間に溜まった要求は1回でまとめて渡す(待ちが無ければ1件ずつで遅延は増えない)
+      service_requests = [service_request]
+      is_stopping = False
+      while len(service_requests) < self.max_batch:
+        try:
+          service_request = self.pending_requests.get_nowait()
+        except queue.Empty:
+          break
+        if service_request is None:
+          is_stopping = True
+          break
+        service_requests.append(service_request)
+      self.SubmitBatch(service_requests)
+      if is_stopping == True:
+        return
+  
+  def SubmitBatch(self, service_requests: list):
+    with self.lock:
+      self.in_flight_count += len(service_requests)
+      self.batch_count += 1
+      self.batched_request_count += len(service_requests)
+      executor = self.executor
+    try:
+      batch_future = executor.submit(AnalyzeRequestBatchInWorker, [(process_file_name, input_file_data) for process_file_name, input_file_data, _ in service_requests])
+    except Exception as e:
+      batch_future = concurrent.futures.Future()
+      batch_future.set_exception(e)
+    batch_future.add_done_callback(lambda completed_future: self.CompleteBatch(service_requests, completed_future, executor))
+  
+  def CompleteBatch(self, service_requests: list, batch_future, executor):
+    try:
+      batch_results = batch_future.result()
+    except Exception as e:
+      batch_results = [(None, "Worker failed: " + str(e))] * len(service_requests)
+      if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+        # メモリ不足などでワーカーが落ちるとプール全体が使えなくなるため作り直す
+        with self.lock:
+          if self.executor is executor:
+            self.executor = self.CreateExecutor()
+        executor.shutdown(wait=False)
+    with self.lock:
+      self.in_flight_count -= len(service_requests)
+    self.worker_slots.release()
+    for (_, _, result_future), batch_result in zip(service_requests, batch_results):
+      result_future.set_result(batch_result)
+  
+  def RecordLatency(self, latency: float, is_failed: bool):
+    with self.lock:
+      self.latencies.append(latency)
+      if is_failed == True:
+        self.failed_count += 1
+      else:
+        self.completed_count += 1
+  
+  def MakeStatistics(self):
+    with self.lock:
+      latencies = list(self.latencies)
+      statistics = {
+        "uptime_seconds": time.perf_counter() - self.start_time,
+        "workers": self.number_of_jobs,
+        "requests": self.request_count,
+        "completed": self.completed_count,
+        "failed": self.failed_count,
+        "rejected": self.rejected_count,
+        "queue_depth": self.pending_requests.qsize(),
+        "max_pending": self.max_pending,
+        "in_flight": self.in_flight_count,
+        "batches": self.batch_count,
+        "average_batch_size": self.batched_request_count / self.batch_count if self.batch_count > 0 else None,
+        "max_batch": self.max_batch,
+      }
+    latency_values = None
+    if len(latencies) > 0:
+      latency_percentiles = np.percentile(latencies, PROFILE_PERCENTILES) * 1000
+      latency_values = {"p" + str(percentile): float(latency_value) for percentile, latency_value in zip(PROFILE_PERCENTILES, latency_percentiles)}
+      latency_values["max"] = max(latencies) * 1000
+    statistics["latency_ms"] = latency_values
+    return statistics
+  
+  def Close(self):
+    self.pending_requests.put(None)
+    self.dispatcher_thread.join()
+    self.executor.shutdown(wait=True)
+
+def ImportServiceModules():
+  global http
+  global socketserver
+  global urllib
+  
+  if http is not None:
+    return
+  import http.server
+  import socketserver
+  import urllib.parse
+
+class AnalysisRequestHandlerMixin:
+  # http.server.BaseHTTPRequestHandlerと組み合わせて使う(基底クラスはImportServiceModulesの後でCreateServiceServerが与える)
+  # POST /analyze : 画像のバイト列(?name=ファイル名)か {"path": ファイルパス} のJSONを受け取り、statistics_report.jsonと同じ形式の1件を返す
+  # GET /stats    : 応答時間と待ち行列の長さなどを返す
+  protocol_version = "HTTP/1.1"
+  
+  def do_GET(self):
+    if urllib.parse.urlsplit(self.path).path == "/stats":
+      self.SendJsonResponse(200, self.server.analysis_service.MakeStatistics())
+    else:
+      self.SendJsonResponse(404, {"error": "Not found: " + self.path})
+  
+  def do_POST(self):
+    request_start_time = time.perf_counter()
+    request_url = urllib.parse.urlsplit(self.path)
+    if request_url.path != "/analyze":
+      self.SendJsonResponse(404, {"error": "Not found: " + self.path})
+      return
+    try:
+      content_length = int(self.headers.get("Content-Length", "0"))
+    except ValueError:
+      content_length = -1
+    if content_length < 0 or content_length > SERVICE_MAX_REQUEST_BYTES:
+      self.close_connection = True
+      self.SendJsonResponse(413 if content_length > 0 else 400, {"error": "Invalid Content-Length."})
+      return
+    request_body = self.rfile.read(content_length)
+    
+    if self.headers.get("Content-Type", "").startswith("application/json"):
+      try:
+        process_file_name = json.loads(request_body)["path"]
+      except (ValueError, KeyError, TypeError):
+        self.SendJsonResponse(400, {"error": "JSON body must be {\"path\": \"<image file path>\"}."})
+        return
+      if isinstance(process_file_name, str) == False or os.path.isfile(process_file_name) == False:
+        self.SendJsonResponse(404, {"error": "File not found: " + str(process_file_name)})
+        return
+      input_file_data = None
+    else:
+      # メーカー名や発売日はファイル名から読み取るため、バイト列で送る場合もファイル名が必要
+      process_file_name = urllib.parse.parse_qs(request_url.query).get("name", [""])[0]
+      if process_file_name == "" or content_length == 0:
+        self.SendJsonResponse(400, {"error": "POST the image bytes with ?name=<file name>."})
+        return
+      input_file_data = request_body
+    
+    analysis_service = self.server.analysis_service
+    result_future = analysis_service.Submit(process_file_name, input_file_data)
+    if result_future is None:
+      self.SendJsonResponse(503, {"error": "Too many pending requests."}, {"Retry-After": str(SERVICE_RETRY_AFTER_SECONDS)})
+      return
+    json_result_data, error_message = result_future.result()
+    analysis_service.RecordLatency(time.perf_counter() - request_start_time, json_result_data is None)
+    if json_result_data is None:
+      self.SendJsonResponse(422, {"error": error_message})
+    else:
+      self.SendJsonResponse(200, json_result_data)
+  
+  def SendJsonResponse(self, status_code: int, response_data: dict, extra_headers: dict = {}):
+    response_body = json.dumps(response_data, ensure_ascii=False).encode("utf-8")
+    try:
+      self.send_response(status_code)
+      self.send_header("Content-Type", "application/json; charset=utf-8")
+      self.send_header("Content-Length", str(len(response_body)))
+      for header_name, header_value in extra_headers.items():
+        self.send_header(header_name, header_value)
+      self.end_headers()
+      self.wfile.write(response_body)
+    except (BrokenPipeError, ConnectionResetError):
+      # 応答を待たずに切断したクライアントは無視する
+      self.close_connection = True
+  
+  def address_string(self):
+    # Unixドメインソケットでは接続元のアドレスがない
+    if isinstance(self.client_address, tuple):
+      return self.client_address[0]
+    return service_socket_path
+  
+  def log_message(self, format, *args):
+    if verbosity >= NOISY_MODE:
+      PrintProgressMessage("[" + self.address_string() + "]: " + (format % args))
+
+class ServiceServerMixin:
+  daemon_threads = True
+  request_queue_size = SERVICE_LISTEN_BACKLOG
+
+def CreateServiceServer():
+  global service_socket_path
+  global service_port
+  
+  ImportServiceModules()
+  request_handler_class = type("AnalysisRequestHandler", (AnalysisRequestHandlerMixin, http.server.BaseHTTPRequestHandler), {})
+  if service_socket_path != "":
+    # 前回の実行で残ったソケットファイルがあると bind できない
+    if os.path.exists(service_socket_path):
+      os.remove(service_socket_path)
+    server_class = type("ThreadingUnixHttpServer", (ServiceServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer), {})
+    return server_class(service_socket_path, request_handler_class), "unix:" + service_socket_path
+  server_class = type("ThreadingTcpHttpServer", (ServiceServerMixin, http.server.ThreadingHTTPServer), {})
+  service_server = server_class((DEFAULT_SERVICE_HOST, service_port), request_handler_class)
+  return service_server, "http://{}:{}".format(*service_server.server_address[:2])
+
+def RunServiceMode():
+  global number_of_jobs
+  global service_max_pending
+  global service_max_batch
+  global service_socket_path
+  
+  analysis_service = AnalysisService(number_of_jobs, service_max_pending, service_max_batch)
+  warm_up_start_time = time.perf_counter()
+  print("Warmed up workers:", analysis_service.Start(), "({:.2f} s)".format(time.perf_counter() - warm_up_start_time))
+  service_server, service_address = CreateServiceServer()
+  service_server.analysis_service = analysis_service
+  print("Listening:", service_address)
+  print("Press Ctrl+C to stop.")
+  try:
+    service_server.serve_forever()
+  except KeyboardInterrupt:
+    print("\nStopped the analysis service.")
+  finally:
+    service_server.server_close()
+    analysis_service.Close()
+    if service_socket_path != "" and os.path.exists(service_socket_path):
+      os.remove(service_socket_path)
+  
+  service_statistics = analysis_service.MakeStatistics()
+  print("Served results:", service_statistics["completed"], ", failed:", service_statistics["failed"], ", rejected:", service_statistics["rejected"])
+  return service_statistics
 
 ##################################################
 #                    Main                 
@@ -505,48 +3543,150 @@ if __name__ == '__main__':
     # 初期処理
     DefineSystemArgumentsProcess()
     
+    # Query mode
+    if is_query_mode == True:
+      print("Enter query mode:")
+      print("Exported results:", ExportDatabaseQuery(query_filters))
+      sys.exit(NORMAL_EXIT)
+    
+    # Service mode
+    if is_service_mode == True:
+      print("Enter service mode:")
+      RunServiceMode()
+      sys.exit(NORMAL_EXIT)
+    
     if is_memory_trace_mode == True:
       memory_leak_checker = TraceMemoryForDebug()      
       
-    is_csv_file_exist = os.path.isfile(CSV_FILE_NAME)
-    if is_csv_file_exist == False:
+    result_cache = None
+    output_file_mode = 'a'
+    if is_from_store_mode == True:
+      # 保存済みのヒストグラムから全件を作り直すため追記しない
+      output_file_mode = 'w'
+    elif is_incremental_mode == True and input_file_name == "":
+      # 差分実行ではキャッシュ済みの行も含めて毎回書き直すため行が重複しない
+      os.makedirs(OUTPUT_CACHE_DIR, exist_ok=True)
+      result_cache = AnalysisResultCache(MANIFEST_FILE_NAME, CollectAnalysisParameters())
+      output_file_mode = 'w'
+      
+    csv_header = MakeCsvHeader(MakeAnalysisOptions()) + (NEAR_DUPLICATE_CSV_HEADER if use_near_duplicate_index == True else [])
+    existing_csv_header = None
+    if os.path.isfile(CSV_FILE_NAME) == True and output_file_mode == 'a':
+      existing_csv_header = ReadCsvHeader(CSV_FILE_NAME)
+    if existing_csv_header is None:
       with open(CSV_FILE_NAME, mode='w', encoding='utf-8', newline='') as new_csv_file:
         init_writer = csv.writer(new_csv_file, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
-        init_writer.writerow(['# 売上', 'メーカー', '発売日', 'タイトル', '色相の平均値', '色相の中央値',  '彩度の平均値', '彩度の中央値', '明度の平均値', '明度の中央値'])
+        init_writer.writerow(csv_header)
+    elif existing_csv_header != csv_header:
+      # -s/-k/-x の有無で列が変わるため、既存のヘッダと列が合わない行は追記しない
+      print("[-]: " + CSV_FILE_NAME + " has " + str(len(existing_csv_header)) + " columns but this run writes " + str(len(csv_header)) + " columns (-s/-k/-x differ).")
+      print("     Move or delete the file, or run with the same -s/-k/-x options as before.")
+      sys.exit(ERROR_EXIT)
 
     with open(CSV_FILE_NAME, mode='a', encoding='utf-8', newline='') as result_csv_file:
       result_csv_writer = csv.writer(result_csv_file, delimiter=',', quoting=csv.QUOTE_NONNUMERIC)
-      with open(JSON_FILE_NAME, mode='a', encoding='utf-8', newline='') as result_json_file:
-        result_json_file.write('[')
+      with open(JSON_FILE_NAME, mode=output_file_mode, encoding='utf-8', newline='') as result_json_file:
+        if is_watch_mode == True:
+          ResumeJsonArray(result_json_file)
+        else:
+          result_json_file.write('[')
+        if use_histogram_store == True and is_from_store_mode == False:
+          os.makedirs(OUTPUT_STORE_DIR, exist_ok=True)
+          histogram_store = HistogramStore(HISTOGRAM_STORE_FILE_NAME, HISTOGRAM_INDEX_FILE_NAME)
+        if use_group_aggregate == True:
+          os.makedirs(OUTPUT_AGGREGATE_DIR, exist_ok=True)
+          group_aggregate = GroupAggregate(AGGREGATE_MEMBER_FILE_NAME, AGGREGATE_MEMBER_INDEX_FILE_NAME, AGGREGATE_GROUP_FILE_NAME)
+        if use_near_duplicate_index == True:
+          os.makedirs(OUTPUT_DEDUP_DIR, exist_ok=True)
+          near_duplicate_index = CreateNearDuplicateIndex()
+        if use_result_database == True:
+          os.makedirs(OUTPUT_DATABASE_DIR, exist_ok=True)
+          result_database = ResultDatabase(DATABASE_FILE_NAME)
+        if is_profile_mode == True:
+          os.makedirs(OUTPUT_PROFILE_DIR, exist_ok=True)
+          profile_report = ProfileReport(PROFILE_FILE_NAME, PROFILE_SUMMARY_FILE_NAME)
+        
+        # Rebuild mode
+        if is_from_store_mode == True:
+          print("Enter rebuild from histogram store mode:")
+          print("Rebuilt results:", RebuildFromHistogramStore(result_csv_writer, result_json_file))
+        # Watch mode
+        elif is_watch_mode == True:
+          print("Enter watch mode:")
+          RunWatchMode(result_csv_file, result_csv_writer, result_json_file)
         # Batch mode
-        if input_file_name == "":
+        elif input_file_name == "":
           print("Enter batch mode:")
-          loop_index = 0
-          filter_pattern = re.compile(regex_file_name_pattern)
+          target_file_names = EnumerateInputFiles()
+          memory_scheduler = MemoryBudgetScheduler(memory_budget_bytes)
+          if memory_budget_bytes > 0:
+            print("Memory budget: {:.1f} MB".format(memory_budget_bytes / (1024 * 1024)))
+          progress_reporter = ProgressReporter(len(target_file_names))
+          progress_reporter.Start()
           
-          for str_file_name in glob.iglob('input/**', recursive=True):
-            if filter_pattern.search(str_file_name) != None:
-              print(str_file_name)
-              AnalyzeImage(str_file_name, True, result_csv_writer, result_json_file)
+          if number_of_jobs > 1:
+            print("Parallel jobs:", number_of_jobs)
+            processed_count, failed_count = RunParallelBatch(target_file_names, number_of_jobs, result_csv_file, result_csv_writer, result_json_file, result_cache, memory_scheduler)
+          elif pipeline_queue_depth > 0:
+            print("Pipeline queue depth:", pipeline_queue_depth)
+            processed_count, failed_count = RunPipelinedBatch(target_file_names, pipeline_queue_depth, result_csv_file, result_csv_writer, result_json_file, result_cache, memory_scheduler)
+          else:
+            loop_index = 0
+            failed_count = 0
+            for str_file_name in target_file_names:
+              PrintProgressMessage(str_file_name)
+              cached_result = result_cache.Lookup(str_file_name) if result_cache is not None else None
+              if cached_result is not None:
+                WriteAnalysisResult(cached_result, result_csv_writer, result_json_file)
+              else:
+                # 1枚ずつ処理するため待つことはないが、予算を超える画像は帯状の処理に切り替える
+                image_plan = memory_scheduler.PlanImage(str_file_name)
+                memory_scheduler.Admit(image_plan)
+                if AnalyzeImage(str_file_name, True, result_csv_writer, result_json_file, result_cache, image_plan["tile_budget"]) != NORMAL_EXIT:
+                  failed_count += 1
+                memory_scheduler.Release(image_plan)
+                TrimProcessMemory()
+              progress_reporter.Advance(os.path.getsize(str_file_name))
               
               if is_memory_trace_mode == True:
                 memory_leak_checker.PrintCurrentMemoryStatus()
               
-              # メモリ・リーク暫定対応
               loop_index += 1
               if (loop_index % BUFFER_POOL_SIZE) == 0:
-                gc.collect()                  # 効果が怪しいけど...
                 result_csv_file.flush()       # 応急退避
-                loop_index = 0
-            
+          
+          progress_reporter.Stop()
+          if memory_budget_bytes > 0:
+            memory_scheduler.PrintSummary()
+          if result_cache is not None:
+            result_cache.Save()
+            print("Reused cached results:", result_cache.reused_count)
+          if failed_count > 0:
+            print("Skipped files:", failed_count)
           print("The process has been completed🎉")
         # Single file process mode
         else:
           print("Enter single file process mode:")
+          progress_reporter = ProgressReporter(1)
+          progress_reporter.Start()
           AnalyzeImage(input_file_name, False, result_csv_writer, result_json_file)
+          progress_reporter.Advance(os.path.getsize(input_file_name))
+          progress_reporter.Stop()
           if is_memory_trace_mode == True:
                 memory_leak_checker.PrintCurrentMemoryStatus()
         result_json_file.write(']')
+        if histogram_store is not None:
+          histogram_store.Close()
+        if group_aggregate is not None:
+          print("Updated group members:", group_aggregate.updated_count, ", exported groups:", group_aggregate.Export(AGGREGATE_CSV_FILE_NAME, AGGREGATE_JSON_FILE_NAME))
+          group_aggregate.Close()
+        if near_duplicate_index is not None:
+          print("Near-duplicates reused:", near_duplicate_index.reused_count, ", flagged:", near_duplicate_index.flagged_count, ", indexed images:", len(near_duplicate_index.entries))
+          near_duplicate_index.Close()
+        if result_database is not None:
+          result_database.Close()
+        if profile_report is not None:
+          PrintProfileSummary(profile_report.Close())
   except Exception as e:
     print("\nUnexpected error: " + str(e)) 
     sys.exit(ERROR_EXIT)